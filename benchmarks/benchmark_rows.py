@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+"""
+    Micro-benchmark of the conversion of BigQuery result rows to PostgreSQL rows
+
+    Compares the previous conversion (one `OrderedDict` per row, filled by column name)
+       with the row formatter used by `ConstantForeignDataWrapper.execute`
+
+    Usage: `python3 -m benchmarks.benchmark_rows` (requires Multicorn)
+"""
+
+import argparse
+import timeit
+from collections import OrderedDict
+
+import multicorn
+from google.cloud import bigquery
+
+from src.fdw import ConstantForeignDataWrapper
+
+
+def set_fdw(width):
+    """
+        Create an instance of ConstantForeignDataWrapper with `width` bigint columns
+    """
+
+    options = {
+        'fdw_dataset': 'dataset',
+        'fdw_table': 'table',
+    }
+    columns = OrderedDict([
+        ('column' + str(i), multicorn.ColumnDefinition(
+            column_name='column' + str(i), type_oid=20, base_type_name='bigint'))
+        for i in range(width)
+    ])
+
+    return ConstantForeignDataWrapper(options, columns)
+
+
+def set_rows(columns, count):
+    """
+        Create `count` BigQuery rows for `columns`
+    """
+
+    fieldToIndex = {column: i for i, column in enumerate(columns)}
+
+    return [bigquery.table.Row(tuple(range(len(columns))), fieldToIndex) for _ in range(count)]
+
+
+def convert_ordered_dict(rows, columns):
+    """
+        Previous conversion: one `OrderedDict` per row
+    """
+
+    for row in rows:
+        line = OrderedDict()
+        for column in columns:
+            line[column] = row[column]
+
+        yield line
+
+
+def convert_formatter(fdw, rows, columns):
+    """
+        Current conversion: positions resolved once per scan
+    """
+
+    formatRow = fdw.getRowFormatter(columns)
+    for row in rows:
+        yield formatRow(row)
+
+
+def run_benchmark(width, selected, count, repeat):
+    """
+        Print the number of rows per second of each conversion
+    """
+
+    fdw = set_fdw(width)
+    columns = list(fdw.columns)[:selected]
+    rows = set_rows(columns, count)
+
+    for name, convert in [
+        ('OrderedDict per row', lambda: list(convert_ordered_dict(rows, columns))),
+        ('Row formatter', lambda: list(convert_formatter(fdw, rows, columns))),
+    ]:
+        duration = min(timeit.repeat(convert, number=1, repeat=repeat))
+        print(" * %s: %d rows/sec" % (name, count / duration))
+
+
+def main():
+
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--width", type=int,
+                        help="Number of columns of the table", default=20)
+    parser.add_argument("-s", "--selected", type=int,
+                        help="Number of columns selected", default=20)
+    parser.add_argument("-c", "--count", type=int,
+                        help="Number of rows", default=100000)
+    parser.add_argument("-r", "--repeat", type=int,
+                        help="Number of repetitions", default=5)
+    args = parser.parse_args()
+
+    run_benchmark(args.width, args.selected, args.count, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
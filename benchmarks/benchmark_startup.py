@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+"""
+    Benchmark of the startup latency of a PostgreSQL backend using bigquery_fdw
+
+    Each measure runs in a new Python process, like a new PostgreSQL backend:
+     - Import of the FDW module, which defers the import of `google.cloud.bigquery`
+     - Import of `google.cloud.bigquery`, the cost previously paid by every backend
+     - Time to get a BigQuery client ready for the first query, without and with a warm-up
+
+    Usage: `python3 -m benchmarks.benchmark_startup` (requires Multicorn)
+    The client measures require BigQuery credentials (`GOOGLE_APPLICATION_CREDENTIALS`)
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+# Code run in a new process, printing a duration in seconds
+IMPORT_FDW = '''
+import time
+start = time.perf_counter()
+import src.fdw
+print(time.perf_counter() - start)
+'''
+
+IMPORT_BIGQUERY = '''
+import time
+start = time.perf_counter()
+from google.cloud import bigquery
+print(time.perf_counter() - start)
+'''
+
+# First query without warm-up: client creation, credentials and HTTP session on first request
+COLD_CLIENT = '''
+import time
+start = time.perf_counter()
+from src.bqclient import BqClient
+bq = BqClient()
+bq.project = %(project)r
+bq.setClient()
+bq.client.get_service_account_email()
+print(time.perf_counter() - start)
+'''
+
+# First query after a warm-up at session start: the client is taken from the pool
+WARM_CLIENT = '''
+import time
+from src.bqclient import BqClient, warmUp
+warmUp(%(project)r)
+start = time.perf_counter()
+bq = BqClient()
+bq.project = %(project)r
+bq.setClient()
+bq.client.get_service_account_email()
+print(time.perf_counter() - start)
+'''
+
+
+def measure(code, repeat):
+    """
+        Returns the median duration (in seconds) printed by `code` run `repeat` times in new processes
+    """
+
+    durations = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code],
+                                capture_output=True, text=True, check=True).stdout
+        durations.append(float(output.strip().splitlines()[-1]))
+
+    return statistics.median(durations)
+
+
+def run_benchmark(project, repeat):
+    """
+        Print the median duration of each startup step
+    """
+
+    for name, code in [
+        ('Import FDW module', IMPORT_FDW),
+        ('Import google.cloud.bigquery', IMPORT_BIGQUERY),
+        ('Client ready for the first query, cold', COLD_CLIENT % {'project': project}),
+        ('Client ready for the first query, warmed up', WARM_CLIENT % {'project': project}),
+    ]:
+        try:
+            print(" * %s: %.1f ms" % (name, measure(code, repeat) * 1000))
+        except subprocess.CalledProcessError as e:
+            print(" * %s: failed (%s)" % (name, e.stderr.strip().splitlines()[-1]))
+
+
+def main():
+
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--project", type=str,
+                        help="BigQuery project of the client", default=None)
+    parser.add_argument("-r", "--repeat", type=int,
+                        help="Number of repetitions", default=5)
+    args = parser.parse_args()
+
+    run_benchmark(args.project, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,13 @@ setup(
         # 'grpcio==1.60.1',  # Forcing version for google-cloud-bigquery
         # 'grpcio-status==1.60.1',  # Forcing version for google-cloud-bigquery
     ],
+    extras_require={
+        # BigQuery Storage Read API support (`fdw_storage_api` option)
+        'storage': [
+            'google-cloud-bigquery-storage',
+            'pyarrow',
+        ],
+    },
     entry_points={
         'console_scripts': [
             # 'bigquery_fdw = bigquery_fdw.fdw:main',
@@ -6,28 +6,95 @@
 """
 
 import datetime
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from google.cloud import bigquery
-from google import auth
+from .tokencache import TokenCache
+
+# `google.cloud.bigquery` is imported on first use: importing it takes hundreds of milliseconds
+#    and PostgreSQL backends load this module before knowing if a query is sent to BigQuery
+
+
+# Process-wide pool of BigQuery clients shared by every foreign table:
+#    `{(project, credentials file, location): bigquery.Client}`
+# Sharing clients avoids repeated credentials discovery and reuses keep-alive HTTP sessions
+clientPool = {}
+storageClientPool = {}
+clientPoolStats = {'hits': 0, 'creations': 0}
+clientPoolLock = threading.Lock()
+
+# Process-wide cache of table metadata: `{(project, table_id): (expiration, bigquery.Table)}`
+tableCache = {}
+tableCacheLock = threading.Lock()
 
 
 class BqClient:
 
     # Set vars
     client = None
+    storageClient = None  # BigQuery Storage Read API client
     queryJob = None
     location = None  # Override dataset location
+    project = None  # Override the project of the credentials
+    credentialsFile = None  # Json key, `GOOGLE_APPLICATION_CREDENTIALS` is used if not set
+    tokenCacheDir = None  # Directory where access tokens are shared by the backends
+    jobTimeout = None  # Number of seconds a query job can run before it is cancelled
+    jobIdPrefix = 'bigquery_fdw_'  # Prefix of the IDs of query jobs
+    retryDeadline = 600  # Number of seconds API calls are retried on transient errors
+    retryInitial = 1.0  # First delay (in seconds) between two attempts, doubled after each attempt
+    retryMaximum = 32.0  # Maximum delay (in seconds) between two attempts
+    hedgeMinSamples = 5  # Number of pages read before hedging requests
 
     def setClient(self):
         """
             Set BigQuery client with a Json key
+
+            Clients are taken from a process-wide pool, a new client is only created
+               for a new combination of project, credentials and location
         """
 
-        try:
-            self.client = bigquery.Client()
-        except auth.exceptions.DefaultCredentialsError as e:
-            raise RuntimeError(
-                'BigQuery client is not instantiated properly: ' + str(e))
+        from google.cloud import bigquery
+        from google import auth
+
+        key = self.getPoolKey()
+
+        with clientPoolLock:
+            client = clientPool.get(key)
+            if client:
+                clientPoolStats['hits'] += 1
+            else:
+                try:
+                    if self.credentialsFile:
+                        client = bigquery.Client.from_service_account_json(
+                            self.credentialsFile, project=self.project, location=self.location)
+                    else:
+                        client = bigquery.Client(
+                            project=self.project, location=self.location)
+                except (auth.exceptions.DefaultCredentialsError, OSError, ValueError) as e:
+                    raise RuntimeError(
+                        'BigQuery client is not instantiated properly: ' + str(e))
+
+                # Share access tokens with the other PostgreSQL backends
+                if self.tokenCacheDir:
+                    tokenCache = TokenCache(self.tokenCacheDir)
+                    tokenCache.attach(client._credentials, tokenCache.getKey(
+                        client._credentials, self.credentialsFile))
+
+                clientPool[key] = client
+                clientPoolStats['creations'] += 1
+
+        self.client = client
+
+    def getPoolKey(self):
+        """
+            Returns the key of the client in the pool of clients
+            Clients sharing their access tokens are not used by tables that do not share them
+        """
+
+        return (self.project, self.credentialsFile or os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'), self.location, self.tokenCacheDir)
 
     def getClient(self):
         """
@@ -36,21 +103,114 @@ class BqClient:
 
         return self.client
 
-    def runQuery(self, query, parameters=[], sqlDialect='standard'):
+    def setStorageClient(self):
+        """
+            Set BigQuery Storage Read API client using the credentials of the BigQuery client
+            Requires the optional packages `google-cloud-bigquery-storage` and `pyarrow`
+        """
+
+        if not self.client:
+            raise RuntimeError(
+                'BigQuery client is not instantiated properly (from `setStorageClient`).')
+
+        try:
+            import pyarrow  # noqa: F401
+            from google.cloud import bigquery_storage
+        except ImportError as e:
+            raise RuntimeError(
+                'BigQuery Storage Read API is not available: ' + str(e))
+
+        key = self.getPoolKey()
+
+        with clientPoolLock:
+            if key not in storageClientPool:
+                storageClientPool[key] = bigquery_storage.BigQueryReadClient(
+                    credentials=self.client._credentials)
+
+            self.storageClient = storageClientPool[key]
+
+    def getStorageClient(self):
+        """
+            Returns `storageClient`, create it if needed
+        """
+
+        if not self.storageClient:
+            self.setStorageClient()
+
+        return self.storageClient
+
+    def getTableMetadata(self, tableId, ttl=300):
+        """
+            Returns the metadata of the table `tableId` (`dataset.table` or `project.dataset.table`)
+
+            Metadata is cached for `ttl` seconds and shared by every instance of the process
+        """
+
+        if not self.client:
+            raise RuntimeError(
+                'BigQuery client is not instantiated properly (from `getTableMetadata`).')
+
+        key = (self.client.project, tableId)
+        now = time.monotonic()
+
+        with tableCacheLock:
+            cached = tableCache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        table = self.client.get_table(tableId)
+
+        with tableCacheLock:
+            tableCache[key] = (now + ttl, table)
+
+        return table
+
+    def listTables(self, dataset):
+        """
+            Returns the IDs of the tables of a dataset
+        """
+
+        if not self.client:
+            raise RuntimeError(
+                'BigQuery client is not instantiated properly (from `listTables`).')
+
+        return [table.table_id for table in self.client.list_tables(dataset)]
+
+    def getTablesMetadata(self, tableIds, ttl=300, threads=16):
+        """
+            Returns the metadata of several tables, fetched in parallel with `threads` threads
+            Metadata is cached like `getTableMetadata`
+        """
+
+        if not tableIds:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(threads, len(tableIds))) as executor:
+            return list(executor.map(lambda tableId: self.getTableMetadata(tableId, ttl), tableIds))
+
+    def runQuery(self, query, parameters=[], sqlDialect='standard', maximumBytesBilled=None):
         """
             Run BigQuery query
+            If `maximumBytesBilled` is set, BigQuery fails the query instead of billing more bytes
+            If `jobTimeout` is set, BigQuery cancels the job when it runs for longer
         """
 
+        from google.cloud import bigquery
+
         if self.client:
-            if parameters:  # Parameterized query
+            if parameters or maximumBytesBilled or self.jobTimeout:  # Parameterized, capped or limited query
                 # Prepare job configuration
                 job_config = bigquery.QueryJobConfig()
                 job_config.query_parameters = parameters
+                job_config.maximum_bytes_billed = maximumBytesBilled
+                if self.jobTimeout:
+                    job_config.job_timeout_ms = self.jobTimeout * 1000
 
                 self.queryJob = self.client.query(
-                    query, job_config=job_config, location=None)
+                    query, job_config=job_config, location=None, job_id_prefix=self.jobIdPrefix, retry=self.getRetry())
             else:  # Non parameterized query
-                self.queryJob = self.client.query(query, location=None)
+                self.queryJob = self.client.query(
+                    query, location=None, job_id_prefix=self.jobIdPrefix, retry=self.getRetry())
 
             # Set SQL dialect
             self.queryJob.UseLegacySQL = False
@@ -63,6 +223,84 @@ class BqClient:
             raise RuntimeError(
                 'BigQuery client is not instantiated properly (from `runQuery`).')
 
+    def getRetry(self):
+        """
+            Returns the retry policy of API calls
+            Transient errors (5xx, rate limits) are retried with an exponential backoff with jitter,
+               for at most `retryDeadline` seconds
+
+            A query job is submitted with a job ID generated once: if the submission is retried after
+               the job was created, the existing job is used instead of running the query twice
+        """
+
+        from google.cloud import bigquery
+
+        return bigquery.DEFAULT_RETRY.with_delay(
+            initial=self.retryInitial, maximum=self.retryMaximum, multiplier=2.0).with_deadline(self.retryDeadline)
+
+    def attachQuery(self, jobId, location=None):
+        """
+            Set the query job `jobId`, run by another client, as the current job
+            Returns `False` if the job cannot be read
+        """
+
+        if not self.client:
+            raise RuntimeError(
+                'BigQuery client is not instantiated properly (from `attachQuery`).')
+
+        try:
+            self.queryJob = self.client.get_job(
+                jobId, location=location, retry=self.getRetry())
+        except Exception:
+            return False
+
+        return True
+
+    def dryRun(self, query, parameters=[]):
+        """
+            Returns the number of bytes the query would process, without running it
+        """
+
+        from google.cloud import bigquery
+
+        if self.client:
+            job_config = bigquery.QueryJobConfig(
+                dry_run=True, use_query_cache=False)
+            job_config.query_parameters = parameters
+
+            return self.client.query(query, job_config=job_config, location=None).total_bytes_processed or 0
+        else:
+            raise RuntimeError(
+                'BigQuery client is not instantiated properly (from `dryRun`).')
+
+    def waitResult(self, **kwargs):
+        """
+            Wait for the result of the query job, for at most `jobTimeout` seconds
+            The job is not cancelled if the result cannot be read: it may be shared with other backends,
+               the caller decides with `cancelQuery()`
+        """
+
+        return self.queryJob.result(timeout=self.jobTimeout, retry=self.getRetry(), **kwargs)
+
+    def cancelQuery(self, job=None):
+        """
+            Cancel a query job (the current job by default) if it is still running
+            Returns `True` if the cancellation was requested
+        """
+
+        job = job or self.queryJob
+        if not job:
+            return False
+
+        try:
+            if job.done(reload=False):
+                return False
+
+            return job.cancel()
+        except Exception:
+            # The job ends by itself or with its timeout
+            return False
+
     def getQueryJob(self):
         """
             Returns `queryJob`
@@ -70,25 +308,248 @@ class BqClient:
 
         return self.queryJob
 
-    def readResult(self):
+    def readResult(self, pageSize=None, prefetch=0):
+        """
+            Returns an iterator over the query result
+
+            Rows are fetched one page at a time: only the page being read is held in memory
+            `pageSize` sets the maximum number of rows per page (BigQuery's default is used if `None`)
+            If `prefetch` is set, up to `prefetch` pages are fetched ahead in a background thread
+        """
+
+        if self.queryJob:
+            result = self.waitResult(page_size=pageSize)
+            if prefetch:
+                return self.prefetchPages(result.pages, prefetch)
+
+            return self.streamPages(result.pages)
+        else:
+            raise RuntimeError('No query is pending a result.')
+
+    def readArrowResult(self):
         """
-            Returns query result
+            Returns an iterator over the query result read with the BigQuery Storage Read API
+
+            The destination table of the query is downloaded as Arrow record batches,
+            which avoids the JSON decoding of the REST API on large results
         """
 
         if self.queryJob:
-            result = self.queryJob.result()
-            return list(result)
+            storageClient = self.getStorageClient()
+            result = self.waitResult()
+            batches = result.to_arrow_iterable(bqstorage_client=storageClient)
+            return self.streamRecordBatches(batches)
         else:
             raise RuntimeError('No query is pending a result.')
 
+    def streamRecordBatches(self, batches):
+        """
+            Yield the rows of an iterator of Arrow record batches as tuples of values
+        """
+
+        for batch in batches:
+            for row in zip(*[column.to_pylist() for column in batch.columns]):
+                yield row
+
+    def readParallelResult(self, streams, pageSize=None, ordered=True, queueSize=2):
+        """
+            Returns an iterator over the query result downloaded by `streams` parallel readers
+
+            The destination table of the query is split in `streams` ranges of rows read
+               on a thread pool with `start_index`
+            Each reader buffers at most `queueSize` pages ahead of the consumer
+            If `ordered` is `False`, rows are returned in the order pages are received
+        """
+
+        if self.queryJob:
+            result = self.waitResult(page_size=pageSize)
+            totalRows = result.total_rows or 0
+            destination = self.queryJob.destination
+
+            # Not worth splitting: read the result sequentially
+            if streams < 2 or not destination or totalRows < streams:
+                return self.streamPages(result.pages)
+
+            # Split the result in contiguous ranges of rows
+            size = -(-totalRows // streams)
+            ranges = [(start, min(size, totalRows - start))
+                      for start in range(0, totalRows, size)]
+
+            return self.streamRanges(destination, result.schema, ranges, pageSize, ordered, queueSize)
+        else:
+            raise RuntimeError('No query is pending a result.')
+
+    def streamRanges(self, destination, schema, ranges, pageSize, ordered, queueSize):
+        """
+            Yield the rows of a list of ranges `(start_index, max_results)` read in parallel
+        """
+
+        stop = threading.Event()
+
+        # One queue per range to keep the order, otherwise a single shared queue
+        if ordered:
+            queues = [queue.Queue(queueSize) for _ in ranges]
+        else:
+            queues = [queue.Queue(queueSize * len(ranges))] * len(ranges)
+
+        executor = ThreadPoolExecutor(max_workers=len(ranges))
+        try:
+            for queue_, (start, count) in zip(queues, ranges):
+                executor.submit(self.readRange, queue_, stop,
+                                destination, schema, start, count, pageSize)
+
+            if ordered:
+                for queue_ in queues:
+                    for row in drainQueue(queue_, 1):
+                        yield row
+            else:
+                for row in drainQueue(queues[0], len(ranges)):
+                    yield row
+        finally:
+            # Release readers if the scan ends early
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def readRange(self, queue_, stop, destination, schema, start, count, pageSize):
+        """
+            Read a range of rows of `destination` and put each page in `queue_`
+            A final `None` marks the end of the range, errors are forwarded to the consumer
+        """
+
+        try:
+            rows = self.client.list_rows(destination, selected_fields=schema, start_index=start,
+                                         max_results=count, page_size=pageSize, retry=self.getRetry())
+        except Exception as e:
+            putOrStop(queue_, e, stop)
+            return
+
+        self.fetchPages(rows.pages, queue_, stop)
+
+    def readHedgedResult(self, pageSize, percentile):
+        """
+            Returns an iterator over the query result read one page at a time with hedged requests
+
+            Pages of `pageSize` rows are read by offset, so the same page can be requested twice:
+               when a page takes longer than the `percentile` of the latencies of the previous pages,
+               a duplicate request is sent and the first response is used
+        """
+
+        if self.queryJob:
+            result = self.waitResult(page_size=pageSize)
+            totalRows = result.total_rows or 0
+            destination = self.queryJob.destination
+
+            # Pages cannot be read by offset: read the result sequentially
+            if not destination or not totalRows:
+                return self.streamPages(result.pages)
+
+            return self.streamHedgedPages(destination, result.schema, totalRows, pageSize, percentile)
+        else:
+            raise RuntimeError('No query is pending a result.')
+
+    def streamHedgedPages(self, destination, schema, totalRows, pageSize, percentile):
+        """
+            Yield the rows of `destination` read one page at a time, with a duplicate request for slow pages
+        """
+
+        latencies = []
+        executor = ThreadPoolExecutor(max_workers=4)
+        try:
+            for start in range(0, totalRows, pageSize):
+                count = min(pageSize, totalRows - start)
+                began = time.monotonic()
+
+                requests = [executor.submit(
+                    self.readPage, destination, schema, start, count)]
+
+                # Hedge the request if the page is slower than usual
+                threshold = getPercentile(
+                    latencies, percentile, self.hedgeMinSamples)
+                if threshold is not None and not wait(requests, timeout=threshold)[0]:
+                    requests.append(executor.submit(
+                        self.readPage, destination, schema, start, count))
+
+                page = firstResult(requests)
+
+                latencies.append(time.monotonic() - began)
+                del latencies[:-100]  # Recent pages only
+
+                for row in page:
+                    yield row
+        finally:
+            # Slow requests are not waited for
+            executor.shutdown(wait=False)
+
+    def readPage(self, destination, schema, start, count):
+        """
+            Returns the rows of a page of `destination` starting at the row `start`
+        """
+
+        return list(self.client.list_rows(destination, selected_fields=schema, start_index=start,
+                                          max_results=count, page_size=count, retry=self.getRetry()))
+
+    def prefetchPages(self, pages, depth):
+        """
+            Yield the rows of an iterator of result pages
+            A background thread fetches up to `depth` pages ahead while the current page is consumed
+        """
+
+        stop = threading.Event()
+        queue_ = queue.Queue(depth)
+
+        worker = threading.Thread(
+            target=self.fetchPages, args=(pages, queue_, stop), daemon=True)
+        worker.start()
+
+        try:
+            for row in drainQueue(queue_, 1):
+                yield row
+        finally:
+            # Release the worker if the scan ends early
+            stop.set()
+
+    def fetchPages(self, pages, queue_, stop):
+        """
+            Put each page of `pages` in `queue_` until the event `stop` is set
+            A final `None` marks the end of the pages, errors are forwarded to the consumer
+        """
+
+        try:
+            for page in pages:
+                if not putOrStop(queue_, list(page), stop):
+                    return
+        except Exception as e:
+            putOrStop(queue_, e, stop)
+            return
+
+        putOrStop(queue_, None, stop)
+
+    def streamPages(self, pages):
+        """
+            Yield the rows of an iterator of result pages
+            The next page is requested only when the current one is consumed
+        """
+
+        for page in pages:
+            for row in page:
+                yield row
+
     def setParameter(self, type_, value):
         """
             Prepare a parameter for a parameterized query
             As documented by Google, only standard SQL syntax supports parameters in queries
 
+            A list of values is sent as an array parameter (for example `column IN UNNEST(?)`)
+
             See https://github.com/GoogleCloudPlatform/python-docs-samples/blob/master/bigquery/cloud-client/query_params.py
         """
 
+        from google.cloud import bigquery
+
+        if isinstance(value, (list, tuple)):
+            return bigquery.ArrayQueryParameter(
+                None, type_, [self.varToString(v) for v in value])
+
         return bigquery.ScalarQueryParameter(
             # Set the name to None to use positional parameters (? symbol
             # in the query).  Note that you cannot mix named and positional
@@ -112,3 +573,104 @@ class BqClient:
             return var.strftime('%Y-%m-%d %H:%M:%S')
 
         return str(var)
+
+
+def warmUp(project=None, credentialsFile=None, location=None, tokenCacheDir=None):
+    """
+        Prepare the pooled BigQuery client of a backend before its first query:
+           import the client library, resolve the credentials, fetch an access token and build the HTTP session
+        Options are the same as `fdw_project`, `fdw_key`, `fdw_location` and `fdw_token_cache_dir`
+           so the foreign tables use this client
+        Returns the number of seconds spent
+    """
+
+    start = time.monotonic()
+
+    bq = BqClient()
+    bq.project = project
+    bq.credentialsFile = credentialsFile
+    bq.location = location
+    bq.tokenCacheDir = tokenCacheDir
+    bq.setClient()
+
+    try:
+        # A cheap API call fetches an access token and opens the HTTP session of the client
+        bq.client.get_service_account_email(retry=bq.getRetry())
+    except Exception as e:
+        raise RuntimeError('BigQuery client cannot be warmed up: ' + str(e))
+
+    return time.monotonic() - start
+
+
+def putOrStop(queue_, item, stop):
+    """
+        Put `item` in `queue_`, waiting for a free slot until the event `stop` is set
+        Returns `False` if the consumer stopped
+    """
+
+    while not stop.is_set():
+        try:
+            queue_.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def drainQueue(queue_, producers):
+    """
+        Yield the rows of the pages put in `queue_` until `producers` readers are done
+        Errors raised by a reader are raised again in the consumer
+    """
+
+    while producers:
+        item = queue_.get()
+        if item is None:  # A reader is done
+            producers -= 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            for row in item:
+                yield row
+
+
+def getPercentile(values, percentile, minSamples=1):
+    """
+        Returns the `percentile` of a list of values, or `None` if there are fewer than `minSamples` values
+    """
+
+    if len(values) < minSamples or not values:
+        return None
+
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * percentile / 100), len(ordered) - 1)]
+
+
+def firstResult(futures):
+    """
+        Returns the result of the first future that succeeds
+        The error of the last future is raised if they all fail
+    """
+
+    pending = set(futures)
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+
+        if not pending:
+            return done.pop().result()
+
+
+def getClientPoolStats():
+    """
+        Returns statistics of the pool of BigQuery clients
+    """
+
+    with clientPoolLock:
+        stats = dict(clientPoolStats)
+        stats['size'] = len(clientPool)
+
+    return stats
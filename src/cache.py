@@ -0,0 +1,212 @@
+"""
+    Cache of query results shared by every foreign table of the PostgreSQL backend
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+
+    # Set vars
+    maxBytes = 64 * 1024 * 1024  # Memory budget
+    spillDir = None  # Directory where entries evicted from memory are saved
+
+    def __init__(self):
+        """
+            Initialize an empty cache
+        """
+
+        self.entries = OrderedDict()  # `{key: (expiration, payload)}`, least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def getKey(self, query, parameters, context=()):
+        """
+            Returns the cache key of a query, its parameters and a `context` changing its result
+               (for example the project used to resolve unqualified table names)
+        """
+
+        parameters = [parameter.to_api_repr() for parameter in parameters]
+        serialized = json.dumps([query, parameters, list(context)],
+                                sort_keys=True, default=str)
+
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def getSize(self, row):
+        """
+            Returns an estimate of the size of a row, used to stop buffering results larger than the memory budget
+            The size of the Python objects is larger than their serialized size
+        """
+
+        return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+    def get(self, key):
+        """
+            Returns the cached rows of `key` or `None` if the entry is missing or expired
+        """
+
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                expiration, payload = entry
+                if expiration > now:
+                    self.entries.move_to_end(key)
+                    return pickle.loads(payload)
+
+                self.remove(key)
+
+        return self.readSpill(key, now)
+
+    def set(self, key, rows, ttl):
+        """
+            Save a list of rows for `ttl` seconds
+            Least recently used entries are evicted (or spilled to `spillDir`) to stay under `maxBytes`
+        """
+
+        payload = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        expiration = time.time() + ttl
+
+        # Entries larger than the budget can only be spilled
+        if len(payload) > self.maxBytes:
+            self.spill(key, expiration, payload)
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+            self.entries[key] = (expiration, payload)
+            self.size += len(payload)
+
+            while self.size > self.maxBytes:
+                evictedKey, (evictedExpiration, evictedPayload) = self.entries.popitem(last=False)
+                self.size -= len(evictedPayload)
+                self.spill(evictedKey, evictedExpiration, evictedPayload)
+
+    def remove(self, key):
+        """
+            Remove an entry from memory
+        """
+
+        expiration, payload = self.entries.pop(key)
+        self.size -= len(payload)
+
+    def clear(self):
+        """
+            Remove every entry from memory
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def getSpillPath(self, key):
+        """
+            Returns the path of the file of a spilled entry
+        """
+
+        return os.path.join(self.spillDir, key + '.pickle')
+
+    def spill(self, key, expiration, payload):
+        """
+            Save an entry evicted from memory to `spillDir`, if the option is set
+        """
+
+        if not self.spillDir or expiration <= time.time():
+            return
+
+        try:
+            # Spilled entries are only readable by the `postgres` user
+            os.makedirs(self.spillDir, mode=0o700, exist_ok=True)
+
+            # Write to a temporary file first so concurrent readers never see a partial entry
+            path = self.getSpillPath(key)
+            temporaryPath = path + '.' + str(os.getpid()) + '.tmp'
+            try:
+                os.remove(temporaryPath)
+            except FileNotFoundError:
+                pass
+
+            # Never follow a symbolic link planted in the directory
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0)
+            fd = os.open(temporaryPath, flags, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expiration, payload), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporaryPath, path)
+        except OSError:
+            # The cache is best effort
+            pass
+
+    def readSpill(self, key, now):
+        """
+            Returns the rows of a spilled entry or `None` if the entry is missing or expired
+        """
+
+        if not self.spillDir:
+            return None
+
+        path = self.getSpillPath(key)
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+            with os.fdopen(fd, 'rb') as f:
+                # Unpickling runs code: only files written by this user are read
+                if not self.isTrusted(os.fstat(f.fileno())):
+                    return None
+
+                expiration, payload = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if expiration <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        return pickle.loads(payload)
+
+    def isTrusted(self, stat):
+        """
+            Returns `True` if a spilled file is owned by the current user and cannot be written by other users
+        """
+
+        if not hasattr(os, 'getuid'):  # File owners are not available on Windows
+            return False
+
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+# Process-wide result caches, one per memory budget and spill directory
+resultCaches = {}
+resultCachesLock = threading.Lock()
+
+
+def getResultCache(maxBytes=None, spillDir=None):
+    """
+        Returns the result cache of a memory budget and a spill directory
+        Foreign tables using the same settings share the same cache
+    """
+
+    key = (maxBytes or ResultCache.maxBytes, spillDir)
+
+    with resultCachesLock:
+        if key not in resultCaches:
+            cache = ResultCache()
+            cache.maxBytes, cache.spillDir = key
+            resultCaches[key] = cache
+
+        return resultCaches[key]
+
+
+# Default result cache
+resultCache = getResultCache()
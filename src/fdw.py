@@ -1,9 +1,22 @@
+import datetime
+import os
+import re
+import time
 from collections import OrderedDict, namedtuple
+from operator import itemgetter
 
-from multicorn import ForeignDataWrapper
+from multicorn import ANY, ForeignDataWrapper, TableDefinition, ColumnDefinition
 from multicorn.utils import log_to_postgres, ERROR, WARNING, INFO, DEBUG
 
-from .bqclient import BqClient
+from .bqclient import BqClient, getClientPoolStats
+from .cache import getResultCache, resultCache
+from .singleflight import getSingleFlight
+
+
+# Partitioning of a BigQuery table:
+#    `column` is the partitioning column (`_PARTITIONTIME` for ingestion-time partitioning) and `dataType` its BigQuery data type
+#    `granularity` is `HOUR`, `DAY`, `MONTH` or `YEAR` for time partitioning, `RANGE` for integer-range partitioning
+Partitioning = namedtuple('Partitioning', 'column dataType granularity')
 
 
 class ConstantForeignDataWrapper(ForeignDataWrapper):
@@ -11,9 +24,75 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
     # Default vars
     client = None  # BqClient instance
     partitionPseudoColumn = 'partition_date'  # Name of the partition pseudo column
+    suffixPseudoColumn = 'table_suffix'  # Name of the `_TABLE_SUFFIX` pseudo column of wildcard tables
+    suffixFormat = '%Y%m%d'  # Date format of the suffix of date-sharded tables
     # Pseudo column to fetch `count(*)` when using the remote counting and grouping feature
     countPseudoColumn = '_fdw_count'
     castingRules = None  # Dict of casting rules when using the `fdw_casting` option
+    # Aggregate pseudo columns named `_fdw_<function>_<column>` when using the remote grouping feature
+    aggregatePrefix = '_fdw_'
+    aggregateFunctions = {
+        'sum': 'SUM({})',
+        'min': 'MIN({})',
+        'max': 'MAX({})',
+        'avg': 'AVG({})',
+        'count': 'COUNT({})',
+        'count_distinct': 'COUNT(DISTINCT {})',
+        'approx_distinct': 'APPROX_COUNT_DISTINCT({})',
+    }
+    aggregates = None  # Dict of aggregate pseudo columns when using the `fdw_aggregates` option
+    partitionGranularities = ['HOUR', 'DAY', 'MONTH', 'YEAR']  # Time partitioning types
+    importThreads = 16  # Number of threads fetching table metadata on `IMPORT FOREIGN SCHEMA`
+    project = None  # BigQuery project used to run queries
+    credentialsFile = None  # Json key used to authenticate
+    location = None  # BigQuery location used to run queries
+    tokenCacheDir = None  # Directory where access tokens are shared by the backends
+    limitPushdown = False  # Push LIMIT and OFFSET down to BigQuery when using the `fdw_limit_pushdown` option
+    plannedQuals = []  # Quals received by the planner, used to decide if LIMIT can be pushed down
+    plannedLimit = (None, None)  # LIMIT and OFFSET received by the planner, displayed by `EXPLAIN`
+    plannedSorted = True  # `False` if the planner requested sort keys that are not pushed down
+    pageSize = None  # Number of rows fetched per page when reading results
+    storageApi = False  # Read results with the BigQuery Storage Read API
+    streams = 1  # Number of parallel readers used to download results
+    preserveOrder = False  # Keep the order of rows when using parallel readers
+    prefetch = 0  # Number of result pages fetched ahead in a background thread
+    # List of BigQuery operators supported
+    # Exhaustive list: https://cloud.google.com/bigquery/docs/reference/standard-sql/functions-and-operators#operators
+    # Non listed operators may or may not work
+    operators = ['=', '<', '>', '<=', '>=', '!=', '<>', 'LIKE', 'NOT LIKE']
+    # Mapping between multicorn operators and BigQuery operators
+    operatorsMapping = {
+        '~~': 'LIKE',
+        '!~~': 'NOT LIKE',
+    }
+    cacheTtl = 0  # Number of seconds query results are cached
+    memoize = False  # Keep the results of rescans in memory until the end of the scan
+    memoMaxRows = 10000  # Maximum number of rows of a memoized result
+    memoMaxTotalRows = 100000  # Maximum number of rows of all the memoized results of a scan
+    batchMaxRows = 0  # Maximum number of rows loaded at once to serve repeated lookups of a column
+    batchThreshold = 3  # Number of distinct lookups of a column before loading its rows at once
+    maxBytesBilled = None  # Maximum number of bytes billed per query
+    jobTimeout = None  # Number of seconds a query job can run before it is cancelled
+    retryDeadline = 600  # Number of seconds BigQuery API calls are retried on transient errors
+    hedgePercentile = None  # Percentile of page latencies after which a duplicate page request is sent
+    hedgePageSize = 10000  # Number of rows per page of hedged reads if `fdw_page_size` is not set
+    dryRun = False  # Estimate the number of bytes processed by a query before running it
+    maxEstimates = 1000  # Maximum number of dry run estimates kept in memory
+    maxWidth = 1024 * 1024  # Maximum average row width (in bytes) returned to the planner
+    statsTtl = 300  # Number of seconds table statistics are cached for the planner
+    # Default selectivity of a qual per operator, used to estimate the number of rows
+    # Values are the defaults used by the PostgreSQL planner
+    selectivities = {
+        '=': 0.005,
+        '<': 0.3333,
+        '>': 0.3333,
+        '<=': 0.3333,
+        '>=': 0.3333,
+        '!=': 0.995,
+        '<>': 0.995,
+        '~~': 0.005,
+        '!~~': 0.995,
+    }
 
     def __init__(self, options, columns):
         """
@@ -32,6 +111,18 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
         self.setDatatypes()
         self.setConversionRules()
 
+        # Compile the SQL fragments of the columns
+        self.compileTable()
+
+        # Memoized results of the current scan
+        self.resetMemo()
+
+        # Query jobs of the scans being read
+        self.activeJobs = []
+
+        # Estimated bytes processed by queries: `{query key: (expiration, bytes)}`, least recently used first
+        self.bytesEstimates = OrderedDict()
+
     def setOptions(self, options):
         """
             Set table options at class level
@@ -42,6 +133,9 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
             self.dataset = options['fdw_dataset']
             self.table = options['fdw_table']
             self.convertToTz = options.get('fdw_convert_tz')
+            self.project = options.get('fdw_project')
+            self.credentialsFile = options.get('fdw_key')
+            self.location = options.get('fdw_location')
 
             # Set verbose option
             self.setOptionVerbose(options.get('fdw_verbose'))
@@ -54,6 +148,60 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
 
             # Set casting rules
             self.setOptionCasting(options.get('fdw_casting'))
+
+            # Set date format of the suffix of wildcard tables
+            self.setOptionSuffixFormat(options.get('fdw_table_suffix_format'))
+
+            # Set aggregate pseudo columns
+            self.setOptionAggregates(options.get('fdw_aggregates'))
+
+            # Set page size
+            self.setOptionPageSize(options.get('fdw_page_size'))
+
+            # Set BigQuery Storage Read API option
+            self.setOptionStorageApi(options.get('fdw_storage_api'))
+
+            # Set parallel download options
+            self.setOptionStreams(options.get('fdw_streams'))
+            self.setOptionPreserveOrder(options.get('fdw_preserve_order'))
+
+            # Set LIMIT pushdown option
+            self.setOptionLimitPushdown(options.get('fdw_limit_pushdown'))
+
+            # Set page prefetching option
+            self.setOptionPrefetch(options.get('fdw_prefetch_pages'))
+
+            # Set result cache options
+            self.setOptionCache(options.get('fdw_cache_ttl'), options.get(
+                'fdw_cache_size'), options.get('fdw_cache_dir'))
+
+            # Set the directory of the access tokens shared by the backends
+            self.tokenCacheDir = options.get('fdw_token_cache_dir')
+
+            # Set the directory of the single-flight lock files shared by the backends
+            self.singleFlight = getSingleFlight(
+                options.get('fdw_single_flight_dir') or None)
+
+            # Set rescan memoization options
+            self.setOptionMemoize(options.get('fdw_memoize'))
+            self.batchMaxRows = self.getIntegerOption(
+                options.get('fdw_batch_max_rows'), 'fdw_batch_max_rows', 0)
+
+            # Set cost control options
+            self.maxBytesBilled = self.getIntegerOption(
+                options.get('fdw_max_bytes_billed'), 'fdw_max_bytes_billed')
+            self.setOptionDryRun(options.get('fdw_dry_run'))
+            self.jobTimeout = self.getIntegerOption(
+                options.get('fdw_job_timeout'), 'fdw_job_timeout')
+
+            # Set retry and hedging options
+            self.retryDeadline = self.getIntegerOption(
+                options.get('fdw_retry_deadline'), 'fdw_retry_deadline', 600)
+            self.setOptionHedgePercentile(options.get('fdw_hedge_percentile'))
+
+            # Set table statistics cache duration
+            self.statsTtl = self.getIntegerOption(
+                options.get('fdw_stats_ttl'), 'fdw_stats_ttl', 300)
         except KeyError:
             log_to_postgres(
                 "You must specify these options when creating the FDW: fdw_dataset, fdw_table", ERROR)
@@ -63,10 +211,23 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
             Set data types mapping
         """
 
+        self.datatypes = self.getDatatypes()
+
+        # Mapping of PostgreSQL data types, the first match of the list is used
+        self.datatypesMapping = {}
+        for datatype in reversed(self.datatypes):
+            self.datatypesMapping[datatype.postgres] = datatype
+
+    @staticmethod
+    def getDatatypes():
+        """
+            Returns the list of data types: `(postgres, bq_standard, bq_legacy)`
+        """
+
         # Create a named tuple
         datatype = namedtuple('datatype', 'postgres bq_standard bq_legacy')
 
-        self.datatypes = [
+        return [
             datatype('text', 'STRING', 'STRING'),
             # datatype('bytea', 'BYTES', 'BYTES'), # Not supported, need testing for support
             datatype('bigint', 'INT64', 'INTEGER'),
@@ -105,6 +266,10 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
             conversionRule('STRUCT', ['STRUCT']),
         ]
 
+        # Mapping of allowed conversions per BigQuery data type
+        self.conversionRulesMapping = {
+            rule.bq_standard_from: rule.bq_standard_to for rule in self.conversionRules}
+
     def setOptionSqlDialect(self, standard_sql=None):
         """
             Set a flag for the SQL dialect.
@@ -151,6 +316,9 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
             The string will be converted to a dict
         """
 
+        # Compiled columns depend on casting rules
+        self.columnFragments = {}
+
         if castingRules:
             # Cast string as a dict
             try:
@@ -168,6 +336,185 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
                 log_to_postgres(
                     "fdw_casting conversion failed: `" + str(e) + "`", ERROR)
 
+    def setOptionSuffixFormat(self, suffixFormat):
+        """
+            Set `self.suffixFormat` from the option `fdw_table_suffix_format`
+
+            Conditions on `_TABLE_SUFFIX` compare strings: the format must sort like the dates,
+               its directives must be `%Y`, `%m` and `%d` in this order (for example `%Y%m%d`, `%Y-%m` or `%Y`)
+        """
+
+        self.suffixFormat = '%Y%m%d'
+
+        if not suffixFormat:
+            return
+
+        directives = re.findall('%.', suffixFormat)
+        if not directives or directives != ['%Y', '%m', '%d'][:len(directives)]:
+            log_to_postgres(
+                "fdw_table_suffix_format is ignored: `fdw_table_suffix_format must use the directives %Y, %m and %d in this order.`", WARNING)
+            return
+
+        self.suffixFormat = suffixFormat
+
+    def setOptionAggregates(self, aggregates):
+        """
+            Aggregate pseudo columns are received as a string, for example: '{"revenue": "SUM(price * quantity)"}'
+
+            The string will be converted to a dict
+        """
+
+        # Compiled columns depend on aggregate pseudo columns
+        self.columnFragments = {}
+        self.aggregates = None
+
+        if aggregates:
+            # Cast string as a dict
+            try:
+                import ast
+                self.aggregates = ast.literal_eval(aggregates)
+            except Exception as e:
+                log_to_postgres(
+                    "fdw_aggregates conversion failed: `" + str(e) + "`", ERROR)
+
+            # For security reasons, ensure that the string was correctly casted as a dict of strings
+            try:
+                if type(self.aggregates) is not dict or not all(type(expression) is str for expression in self.aggregates.values()):
+                    raise ValueError('fdw_aggregates format is incorrect.')
+            except Exception as e:
+                self.aggregates = None
+                log_to_postgres(
+                    "fdw_aggregates conversion failed: `" + str(e) + "`", ERROR)
+
+    def setOptionPageSize(self, pageSize):
+        """
+            Set `self.pageSize` from the option `fdw_page_size`
+            If the option is not set or invalid, BigQuery's default page size is used
+        """
+
+        self.pageSize = self.getIntegerOption(pageSize, 'fdw_page_size')
+
+    def setOptionStreams(self, streams):
+        """
+            Set `self.streams`, the number of parallel readers used to download results
+        """
+
+        self.streams = self.getIntegerOption(streams, 'fdw_streams', 1)
+
+    def setOptionPreserveOrder(self, preserveOrder):
+        """
+            Set a flag `self.preserveOrder` as `True` if `preserveOrder` contains the string 'true'
+            Otherwise, set it as `False`
+        """
+
+        if preserveOrder == 'true':
+            self.preserveOrder = True
+            return
+
+        self.preserveOrder = False
+
+    def setOptionLimitPushdown(self, limitPushdown):
+        """
+            Set a flag `self.limitPushdown` as `True` if `limitPushdown` contains the string 'true'
+            Otherwise, set it as `False`
+        """
+
+        if limitPushdown == 'true':
+            self.limitPushdown = True
+            return
+
+        self.limitPushdown = False
+
+    def setOptionPrefetch(self, prefetch):
+        """
+            Set `self.prefetch`, the number of result pages fetched ahead while the current page is consumed
+        """
+
+        self.prefetch = self.getIntegerOption(prefetch, 'fdw_prefetch_pages', 0)
+
+    def setOptionMemoize(self, memoize):
+        """
+            Set a flag `self.memoize` as `True` if `memoize` contains the string 'true'
+            Otherwise, set it as `False`
+        """
+
+        if memoize == 'true':
+            self.memoize = True
+            return
+
+        self.memoize = False
+
+    def setOptionDryRun(self, dryRun):
+        """
+            Set a flag `self.dryRun` as `True` if `dryRun` contains the string 'true'
+            Otherwise, set it as `False`
+        """
+
+        if dryRun == 'true':
+            self.dryRun = True
+            return
+
+        self.dryRun = False
+
+    def setOptionHedgePercentile(self, percentile):
+        """
+            Set `self.hedgePercentile` from the option `fdw_hedge_percentile`, a percentile between 1 and 99
+            Hedged page reads are disabled if the option is not set or invalid
+        """
+
+        self.hedgePercentile = self.getIntegerOption(
+            percentile, 'fdw_hedge_percentile')
+
+        if self.hedgePercentile and self.hedgePercentile > 99:
+            log_to_postgres(
+                "fdw_hedge_percentile is ignored: `fdw_hedge_percentile must be between 1 and 99.`", WARNING)
+            self.hedgePercentile = None
+
+    def setOptionCache(self, ttl, size, directory):
+        """
+            Set the result cache options
+            `self.cacheTtl` is the number of seconds results are cached (the cache is disabled if not set)
+            Tables with the same memory budget and spill directory share the same cache
+        """
+
+        self.cacheTtl = self.getIntegerOption(ttl, 'fdw_cache_ttl', 0)
+        self.resultCache = getResultCache(self.getIntegerOption(
+            size, 'fdw_cache_size'), directory or None)
+
+    @staticmethod
+    def getIntegerOption(value, option, default=None):
+        """
+            Returns the option `value` as a positive integer
+            If the option is not set or invalid, `default` is returned
+        """
+
+        if not value:
+            return default
+
+        try:
+            integer = int(value)
+            if integer <= 0:
+                raise ValueError(option + ' must be a positive integer.')
+
+            return integer
+        except ValueError as e:
+            log_to_postgres(
+                option + " is ignored: `" + str(e) + "`", WARNING)
+
+        return default
+
+    def setOptionStorageApi(self, storageApi):
+        """
+            Set a flag `self.storageApi` as `True` if `storageApi` contains the string 'true'
+            Otherwise, set it as `False`
+        """
+
+        if storageApi == 'true':
+            self.storageApi = True
+            return
+
+        self.storageApi = False
+
     def getClient(self):
         """
             Manage a pool of instances of BqClient
@@ -190,12 +537,20 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
         try:
             # Attempt connection
             bq = BqClient()
+            bq.project = self.project
+            bq.credentialsFile = self.credentialsFile
+            bq.location = self.location
+            bq.tokenCacheDir = self.tokenCacheDir
+            bq.jobTimeout = self.jobTimeout
+            bq.retryDeadline = self.retryDeadline
             bq.setClient()
 
             # Verbose log
             if self.verbose:
                 log_to_postgres(
                     "Connection to BigQuery client with BqClient instance ID " + str(id(bq)), INFO)
+                log_to_postgres(
+                    "BigQuery clients pool: " + str(getClientPoolStats()), INFO)
 
             # Add to pool
             self.client = bq
@@ -205,7 +560,225 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
             log_to_postgres(
                 "Connection to BigQuery client failed", ERROR)
 
-    def execute(self, quals, columns):
+    def get_rel_size(self, quals, columns):
+        """
+            Returns the estimated number of rows and average row width (in bytes) to the planner
+
+            Estimations use the number of rows and bytes of the BigQuery table and the selectivity of the quals
+        """
+
+        # Save quals for `can_limit()`, the sort keys of the statement are checked by `can_sort()`
+        self.plannedQuals = quals
+        self.plannedSorted = True
+
+        try:
+            table = self.getTableMetadata()
+        except Exception as e:
+            log_to_postgres(
+                "Table statistics are not available: `" + str(e) + "`", WARNING)
+            return super(ConstantForeignDataWrapper, self).get_rel_size(quals, columns)
+
+        # Wildcard tables, views and external tables have no statistics: fallback to Multicorn's default estimation
+        if table is None or table.num_rows is None:
+            return super(ConstantForeignDataWrapper, self).get_rel_size(quals, columns)
+
+        numRows = table.num_rows
+        numBytes = table.num_bytes or 0
+        rows = self.estimateRows(numRows, quals)
+
+        # Average width of the selected columns
+        width = 0
+        if numRows:
+            width = numBytes / numRows
+            if columns and table.schema:
+                width = width * min(len(columns), len(table.schema)) / len(table.schema)
+
+        # The cost of a scan is the number of bytes BigQuery processes
+        #    Multicorn has no cost hook and costs a scan as `rows * width`, the width is set accordingly
+        #    The width is capped so a scan of a few rows does not distort the memory estimates of the planner
+        if self.dryRun:
+            try:
+                query, parameters = self.buildQuery(
+                    quals, self.getOrderedColumns(columns))
+                width = self.estimateBytes(query, parameters) / max(rows, 1)
+            except Exception as e:
+                log_to_postgres(
+                    "Dry run is not available: `" + str(e) + "`", WARNING)
+
+        # Verbose log
+        if self.verbose:
+            log_to_postgres("Estimated relation size: " + str(int(rows)) + " rows of " + str(int(width)) + " bytes", INFO)
+
+        return (max(int(rows), 1), max(int(min(width, self.maxWidth)), 1))
+
+    def estimateRows(self, numRows, quals):
+        """
+            Returns the estimated number of rows of a table of `numRows` rows matching the quals
+        """
+
+        # Apply the selectivity of each qual
+        # Ranges (`BETWEEN`) use the default selectivity of an equality, like the PostgreSQL planner
+        between = self.getBetweenQuals(quals)
+        rows = numRows
+        for qual in quals:
+            if qual.field_name in between and qual in between[qual.field_name]:
+                if qual is between[qual.field_name][0]:
+                    rows *= self.selectivities['=']
+            else:
+                rows *= self.getQualSelectivity(qual)
+
+        return rows
+
+    def getQualSelectivity(self, qual):
+        """
+            Returns the estimated fraction of rows matching a qual
+        """
+
+        # List quals: one selectivity per element of the list
+        if qual.is_list_operator:
+            operator, useOr = qual.operator
+            if useOr:
+                return min(self.selectivities.get(operator, 0.3333) * len(qual.value), 1)
+
+            return self.selectivities.get(operator, 0.3333) ** len(qual.value)
+
+        return self.selectivities.get(qual.operator, 0.3333)
+
+    def can_sort(self, sortkeys):
+        """
+            Returns the list of sort keys that can be pushed down to BigQuery with an ORDER BY clause
+
+            BigQuery compares strings byte by byte, which only matches the `C` collation in PostgreSQL
+            Sorting on columns that are casted is not supported
+        """
+
+        sortable = []
+        for sortkey in sortkeys:
+            column = sortkey.attname
+
+            if column not in self.columns or self.isAggregateColumn(column):
+                break
+            if self.castingRules and column in self.castingRules:
+                break
+            if self.getBigQueryDatatype(column) == 'STRING' and sortkey.collate not in ('C', 'POSIX'):
+                break
+
+            sortable.append(sortkey)
+
+        # LIMIT cannot be pushed down if PostgreSQL sorts the rows
+        self.plannedSorted = len(sortable) == len(sortkeys)
+
+        return sortable
+
+    def get_path_keys(self):
+        """
+            Returns the list of columns that are cheap to look up with the expected number of rows per value
+
+            BigQuery prunes partitions and clustered blocks, so the partitioning and clustering columns
+               are advertised to the planner for parameterized scans
+        """
+
+        try:
+            table = self.getTableMetadata()
+        except Exception as e:
+            log_to_postgres(
+                "Table statistics are not available: `" + str(e) + "`", WARNING)
+            return []
+
+        # Wildcard tables have no metadata
+        if table is None:
+            return []
+
+        # Partitioning and clustering columns
+        columns = list(table.clustering_fields or [])
+        if table.time_partitioning:
+            columns.append(
+                table.time_partitioning.field or self.partitionPseudoColumn)
+
+        rows = max(int((table.num_rows or 0) * self.selectivities['=']), 1)
+
+        return [((column,), rows) for column in columns if column in self.columns]
+
+    def can_limit(self, limit, offset):
+        """
+            Returns `True` if LIMIT and OFFSET can be pushed down to BigQuery for the planned quals
+
+            Multicorn only passes the quals it can convert: restrictions such as OR expressions or function calls
+               are evaluated by PostgreSQL without the wrapper knowing about them
+            LIMIT is therefore only pushed down on tables where `fdw_limit_pushdown` declares it safe,
+               and never when some sort keys are not pushed down: the first rows must be selected after sorting
+        """
+
+        # Save LIMIT and OFFSET for `explain()`
+        self.plannedLimit = (limit, offset)
+
+        if not self.limitPushdown:
+            return False
+
+        if not self.plannedSorted:
+            self.plannedLimit = (None, None)
+            return False
+
+        return self.canPushLimit(self.plannedQuals)
+
+    def getPushedLimit(self, quals, limit, offset):
+        """
+            Returns the LIMIT and OFFSET added to the BigQuery query, `(None, None)` if they cannot be pushed down
+        """
+
+        if not self.limitPushdown or not self.canPushLimit(quals):
+            return (None, None)
+
+        return (limit, offset)
+
+    def canPushLimit(self, quals):
+        """
+            Returns `True` if BigQuery returns exactly the rows matching the quals
+
+            Quals that cannot be pushed down are evaluated by PostgreSQL after the LIMIT,
+               as well as quals on columns converted by `fdw_convert_tz` or `fdw_casting`
+        """
+
+        for qual in quals:
+            if not self.isQualPushable(qual):
+                return False
+            if self.castingRules and qual.field_name in self.castingRules:
+                return False
+            if self.convertToTz and qual.field_name in self.columns and self.getBigQueryDatatype(qual.field_name) in ['DATE', 'TIMESTAMP']:
+                return False
+
+        return True
+
+    def isQualPushable(self, qual):
+        """
+            Returns `True` if a qual can be added to the WHERE clause of the BigQuery query
+            Aggregate pseudo columns are computed after the WHERE clause and are filtered by PostgreSQL
+        """
+
+        if self.isAggregateColumn(qual.field_name):
+            return False
+
+        # Suffixes truncated to a month or a year differ from the dates inside their period
+        if qual.field_name == self.suffixPseudoColumn and not self.isSuffixInequalityPushable(qual):
+            return False
+
+        if qual.is_list_operator:
+            operator, useOr = qual.operator
+            if operator == '=' and useOr:  # `= ANY(...)`
+                return True
+            # `<> ALL(...)`, is never true in PostgreSQL if the list contains NULL
+            if operator in ['<>', '!='] and not useOr:
+                return None not in qual.value
+
+            return False
+
+        # `IS NULL` and `IS NOT NULL`
+        if qual.value is None:
+            return qual.operator in ['=', '<>', '!=']
+
+        return qual.operator in self.operators or qual.operator in self.operatorsMapping
+
+    def execute(self, quals, columns, sortkeys=None, limit=None, offset=None):
         """
             Executes a query
         """
@@ -220,23 +793,553 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
         # Returns instance of BqClient
         client = self.getClient()
 
+        # Select columns in the order of the table definition
+        columns = self.getOrderedColumns(columns)
+
+        # LIMIT and OFFSET are only pushed down when it is safe
+        limit, offset = self.getPushedLimit(quals, limit, offset)
+
         # Prepare query
-        query, parameters = self.buildQuery(quals, columns)
+        query, parameters = self.buildQuery(
+            quals, columns, sortkeys, limit, offset)
+
+        # Return memoized result of a rescan
+        if self.memoize:
+            memoKey = resultCache.getKey(query, parameters)
+            lines = self.getMemoizedResult(
+                memoKey, quals, columns, sortkeys, limit, offset)
+            if lines is not None:
+                for line in lines:
+                    yield line
+                return
+
+        # Return cached result
+        if self.cacheTtl:
+            cacheKey = self.getCacheKey(query, parameters)
+            lines = self.resultCache.get(cacheKey)
+            if lines is not None:
+                # Verbose log
+                if self.verbose:
+                    log_to_postgres("Result read from cache", INFO)
+
+                for line in lines:
+                    yield line
+                return
+
+        # Rows are buffered for the result cache as long as they fit in its memory budget,
+        #    and for memoization up to `memoMaxRows` rows
+        lines = []
+        caching = bool(self.cacheTtl)
+        cacheSize = 0
+        memoizing = self.memoize
+
+        # Fail before running a query processing too many bytes
+        if self.dryRun:
+            self.checkQueryCost(query, parameters)
+
+        # Run query, identical queries of other backends share a single job
+        flightKey = self.singleFlight.getKey(resultCache.getKey(
+            query, parameters), self.project, self.credentialsFile, self.location)
+        shared = self.singleFlight.runQuery(
+            client, flightKey, query, parameters, self.dialect, self.maxBytesBilled)
+
+        # Verbose log
+        if self.verbose and shared:
+            log_to_postgres("Result read from the job `" + str(client.getQueryJob().job_id) + "` of another backend", INFO)
 
-        # Run query
-        client.runQuery(query, parameters, self.dialect)
+        # The job is cancelled if the scan is abandoned before the end of the result
+        job = client.getQueryJob()
+        self.activeJobs.append(job)
+        completed = False
 
         # Return query output
-        for row in client.readResult():
-            # Create an ordered dict with the column name and value
-            # Example: `OrderedDict([('column1', 'value1'), ('column2', value2)])`
-            line = OrderedDict()
-            for column in columns:
-                line[column] = row[column]
+        try:
+            limited = limit is not None or offset is not None
+            formatRow = self.getRowFormatter(columns)
+            for row in self.readResult(client, bool(sortkeys), limited):
+                line = formatRow(row)
+
+                if caching:
+                    cacheSize += self.resultCache.getSize(line)
+                    caching = cacheSize <= self.resultCache.maxBytes
+                if memoizing and len(lines) >= self.memoMaxRows:
+                    memoizing = False
+                if caching or memoizing:
+                    lines.append(line)
+                elif lines:  # The result is too large to be cached and memoized
+                    lines = []
+
+                yield line
+
+            completed = True
+        finally:
+            # Jobs of abandoned scans may already be cancelled by `end_scan()`
+            if job in self.activeJobs:
+                self.activeJobs.remove(job)
+                if not completed:
+                    self.cancelJob(job)
+            self.singleFlight.forget(job)
+
+        # Save the complete result in cache
+        if caching:
+            self.resultCache.set(cacheKey, lines, self.cacheTtl)
+        if memoizing:
+            self.setMemoizedResult(memoKey, lines)
+
+    @classmethod
+    def import_schema(cls, schema, srv_options, options, restriction_type, restrictions):
+        """
+            Called by Multicorn on `IMPORT FOREIGN SCHEMA`
+            `schema` is the BigQuery dataset: a foreign table is defined for each of its tables
+            Table metadata is fetched in parallel and cached like the table statistics
+        """
+
+        # Options of the server, overridden by the options of the import
+        importOptions = dict(srv_options)
+        importOptions.update(options)
+
+        # Reverse of the data types mapping, the first match of the list is used
+        datatypes = {}
+        for datatype in cls.getDatatypes():
+            datatypes.setdefault(datatype.bq_standard, datatype.postgres)
+            datatypes.setdefault(datatype.bq_legacy, datatype.postgres)
+
+        try:
+            client = BqClient()
+            client.project = importOptions.get('fdw_project')
+            client.credentialsFile = importOptions.get('fdw_key')
+            client.location = importOptions.get('fdw_location')
+            client.setClient()
+
+            tables = client.listTables(schema)
+            if restriction_type == 'limit':
+                tables = [table for table in tables if table in restrictions]
+            elif restriction_type == 'except':
+                tables = [table for table in tables if table not in restrictions]
+
+            metadata = client.getTablesMetadata(
+                [schema + '.' + table for table in tables],
+                cls.getIntegerOption(importOptions.get('fdw_stats_ttl'), 'fdw_stats_ttl', 300), cls.importThreads)
+        except Exception as e:
+            log_to_postgres(
+                "Import of dataset `" + schema + "` failed: `" + str(e) + "`", ERROR)
+            return []
+
+        definitions = []
+        for table in metadata:
+            columns = []
+            for field in table.schema:
+                # Arrays, structs and data types without equivalent are imported as text
+                type_ = datatypes.get(field.field_type, 'text')
+                if field.mode == 'REPEATED':
+                    type_ = 'text'
+                columns.append(ColumnDefinition(
+                    column_name=field.name, type_name=type_))
+
+            # Pseudo column of ingestion-time partitioned tables
+            if table.time_partitioning and not table.time_partitioning.field:
+                columns.append(ColumnDefinition(
+                    column_name=cls.partitionPseudoColumn, type_name='date'))
+
+            # Options of the import are set on each foreign table
+            definitionOptions = dict(options)
+            definitionOptions['fdw_dataset'] = schema
+            definitionOptions['fdw_table'] = table.table_id
+
+            definitions.append(TableDefinition(
+                table.table_id, columns=columns, options=definitionOptions))
+
+        return definitions
+
+    def explain(self, quals, columns, sortkeys=None, verbose=False):
+        """
+            Called by Multicorn on `EXPLAIN`
+            Returns the BigQuery query, its parameters and the quals pushed down to BigQuery
+            The query is built like in `execute()`, with the LIMIT and OFFSET received by `can_limit()`
+            With `EXPLAIN (VERBOSE)`, the number of bytes processed is estimated with a dry run
+        """
 
-            yield line
+        # Parameters are prepared by the BigQuery client
+        self.getClient()
 
-    def buildQuery(self, quals, columns):
+        limit, offset = self.getPushedLimit(quals, *self.plannedLimit)
+        query, parameters = self.buildQuery(
+            quals, self.getOrderedColumns(columns), sortkeys, limit, offset)
+
+        lines = ['BigQuery query: ' + query]
+        if parameters:
+            lines.append('BigQuery parameters: ' + ', '.join(
+                self.formatParameter(parameter) for parameter in parameters))
+
+        pushedQuals = [qual for qual in quals if self.isQualPushable(qual)]
+        localQuals = [qual for qual in quals if not self.isQualPushable(qual)]
+        if pushedQuals:
+            lines.append('Pushed quals: ' + ', '.join(
+                self.formatQual(qual) for qual in pushedQuals))
+        if localQuals:
+            lines.append('Local quals: ' + ', '.join(
+                self.formatQual(qual) for qual in localQuals))
+
+        if verbose:
+            try:
+                estimate = str(self.estimateBytes(query, parameters))
+            except Exception as e:
+                estimate = 'not available (' + str(e) + ')'
+            lines.append('BigQuery bytes processed (estimate): ' + estimate)
+
+        return lines
+
+    def formatParameter(self, parameter):
+        """
+            Format a query parameter for `EXPLAIN`, for example `INT64 2017` or `ARRAY<STRING> ['TX', 'CA']`
+        """
+
+        if hasattr(parameter, 'array_type'):  # `ArrayQueryParameter`
+            return 'ARRAY<' + parameter.array_type + '> ' + repr(list(parameter.values))
+
+        return parameter.type_ + ' ' + repr(parameter.value)
+
+    def formatQual(self, qual):
+        """
+            Format a qual for `EXPLAIN`, for example `year = 2017` or `state = ANY(['TX', 'CA'])`
+        """
+
+        if qual.is_list_operator:
+            operator, useOr = qual.operator
+            return qual.field_name + ' ' + operator + (' ANY(' if useOr else ' ALL(') + repr(qual.value) + ')'
+
+        if qual.value is None:
+            return qual.field_name + (' IS NULL' if qual.operator == '=' else ' IS NOT NULL')
+
+        return qual.field_name + ' ' + qual.operator + ' ' + repr(qual.value)
+
+    def estimateBytes(self, query, parameters):
+        """
+            Returns the number of bytes processed by the query, estimated with a dry run
+            Estimates are kept for `fdw_stats_ttl` seconds, the least recently used are evicted above `maxEstimates`
+        """
+
+        key = resultCache.getKey(query, parameters)
+        now = time.time()
+
+        estimate = self.bytesEstimates.get(key)
+        if estimate and estimate[0] > now:
+            self.bytesEstimates.move_to_end(key)
+            return estimate[1]
+
+        bytesProcessed = self.getClient().dryRun(query, parameters)
+        self.bytesEstimates[key] = (now + self.statsTtl, bytesProcessed)
+        self.bytesEstimates.move_to_end(key)
+
+        while len(self.bytesEstimates) > self.maxEstimates:
+            self.bytesEstimates.popitem(last=False)
+
+        return bytesProcessed
+
+    def checkQueryCost(self, query, parameters):
+        """
+            Raises an error if the query would process more than `fdw_max_bytes_billed` bytes
+        """
+
+        estimate = self.estimateBytes(query, parameters)
+
+        # Verbose log
+        if self.verbose:
+            log_to_postgres("Query will process " + str(estimate) + " bytes", INFO)
+
+        if self.maxBytesBilled and estimate > self.maxBytesBilled:
+            log_to_postgres("Query would process " + str(estimate) + " bytes, more than fdw_max_bytes_billed (" + str(
+                self.maxBytesBilled) + " bytes). Add a filter on a partitioned or clustered column or raise the limit.", ERROR)
+
+    def end_scan(self):
+        """
+            Called by Multicorn at the end of the scan
+        """
+
+        self.resetMemo()
+        self.cancelJobs()
+
+    def rollback(self):
+        """
+            Called by Multicorn when the transaction aborts
+            The memo of the aborted statement must not be read by the next statement
+        """
+
+        self.resetMemo()
+        self.cancelJobs()
+
+    def sub_rollback(self, level):
+        """
+            Called by Multicorn when a savepoint is rolled back
+        """
+
+        self.resetMemo()
+        self.cancelJobs()
+
+    def cancelJobs(self):
+        """
+            Cancel the query jobs of the scans that are still being read
+        """
+
+        for job in self.activeJobs:
+            self.cancelJob(job)
+
+        self.activeJobs = []
+
+    def cancelJob(self, job):
+        """
+            Cancel a query job, unless other backends read it through single-flight
+        """
+
+        if not self.singleFlight.release(job):
+            # Verbose log
+            if self.verbose:
+                log_to_postgres("BigQuery job `" + str(job.job_id) + "` is read by other backends and is not cancelled", INFO)
+            return
+
+        # Verbose log
+        if self.verbose:
+            log_to_postgres("Cancel BigQuery job `" + str(job.job_id) + "`", INFO)
+
+        self.client.cancelQuery(job)
+
+    def resetMemo(self):
+        """
+            Forget the memoized results of the scan
+        """
+
+        self.memo = OrderedDict()  # `{query key: lines}`, least recently used first
+        self.memoRows = 0  # Number of rows of the memoized results
+        self.lookups = {}  # `{lookup signature: set of looked up values}`
+        self.lookupIndexes = {}  # `{lookup signature: {value: lines}}`
+
+    def getMemoizedResult(self, memoKey, quals, columns, sortkeys, limit, offset):
+        """
+            Returns the lines of a rescan from memory, or `None` if the query has to run
+
+            When a scan is rescanned with different values for the same column (for example
+               the inner side of a nested loop join), the lines matching the other quals are
+               loaded at once and indexed by this column, if they are fewer than `fdw_batch_max_rows`
+        """
+
+        if memoKey in self.memo:
+            self.memo.move_to_end(memoKey)
+            return self.memo[memoKey]
+
+        lookup = self.getLookupSignature(quals, columns, sortkeys, limit, offset)
+        if not lookup:
+            return None
+
+        signature, column, value, otherQuals = lookup
+
+        # Lookup in an index (`None` if the rows are too many to be indexed)
+        if signature in self.lookupIndexes:
+            index = self.lookupIndexes[signature]
+            return index.get(value, []) if index is not None else None
+
+        # Count distinct lookups of the column
+        values = self.lookups.setdefault(signature, set())
+        values.add(value)
+        if len(values) < self.batchThreshold:
+            return None
+
+        index = self.buildLookupIndex(column, otherQuals, columns)
+        self.lookupIndexes[signature] = index
+
+        return index.get(value, []) if index is not None else None
+
+    def setMemoizedResult(self, memoKey, lines):
+        """
+            Keep the lines of a scan in memory for its rescans
+            The least recently used results are evicted when the memoized results exceed `memoMaxTotalRows` rows
+        """
+
+        self.memo[memoKey] = lines
+        self.memoRows += len(lines)
+
+        while self.memoRows > self.memoMaxTotalRows:
+            evicted = self.memo.popitem(last=False)[1]
+            self.memoRows -= len(evicted)
+
+    def getLookupSignature(self, quals, columns, sortkeys, limit, offset):
+        """
+            Returns `(signature, column, value, otherQuals)` for a batched lookup of an equality qual
+               or `None` if the scan cannot be served by a lookup index
+
+            The signature identifies the other quals and the columns so only lookups that
+               differ by the value of the column share an index
+        """
+
+        if not self.batchMaxRows or sortkeys or limit is not None or offset is not None:
+            return None
+
+        for qual in quals:
+            column = qual.field_name
+            if qual.is_list_operator or qual.operator != '=' or qual.value is None or column not in columns:
+                continue
+
+            # Values returned by BigQuery must be equal to the values received from PostgreSQL
+            if column not in self.columns or self.getBigQueryDatatype(column) not in ['STRING', 'INT64', 'BOOL', 'DATE']:
+                continue
+            if (self.castingRules and column in self.castingRules) or self.convertToTz:
+                continue
+
+            otherQuals = [q for q in quals if q is not qual]
+            if not all(self.isQualPushable(q) for q in otherQuals):
+                continue
+
+            signature = (column, tuple(columns), tuple(
+                (q.field_name, repr(q.operator), repr(q.value)) for q in otherQuals))
+
+            return (signature, column, qual.value, otherQuals)
+
+        return None
+
+    def buildLookupIndex(self, column, quals, columns):
+        """
+            Run a single query for the quals other than the lookup column and
+               returns the lines indexed by the value of the column,
+               or `None` if the table is too large
+        """
+
+        try:
+            table = self.getTableMetadata()
+            # The size of wildcard tables, views and external tables is unknown
+            if table is None or table.num_rows is None:
+                return None
+            if self.estimateRows(table.num_rows, quals) > self.batchMaxRows:
+                return None
+        except Exception:
+            return None
+
+        # Verbose log
+        if self.verbose:
+            log_to_postgres(
+                "Load rows for repeated lookups of column `" + column + "`", INFO)
+
+        client = self.getClient()
+        query, parameters = self.buildQuery(quals, columns)
+
+        # Fail before running a query processing too many bytes
+        if self.dryRun:
+            self.checkQueryCost(query, parameters)
+
+        client.runQuery(query, parameters, self.dialect, self.maxBytesBilled)
+
+        # The job is cancelled if the rows cannot be read completely
+        job = client.getQueryJob()
+        self.activeJobs.append(job)
+        completed = False
+
+        try:
+            index = {}
+            formatRow = self.getRowFormatter(columns)
+            position = list(self.columns).index(column)
+            for row in self.readResult(client):
+                line = formatRow(row)
+                index.setdefault(line[position], []).append(line)
+
+            completed = True
+        finally:
+            # The job may already be cancelled by `end_scan()`
+            if job in self.activeJobs:
+                self.activeJobs.remove(job)
+                if not completed:
+                    self.cancelJob(job)
+
+        return index
+
+    def getCacheKey(self, query, parameters):
+        """
+            Returns the key of a query in the result cache, shared by the tables of the backend
+            Unqualified table names are resolved with the project, the credentials and the location of the client
+            Cached lines are in the order of the table columns, so tables with other columns do not share them
+        """
+
+        return self.resultCache.getKey(query, parameters, (self.project, self.credentialsFile or os.environ.get(
+            'GOOGLE_APPLICATION_CREDENTIALS'), self.location, tuple(self.columns)))
+
+    def getOrderedColumns(self, columns):
+        """
+            Returns the list of requested columns in the order of the table definition
+        """
+
+        if not columns:
+            return []
+
+        ordered = [column for column in self.columns if column in columns]
+
+        # Columns unknown to the table definition are added at the end
+        return ordered + [column for column in columns if column not in self.columns]
+
+    def getRowFormatter(self, columns):
+        """
+            Returns a function converting a result row to a tuple of values in the order of the table columns,
+               as expected by Multicorn (`None` for the columns that are not requested)
+
+            Result rows are sequences of values in the order of `columns` (the SELECT clause)
+            The position of each column is resolved once per scan, so no dict is created per row
+        """
+
+        width = len(self.columns)
+        positions = {column: i for i, column in enumerate(columns)}
+        indexes = [positions.get(column) for column in self.columns]
+
+        # All columns are requested in the order of the table definition
+        if indexes == list(range(width)):
+            if width == 1:
+                return lambda row: (row[0],)
+            return itemgetter(*indexes)
+
+        # No column of the table requested
+        requested = [i for i in indexes if i is not None]
+        if not requested:
+            line = (None,) * width
+            return lambda row: line
+
+        # Get the requested values, then place them at the position of their column
+        # Missing columns read the `None` appended at the end of the values
+        getValues = itemgetter(*requested)
+        if len(requested) == 1:
+            def getValues(row, i=requested[0]):
+                return (row[i],)
+
+        missing = len(requested)
+        order = {i: n for n, i in enumerate(requested)}
+        expand = itemgetter(*[order[i] if i is not None else missing for i in indexes])
+
+        return lambda row: expand(getValues(row) + (None,))
+
+    def readResult(self, client, ordered=False, limited=False):
+        """
+            Returns an iterator over the query result
+            The BigQuery Storage Read API is used if the option `fdw_storage_api` is set,
+               otherwise rows are read from the REST API one page at a time,
+               with `fdw_streams` parallel readers, hedged page requests (`fdw_hedge_percentile`)
+               or `fdw_prefetch_pages` pages fetched ahead
+            If `ordered` is `True`, the order of rows is kept
+            If `limited` is `True`, the result is small and read sequentially without prefetching
+        """
+
+        if limited:
+            return client.readResult(self.pageSize)
+
+        if self.storageApi:
+            try:
+                return client.readArrowResult()
+            except RuntimeError as e:
+                log_to_postgres(
+                    "BigQuery Storage Read API cannot be used, falling back to the REST API: `" + str(e) + "`", WARNING)
+
+        if self.streams > 1:
+            return client.readParallelResult(self.streams, self.pageSize, self.preserveOrder or ordered)
+
+        if self.hedgePercentile:
+            return client.readHedgedResult(self.pageSize or self.hedgePageSize, self.hedgePercentile)
+
+        return client.readResult(self.pageSize, self.prefetch)
+
+    def buildQuery(self, quals, columns, sortkeys=None, limit=None, offset=None):
         """
             Builds a BigQuery query
         """
@@ -261,6 +1364,13 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
                 query += ' GROUP BY ' + \
                     self.buildColumnList(columns, 'GROUP_BY')
 
+        # Add order by
+        if sortkeys:
+            query += ' ORDER BY ' + self.buildOrderByClause(sortkeys, columns)
+
+        # Add limit and offset
+        query += self.buildLimitClause(limit, offset)
+
         # Verbose log
         if self.verbose:
             log_to_postgres("Prepared query: `" + query + "`", INFO)
@@ -274,38 +1384,13 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
 
         clause = ''
 
-        # Disable aliases for Group By
-        useAliases = True
-        if usage == 'GROUP_BY':
-            useAliases = False
-
         if columns:  # If we have columns
-            for column in columns:
-                if column == self.countPseudoColumn:  # Pseudo column to count grouped rows
-                    if usage == 'SELECT':
-                        clause += "count(*) " + \
-                            self.addColumnAlias(column, useAliases) + ", "
-                elif column == self.partitionPseudoColumn:  # Partition pseudo column
-                    clause += "_PARTITIONTIME " + \
-                        self.addColumnAlias(column, useAliases) + ", "
-                else:  # Any other column
-                    # Get column data type
-                    dataType = self.getBigQueryDatatype(column)
-
-                    # Save column original name
-                    columnOriginalName = column
-
-                    # If the data type is a date or a timestamp
-                    if dataType in ['DATE', 'TIMESTAMP']:
-                        column = self.setTimeZone(column, dataType)
-
-                    # Data type casting
-                    column = self.castColumn(
-                        column, columnOriginalName, dataType)
-
-                    clause += column + " " + \
-                        self.addColumnAlias(
-                            columnOriginalName, useAliases) + ", "
+            # SELECT and GROUP BY fragments are compiled once per column
+            fragments = [self.getColumnFragments(column)[
+                0 if usage == 'SELECT' else 1] for column in columns]
+
+            clause = ', '.join(
+                fragment for fragment in fragments if fragment is not None)
 
             # Remove final `, `
             clause = clause.strip(', ')
@@ -314,6 +1399,143 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
 
         return clause
 
+    def getColumnFragments(self, column):
+        """
+            Returns the SELECT and GROUP BY fragments of a column
+            Fragments are compiled on first use and kept for the life of the table instance
+        """
+
+        fragments = self.columnFragments.get(column)
+        if fragments is None:
+            fragments = self.compileColumn(column)
+            self.columnFragments[column] = fragments
+
+        return fragments
+
+    def compileColumn(self, column):
+        """
+            Compile the SELECT and GROUP BY fragments of a column (`None` if the column is not grouped)
+            Time zone conversion and casting rules are applied and checked here
+        """
+
+        if column == self.countPseudoColumn:  # Pseudo column to count grouped rows
+            return ("count(*) " + self.addColumnAlias(column), None)
+
+        aggregate = self.getAggregateExpression(column)
+        if aggregate:  # Aggregate pseudo column, not grouped
+            return (aggregate + " " + self.addColumnAlias(column), None)
+        elif column == self.partitionPseudoColumn:  # Partition pseudo column
+            expression = "_PARTITIONTIME"
+        elif column == self.suffixPseudoColumn:  # Table suffix pseudo column of wildcard tables
+            expression = "_TABLE_SUFFIX"
+            if self.getBigQueryDatatype(column) == 'DATE':  # Date-sharded tables, other tables are NULL
+                expression = "SAFE.PARSE_DATE('" + self.suffixFormat + "', _TABLE_SUFFIX)"
+        else:  # Any other column
+            # Get column data type
+            dataType = self.getBigQueryDatatype(column)
+            expression = column
+
+            # If the data type is a date or a timestamp
+            if dataType in ['DATE', 'TIMESTAMP']:
+                expression = self.setTimeZone(expression, dataType)
+
+            # Data type casting
+            expression = self.castColumn(expression, column, dataType)
+
+        return (expression + " " + self.addColumnAlias(column), expression + " " + self.addColumnAlias(column, False))
+
+    def getAggregateExpression(self, column):
+        """
+            Returns the BigQuery aggregate expression of an aggregate pseudo column, or `None`
+            Expressions are resolved once per column and kept for the life of the table instance
+        """
+
+        if column not in self.aggregateExpressions:
+            self.aggregateExpressions[column] = self.resolveAggregateExpression(column)
+
+        return self.aggregateExpressions[column]
+
+    def resolveAggregateExpression(self, column):
+        """
+            Returns the BigQuery aggregate expression of a column, or `None` if it is not an aggregate pseudo column
+            Pseudo columns are declared with the option `fdw_aggregates` or named `_fdw_<function>_<column>`,
+               for example `_fdw_sum_amount` is computed as `SUM(amount)`
+        """
+
+        if self.aggregates and column in self.aggregates:
+            return self.aggregates[column]
+
+        if not column.startswith(self.aggregatePrefix):
+            return None
+
+        # Longest function names first: `_fdw_count_distinct_user` is `COUNT(DISTINCT user)`
+        name = column[len(self.aggregatePrefix):]
+        for function in sorted(self.aggregateFunctions, key=len, reverse=True):
+            if name.startswith(function + '_') and len(name) > len(function) + 1:
+                return self.aggregateFunctions[function].format(name[len(function) + 1:])
+
+        return None
+
+    def isAggregateColumn(self, column):
+        """
+            Returns `True` if the column is computed by an aggregate function in BigQuery
+        """
+
+        return column == self.countPseudoColumn or self.getAggregateExpression(column) is not None
+
+    def compileTable(self):
+        """
+            Compile the fragments of the columns of the table once at table setup
+        """
+
+        # Aggregate pseudo columns are resolved before the fragments that use them
+        self.aggregateExpressions = {column: self.resolveAggregateExpression(column) for column in self.columns}
+
+        self.columnFragments = {}
+        for column in self.columns:
+            self.getColumnFragments(column)
+
+    def buildOrderByClause(self, sortkeys, columns):
+        """
+            Build the ORDER BY clause of the SQL query from Multicorn sort keys
+            NULLS FIRST/LAST is always set since defaults differ between PostgreSQL and BigQuery
+        """
+
+        clause = []
+        for sortkey in sortkeys:
+            column = sortkey.attname
+
+            # Selected columns are sorted by their alias, otherwise pseudo columns are sorted by `_PARTITIONTIME` or `_TABLE_SUFFIX`
+            if (not columns or column not in columns) and column == self.partitionPseudoColumn:
+                column = '_PARTITIONTIME'
+            elif (not columns or column not in columns) and column == self.suffixPseudoColumn:
+                column = '_TABLE_SUFFIX'
+
+            direction = ' DESC' if sortkey.is_reversed else ' ASC'
+            nulls = ' NULLS FIRST' if sortkey.nulls_first else ' NULLS LAST'
+
+            clause.append(column + direction + nulls)
+
+        return ', '.join(clause)
+
+    def buildLimitClause(self, limit, offset):
+        """
+            Build the LIMIT and OFFSET clauses of the SQL query
+            BigQuery requires a LIMIT to use an OFFSET
+        """
+
+        if limit is None and not offset:
+            return ''
+
+        if limit is None:
+            limit = 9223372036854775807  # Max INT64
+
+        clause = ' LIMIT ' + str(int(limit))
+        if offset:
+            clause += ' OFFSET ' + str(int(offset))
+
+        return clause
+
     def setTimeZone(self, column, dataType):
         """
             If the option `fdw_convert_tz` is used, convert the time zone automatically from UTC to the desired time zone
@@ -339,12 +1561,11 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
             castTo = self.castingRules[columnOriginalName]
 
             # Find if we have a matching rule
-            rule = [
-                conversionRule for conversionRule in self.conversionRules if conversionRule.bq_standard_from == dataType.upper()]
+            rule = self.conversionRulesMapping.get(dataType.upper())
 
             if rule:
                 # Check if casting from the original data type to the new one is supported
-                if castTo.upper() in rule[0].bq_standard_to:
+                if castTo.upper() in rule:
                     return 'CAST(' + column + ' as ' + castTo.upper() + ')'
                 else:
                     log_to_postgres("Casting from the data type `" + dataType.upper(
@@ -369,59 +1590,297 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
     def buildWhereClause(self, quals):
         """
             Build the WHERE clause of the SQL query
+            Quals that cannot be pushed down are ignored and evaluated by PostgreSQL
         """
 
-        clause = ''
+        conditions = []
         parameters = []
 
-        # Add WHERE clause
-        # `quals` example: `[Qual('test', '=', 'test 2'), Qual('test', '~~', '3')]`
-        if quals:
-            clause += "WHERE "
-            for qual in quals:
-                if qual.field_name == self.partitionPseudoColumn:
-                    clause += "_PARTITIONTIME " + \
-                        str(self.getOperator(qual.operator)) + " ?"
+        # Partitioning of the table, to emit filters BigQuery can prune partitions on
+        partitioning = self.getPartitioning() if quals else None
 
-                    # Format date as a timestamp
-                    value = qual.value.strftime("%Y-%m-%d 00:00:00")
+        # Pairs of `>=` and `<=` quals on the same column are merged in a `BETWEEN` condition
+        between = self.getBetweenQuals(
+            [qual for qual in quals or [] if not self.isDayRangeQual(qual, partitioning)])
 
-                    # Force data type to `TIMESTAMP`
+        # Add WHERE clause
+        # `quals` example: `[Qual('test', '=', 'test 2'), Qual('test', '~~', '3')]`
+        for qual in quals or []:
+            if not self.isQualPushable(qual):
+                # Verbose log
+                if self.verbose:
+                    log_to_postgres(
+                        "Qual on column `" + str(qual.field_name) + "` is evaluated by PostgreSQL", INFO)
+                continue
+
+            column, type_, value = self.getQualColumn(qual, partitioning)
+
+            if self.isDayRangeQual(qual, partitioning):
+                condition, values = self.getDayRangeCondition(
+                    column, type_, qual, value)
+                conditions.append(condition)
+                parameters.extend(self.setParameter(qual.field_name, parameterType, parameterValue)
+                                  for parameterType, parameterValue in values)
+            elif qual.field_name in between and qual in between[qual.field_name]:
+                lowerQual, upperQual = between[qual.field_name]
+                if qual is lowerQual:
+                    conditions.append(column + " BETWEEN ? AND ?")
                     parameters.append(self.setParameter(
-                        qual.field_name, 'TIMESTAMP', value))
-                else:
-                    clause += str(qual.field_name) + " " + \
-                        str(self.getOperator(qual.operator)) + " ?"
+                        qual.field_name, type_, value))
                     parameters.append(self.setParameter(
-                        qual.field_name, self.getBigQueryDatatype(qual.field_name), qual.value))
+                        qual.field_name, type_, self.getQualColumn(upperQual, partitioning)[2]))
+            elif qual.is_list_operator:
+                conditions.append(column + " " + self.getListOperator(qual) + "(?)")
+                # NULL elements are not supported in BigQuery arrays and never match `IN`
+                parameters.append(self.setParameter(
+                    qual.field_name, type_, [v for v in value if v is not None]))
+            elif qual.value is None:  # `IS NULL` and `IS NOT NULL`
+                conditions.append(
+                    column + (" IS NULL" if qual.operator == '=' else " IS NOT NULL"))
+            else:
+                operator = qual.operator
+                if qual.field_name == self.suffixPseudoColumn:
+                    operator = self.getSuffixOperator(qual)
+                conditions.append(
+                    column + " " + str(self.getOperator(operator)) + " ?")
+                parameters.append(self.setParameter(
+                    qual.field_name, type_, value))
 
-                # Add ` AND `
-                clause += " AND "
+        if not conditions:
+            return ('', parameters)
 
-        # Remove final ` AND `
-        clause = clause.strip(' AND ')
+        return ("WHERE " + " AND ".join(conditions), parameters)
 
-        return (clause, parameters)
+    def getQualColumn(self, qual, partitioning=None):
+        """
+            Returns the BigQuery column, data type and value of a qual
+            Quals on the partitioning column use the BigQuery data type of the column so BigQuery can prune partitions
+        """
 
-    def getOperator(self, operator):
+        if qual.field_name == self.partitionPseudoColumn:
+            if partitioning and partitioning.column == '_PARTITIONTIME':
+                # Daily partitions are filtered by date
+                # Timestamps are compared to `_PARTITIONTIME`: truncating them to a date would change the result
+                values = qual.value if qual.is_list_operator else [qual.value]
+                if partitioning.granularity == 'DAY' and all(type(value) is datetime.date for value in values if value is not None):
+                    return ("_PARTITIONDATE", 'DATE', qual.value)
+
+                # Other granularities are filtered by day ranges
+                return ("_PARTITIONTIME", 'TIMESTAMP', qual.value)
+
+            # Format date as a timestamp and force data type to `TIMESTAMP`
+            return ("_PARTITIONTIME", 'TIMESTAMP', self.formatValues(
+                qual.value, lambda v: v.strftime("%Y-%m-%d 00:00:00")))
+
+        if qual.field_name == self.suffixPseudoColumn:
+            # Dates are formatted as the suffix of date-sharded tables so BigQuery only reads the matching tables
+            return ("_TABLE_SUFFIX", 'STRING', self.formatValues(
+                qual.value, lambda v: v.strftime(self.suffixFormat) if isinstance(v, datetime.date) else v))
+
+        if partitioning and qual.field_name == partitioning.column:
+            return (str(qual.field_name), partitioning.dataType, qual.value)
+
+        return (str(qual.field_name), self.getBigQueryDatatype(qual.field_name), qual.value)
+
+    def getSuffixOperator(self, qual):
         """
-            Validate operator
+            Returns the operator of a qual on the table suffix pseudo column
+            Dates are truncated to the suffix of their shard: `<` and `>` with a date inside the period of a shard
+               become `<=` and `>=` so the shard is read, PostgreSQL filters its rows
+        """
+
+        if qual.operator in ['<', '>'] and not self.isSuffixPeriodStart(qual.value):
+            return qual.operator + '='
+
+        return qual.operator
+
+    def isSuffixInequalityPushable(self, qual):
+        """
+            Returns `False` if a `<>` qual on the table suffix pseudo column would exclude shards with matching rows:
+               with suffixes truncated to a month or a year, or with a date inside the period of a shard
         """
 
-        # List of BigQuery operators supported
-        # Exhaustive list: https://cloud.google.com/bigquery/docs/reference/standard-sql/functions-and-operators#operators
-        # Non listed operators may or may not work
-        operators = ['=', '<', '>', '<=', '>=', '!=', '<>', 'LIKE', 'NOT LIKE']
+        operator = qual.operator[0] if qual.is_list_operator else qual.operator
+        if operator not in ['<>', '!='] or qual.value is None:
+            return True
 
-        # Mapping between multicorn operators and BigQuery operators
-        mapping = {}
-        mapping['~~'] = 'LIKE'
-        mapping['!~~'] = 'NOT LIKE'
+        if '%d' not in self.suffixFormat:
+            return False
 
-        if operator in operators:  # Operator is natively supported
+        values = qual.value if qual.is_list_operator else [qual.value]
+        return all(self.isSuffixPeriodStart(value) for value in values if value is not None)
+
+    def isSuffixPeriodStart(self, value):
+        """
+            Returns `True` if a qual value is the start of the period of its suffix (for example the first day of the month with `%Y%m`)
+            Values that are not dates are compared to the suffix unchanged
+        """
+
+        if not isinstance(value, datetime.date):
+            return True
+
+        start = datetime.datetime.strptime(value.strftime(self.suffixFormat), self.suffixFormat)
+        if isinstance(value, datetime.datetime):
+            return start == value.replace(tzinfo=None)
+
+        return start.date() == value
+
+    def getTableMetadata(self):
+        """
+            Returns the metadata of the BigQuery table, cached for `fdw_stats_ttl` seconds
+            Wildcard tables have no metadata: `None` is returned without calling BigQuery
+        """
+
+        if self.table.endswith('*'):
+            return None
+
+        return self.getClient().getTableMetadata(
+            self.dataset + '.' + self.table, self.statsTtl)
+
+    def getPartitioning(self):
+        """
+            Returns the partitioning of the BigQuery table, or `None` if the table is not partitioned
+            Table metadata is cached for `fdw_stats_ttl` seconds
+        """
+
+        try:
+            table = self.getTableMetadata()
+        except Exception as e:
+            # Verbose log
+            if self.verbose:
+                log_to_postgres(
+                    "Table partitioning is not available: `" + str(e) + "`", INFO)
+            return None
+
+        # Wildcard tables have no metadata
+        if table is None:
+            return None
+
+        timePartitioning = table.time_partitioning
+        rangePartitioning = table.range_partitioning
+
+        if timePartitioning and timePartitioning.type_ in self.partitionGranularities:
+            if not timePartitioning.field:  # Ingestion-time partitioning
+                return Partitioning('_PARTITIONTIME', 'TIMESTAMP', timePartitioning.type_)
+
+            column, granularity = timePartitioning.field, timePartitioning.type_
+        elif rangePartitioning and isinstance(rangePartitioning.field, str):
+            column, granularity = rangePartitioning.field, 'RANGE'
+        else:
+            return None
+
+        # BigQuery data type of the partitioning column
+        for field in table.schema or []:
+            if field.name == column:
+                return Partitioning(column, field.field_type, granularity)
+
+        return None
+
+    def isDayRangeQual(self, qual, partitioning):
+        """
+            Returns `True` if the qual compares a timestamp partitioning column to dates
+
+            A date matches all the partitions of the day: the qual is filtered with a range of timestamps
+               (for example hourly partitions, or a `date` foreign column on a `TIMESTAMP` column)
+        """
+
+        if not partitioning or partitioning.dataType not in ['TIMESTAMP', 'DATETIME']:
+            return False
+
+        if qual.field_name == self.partitionPseudoColumn:
+            if partitioning.column != '_PARTITIONTIME' or partitioning.granularity == 'DAY':
+                return False
+        elif qual.field_name != partitioning.column:
+            return False
+
+        values = qual.value if qual.is_list_operator else [qual.value]
+        return any(type(value) is datetime.date for value in values)
+
+    def getDayRangeCondition(self, column, type_, qual, value):
+        """
+            Returns a condition on `column` matching the days of a qual and the list of its parameters `(type, value)`
+            Comparisons are rewritten on the bare column so BigQuery can prune partitions:
+               `= day` becomes `column >= day AND column < next day`, `<= day` becomes `column < next day`...
+            Other operators compare the date of the column
+        """
+
+        def startOfDay(day, days=0):
+            return datetime.datetime.combine(day + datetime.timedelta(days=days), datetime.time())
+
+        if qual.is_list_operator or qual.operator not in ['=', '<', '<=', '>', '>=', '<>', '!=']:
+            dates = [v for v in value if v is not None] if qual.is_list_operator else value
+            operator = self.getListOperator(qual) + "(?)" if qual.is_list_operator else str(
+                self.getOperator(qual.operator)) + " ?"
+            return ("DATE(" + column + ") " + operator, [('DATE', dates)])
+
+        if qual.operator == '=':
+            return ("(" + column + " >= ? AND " + column + " < ?)", [(type_, startOfDay(value)), (type_, startOfDay(value, 1))])
+        elif qual.operator in ['<>', '!=']:
+            return ("(" + column + " < ? OR " + column + " >= ?)", [(type_, startOfDay(value)), (type_, startOfDay(value, 1))])
+        elif qual.operator == '<':
+            return (column + " < ?", [(type_, startOfDay(value))])
+        elif qual.operator == '<=':
+            return (column + " < ?", [(type_, startOfDay(value, 1))])
+        elif qual.operator == '>':
+            return (column + " >= ?", [(type_, startOfDay(value, 1))])
+
+        return (column + " >= ?", [(type_, startOfDay(value))])
+
+    def getBetweenQuals(self, quals):
+        """
+            Returns a dict `{column: (lowerQual, upperQual)}` of the `>=` and `<=` quals on the same column
+               that can be merged in a `BETWEEN` condition
+        """
+
+        lower = {}
+        upper = {}
+        for qual in quals:
+            if qual.is_list_operator or qual.value is None:
+                continue
+
+            if qual.operator == '>=':
+                lower.setdefault(qual.field_name, qual)
+            elif qual.operator == '<=':
+                upper.setdefault(qual.field_name, qual)
+
+        return {column: (lower[column], upper[column]) for column in lower if column in upper}
+
+    def formatValues(self, value, format_):
+        """
+            Apply `format_` to a qual value or to each element of a list of values
+        """
+
+        if isinstance(value, (list, tuple)):
+            return [format_(v) if v is not None else None for v in value]
+
+        # `IS NULL` and `IS NOT NULL` quals have no value to format
+        if value is None:
+            return None
+
+        return format_(value)
+
+    def getListOperator(self, qual):
+        """
+            Returns the BigQuery operator of a list qual:
+               `column = ANY(array)` and `column IN (...)` become `column IN UNNEST(?)`
+               `column <> ALL(array)` and `column NOT IN (...)` become `column NOT IN UNNEST(?)`
+        """
+
+        # `list_any_or_all` is one of the `ANY` and `ALL` sentinel objects, both are truthy
+        if qual.list_any_or_all is ANY:
+            return 'IN UNNEST'
+
+        return 'NOT IN UNNEST'
+
+    def getOperator(self, operator):
+        """
+            Validate operator
+        """
+
+        if operator in self.operators:  # Operator is natively supported
             return operator
-        elif operator in mapping:  # Multicorn operator has a BigQuery equivalent
-            return mapping[operator]
+        elif operator in self.operatorsMapping:  # Multicorn operator has a BigQuery equivalent
+            return self.operatorsMapping[operator]
         else:  # Operator is not supported
             log_to_postgres(
                 "Operator `" + operator + "` is not currently supported", ERROR)
@@ -437,13 +1896,13 @@ class ConstantForeignDataWrapper(ForeignDataWrapper):
         # Example: `timestamp without time zone`
         pgDatatype = self.columns[column].base_type_name
 
-        for datatype in self.datatypes:  # For each known data types
-            if datatype.postgres == pgDatatype:  # If the PostgreSQL data type matches the known data type
-                # Returns equivalent BigQuery data type
-                if dialect == 'legacy':
-                    return datatype.bq_legacy
-                else:
-                    return datatype.bq_standard
+        datatype = self.datatypesMapping.get(pgDatatype)
+        if datatype:  # If the PostgreSQL data type matches a known data type
+            # Returns equivalent BigQuery data type
+            if dialect == 'legacy':
+                return datatype.bq_legacy
+            else:
+                return datatype.bq_standard
 
         # Return a default data type in an attempt to save the day
         return 'STRING'
@@ -0,0 +1,325 @@
+"""
+    Single-flight coordination of identical queries run at the same time by several PostgreSQL backends
+
+    The first backend runs the query job, the other backends read the results of the same job
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # File locks are not available on Windows
+    fcntl = None
+
+
+class SingleFlight:
+
+    # Set vars
+    window = 60  # Number of seconds the result of a finished job is shared
+    maxAge = 6 * 3600  # Number of seconds a job is kept in the lock files
+    claimTimeout = 10  # Number of seconds other backends wait for the job of a backend submitting a query
+    pollInterval = 0.1  # Number of seconds between two reads of a pending job
+
+    def __init__(self, directory=None):
+        """
+            Initialize the coordination through the lock files of `directory`, single-flight is disabled if not set
+        """
+
+        self.directory = directory
+        self.leading = {}  # `{job ID: key}` of the jobs submitted by this process
+        self.following = {}  # `{job ID: key}` of the jobs of other backends read by this process
+
+    def getKey(self, queryKey, project=None, credentialsFile=None, location=None):
+        """
+            Returns the key of a query (see `ResultCache.getKey()`) run with the client options
+            Only backends using the same credentials share jobs
+        """
+
+        serialized = json.dumps([queryKey, project, credentialsFile or os.environ.get(
+            'GOOGLE_APPLICATION_CREDENTIALS'), location])
+
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def getPath(self, key):
+        """
+            Returns the path of the lock file of `key`
+            Keys are spread over 256 files to bound the number of files
+        """
+
+        return os.path.join(self.directory, 'flight_' + key[:2] + '.json')
+
+    def runQuery(self, client, key, *args):
+        """
+            Run a query with `client.runQuery(*args)`, or attach `client` to the job of the same query
+               run by another backend
+            Returns `True` if the job of another backend is used
+
+            Lock files are only locked to read or publish a job ID, never during BigQuery API calls:
+               a backend claims the query, submits the job and publishes its ID,
+               the other backends wait for the ID for at most `claimTimeout` seconds
+        """
+
+        if not self.directory or fcntl is None:
+            client.runQuery(*args)
+            return False
+
+        try:
+            stale = None
+            while True:
+                flight = self.transaction(
+                    key, lambda flights: self.claim(flights, key, stale))
+                if flight is None:  # This backend submits the job
+                    break
+
+                if flight.get('jobId'):
+                    if self.follow(client, key, flight):
+                        return True
+                    stale = flight['jobId']
+                else:  # Another backend is submitting the job
+                    time.sleep(self.pollInterval)
+        except OSError:
+            # Untrusted or inaccessible lock files: the query is run without coordination
+            client.runQuery(*args)
+            return False
+
+        try:
+            client.runQuery(*args)
+        except BaseException:
+            self.tryTransaction(key, lambda flights: self.unclaim(flights, key))
+            raise
+
+        job = client.getQueryJob()
+        self.leading[job.job_id] = key
+        self.tryTransaction(
+            key, lambda flights: self.publish(flights, key, job))
+
+        return False
+
+    def follow(self, client, key, flight):
+        """
+            Attach `client` to the job of `flight` and register this backend as one of its readers
+            Returns `False` if the job cannot be shared
+        """
+
+        jobId = flight['jobId']
+        if not client.attachQuery(jobId, flight['location']) or not self.isShareable(client.getQueryJob()):
+            return False
+
+        # The backend that submitted the job does not cancel it once it has readers
+        if not self.transaction(key, lambda flights: self.register(flights, key, jobId)):
+            return False
+
+        self.following[jobId] = key
+
+        return True
+
+    def release(self, job):
+        """
+            Stop sharing `job` before it is cancelled
+            Returns `False` if other backends read the job: it must not be cancelled
+        """
+
+        if job.job_id in self.following:
+            self.leave(job)
+            return False
+
+        key = self.leading.pop(job.job_id, None)
+        if key is None or not self.directory or fcntl is None:
+            return True
+
+        try:
+            return self.transaction(key, lambda flights: self.remove(flights, key, job.job_id))
+        except OSError:
+            return True
+
+    def forget(self, job):
+        """
+            Forget a job that is completely read
+        """
+
+        self.leading.pop(job.job_id, None)
+        if job.job_id in self.following:
+            self.leave(job)
+
+    def leave(self, job):
+        """
+            Stop reading the job of another backend: this backend is not one of its readers anymore
+        """
+
+        key = self.following.pop(job.job_id)
+        if self.directory and fcntl is not None:
+            self.tryTransaction(
+                key, lambda flights: self.unregister(flights, key, job.job_id))
+
+    def claim(self, flights, key, stale=None):
+        """
+            Returns the job of `key` in `flights`, or claim the query and returns `None` if there is no job to wait for
+            Claims older than `claimTimeout` and the job `stale` are replaced
+        """
+
+        now = time.time()
+        flight = flights.get(key)
+
+        if flight and flight.get('jobId') and flight['jobId'] != stale:
+            return flight
+        if flight and not flight.get('jobId') and now - flight['submitted'] < self.claimTimeout:
+            return flight
+
+        flights[key] = {'submitted': now}
+        return None
+
+    def unclaim(self, flights, key):
+        """
+            Remove the claim of `key` after the job could not be submitted
+        """
+
+        if key in flights and not flights[key].get('jobId'):
+            del flights[key]
+
+    def publish(self, flights, key, job):
+        """
+            Save the job of `key` so other backends read it
+        """
+
+        flights[key] = {'jobId': job.job_id, 'location': job.location,
+                        'submitted': time.time(), 'readers': 0}
+
+    def register(self, flights, key, jobId):
+        """
+            Count a reader of the job `jobId`
+            Returns `False` if the job is not shared anymore
+        """
+
+        flight = flights.get(key)
+        if not flight or flight.get('jobId') != jobId:
+            return False
+
+        flight['readers'] = flight.get('readers', 0) + 1
+        return True
+
+    def unregister(self, flights, key, jobId):
+        """
+            Remove a reader of the job `jobId`
+        """
+
+        flight = flights.get(key)
+        if flight and flight.get('jobId') == jobId and flight.get('readers'):
+            flight['readers'] -= 1
+
+    def remove(self, flights, key, jobId):
+        """
+            Remove the job `jobId` if no other backend reads it
+            Returns `False` if the job has readers
+        """
+
+        flight = flights.get(key)
+        if not flight or flight.get('jobId') != jobId:
+            return True
+        if flight.get('readers'):
+            return False
+
+        del flights[key]
+        return True
+
+    def isShareable(self, job):
+        """
+            Returns `True` if the results of `job` can be shared: the job is running or finished recently without error
+        """
+
+        if job.error_result:
+            return False
+
+        if job.state != 'DONE':
+            return True
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return bool(job.ended) and (now - job.ended).total_seconds() < self.window
+
+    def transaction(self, key, function):
+        """
+            Returns `function(flights)` called with the jobs of the lock file of `key`, saved after the call
+            The lock file is locked during the call: `function` must not call BigQuery
+
+            Symbolic links are never followed and files owned by other users are not used (`PermissionError`)
+        """
+
+        fd = os.open(self.getPath(key), os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'r+') as file_:
+            if not self.isTrusted(os.fstat(fd)):
+                raise PermissionError(
+                    'Lock file `' + self.getPath(key) + '` is accessible by other users.')
+
+            # The lock is released when the file is closed
+            fcntl.flock(file_, fcntl.LOCK_EX)
+
+            flights = self.read(file_)
+            result = function(flights)
+            self.write(file_, flights)
+
+        return result
+
+    def tryTransaction(self, key, function):
+        """
+            Call `transaction()`, errors are ignored
+        """
+
+        try:
+            self.transaction(key, function)
+        except OSError:
+            pass
+
+    def isTrusted(self, stat):
+        """
+            Returns `True` if a lock file is owned by the current user and only accessible by this user
+        """
+
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+    def read(self, file_):
+        """
+            Returns the jobs saved in `file_`: `{key: {'jobId', 'location', 'submitted', 'readers'}}`
+            Claims of a query being submitted only have a `submitted` time
+        """
+
+        try:
+            file_.seek(0)
+            return json.loads(file_.read())
+        except ValueError:  # Empty or corrupted file
+            return {}
+
+    def write(self, file_, flights):
+        """
+            Save the jobs in `file_`, without the jobs older than `maxAge`
+        """
+
+        now = time.time()
+        flights = {key: flight for key, flight in flights.items()
+                   if now - flight['submitted'] < self.maxAge}
+
+        file_.seek(0)
+        file_.truncate()
+        file_.write(json.dumps(flights))
+        file_.flush()
+
+
+# Process-wide single-flight coordinations, one per directory
+singleFlights = {}
+singleFlightsLock = threading.Lock()
+
+
+def getSingleFlight(directory=None):
+    """
+        Returns the single-flight coordination through the lock files of `directory`
+        Foreign tables using the same directory share the same coordination
+    """
+
+    with singleFlightsLock:
+        if directory not in singleFlights:
+            singleFlights[directory] = SingleFlight(directory)
+
+        return singleFlights[directory]
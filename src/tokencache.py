@@ -0,0 +1,135 @@
+"""
+    Cache of OAuth access tokens shared by every PostgreSQL backend through a local directory
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # File locks are not available on Windows
+    fcntl = None
+
+
+class TokenCache:
+
+    # Set vars
+    directory = None  # Directory of the token files, the cache is disabled if not set
+    margin = 300  # Number of seconds before expiration a cached token is renewed
+
+    def __init__(self, directory=None):
+        """
+            Initialize a cache saving the tokens in `directory`
+        """
+
+        self.directory = directory
+
+    def getKey(self, credentials, credentialsFile=None):
+        """
+            Returns the cache key of `credentials`: the service account (or the key file) and the scopes
+        """
+
+        account = getattr(credentials, 'service_account_email', None) or credentialsFile or os.environ.get(
+            'GOOGLE_APPLICATION_CREDENTIALS') or 'default'
+        scopes = sorted(getattr(credentials, 'scopes', None) or [])
+
+        return account + ' ' + ' '.join(scopes)
+
+    def getPath(self, key):
+        """
+            Returns the path of the token file of `key`
+        """
+
+        return os.path.join(self.directory, 'token_' + hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def attach(self, credentials, key):
+        """
+            Share the access tokens of `credentials` through the cache
+            Returns `False` if the cache is disabled
+
+            `credentials.refresh()` reads a valid token from the cache, or renews it while other processes wait
+        """
+
+        if not self.directory or fcntl is None:
+            return False
+
+        refresh = credentials.refresh
+
+        def sharedRefresh(request):
+            self.refresh(credentials, refresh, request, key)
+
+        credentials.refresh = sharedRefresh
+
+        return True
+
+    def refresh(self, credentials, refresh, request, key):
+        """
+            Set the token of `credentials` from the cache, or renew it with `refresh(request)` and save it
+            The token file is locked: a single process renews a token at a time
+
+            Symbolic links are never followed and files owned by other users are not used:
+               the token is then renewed without the cache
+        """
+
+        fd = os.open(self.getPath(key), os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'r+') as file_:
+            if not self.isTrusted(os.fstat(fd)):
+                refresh(request)
+                return
+
+            # The lock is released when the file is closed
+            fcntl.flock(file_, fcntl.LOCK_EX)
+
+            cached = self.read(file_)
+            if cached:
+                credentials.token, credentials.expiry = cached
+                return
+
+            refresh(request)
+            self.write(file_, credentials)
+
+    def isTrusted(self, stat):
+        """
+            Returns `True` if a token file is owned by the current user and only accessible by this user
+        """
+
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+    def read(self, file_):
+        """
+            Returns the `(token, expiry)` saved in `file_`, or `None` if it is missing or expires soon
+            `expiry` is a naive UTC datetime, like in `google.auth`
+        """
+
+        try:
+            file_.seek(0)
+            saved = json.loads(file_.read())
+        except ValueError:  # Empty or corrupted file
+            return None
+
+        if saved['expiry'] - self.margin <= time.time():
+            return None
+
+        expiry = datetime.datetime.fromtimestamp(
+            saved['expiry'], datetime.timezone.utc).replace(tzinfo=None)
+
+        return (saved['token'], expiry)
+
+    def write(self, file_, credentials):
+        """
+            Save the token of `credentials` in `file_`
+        """
+
+        if not credentials.token or not credentials.expiry:
+            return
+
+        expiry = credentials.expiry.replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+
+        file_.seek(0)
+        file_.truncate()
+        file_.write(json.dumps({'token': credentials.token, 'expiry': expiry}))
+        file_.flush()
@@ -1,13 +1,36 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import ANY, patch, MagicMock
 import datetime
 import os
+import threading
+from concurrent.futures import ALL_COMPLETED, ThreadPoolExecutor, wait
 
 from google.cloud import bigquery
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
+from .. import bqclient
 from ..bqclient import BqClient
 
 
+def fakeListRows(table, selected_fields=None, start_index=0, max_results=None, page_size=None, retry=None):
+    """
+        Fake paged backend for `Client.list_rows()`, the table contains the integers from 0 to 99
+    """
+
+    rows = list(range(100))[start_index:start_index + max_results]
+    page_size = page_size or 10
+
+    iterator = MagicMock()
+    iterator.pages = (rows[i:i + page_size]
+                      for i in range(0, len(rows), page_size))
+    iterator.__iter__.return_value = iter(rows)
+
+    return iterator
+
+
 class Test(unittest.TestCase):
 
     def setUp(self):
@@ -32,10 +55,115 @@ class Test(unittest.TestCase):
         with patch.dict(os.environ, {'GOOGLE_APPLICATION_CREDENTIALS': ''}):
             self.assertRaises(RuntimeError, self.bc.setClient)
 
+    def test_setClient_3(self):
+        # Clients should be shared by instances using the same credentials
+        bqclient.clientPool.clear()
+        self.addCleanup(bqclient.clientPool.clear)
+        stats = bqclient.getClientPoolStats()
+
+        with patch('google.cloud.bigquery.Client') as client:
+            self.bc.setClient()
+            other = BqClient()
+            other.location = 'US'
+            other.setClient()
+
+            self.assertIs(self.bc.client, other.client)
+            client.assert_called_once_with(project=None, location='US')
+
+        newStats = bqclient.getClientPoolStats()
+        self.assertEqual(newStats['creations'], stats['creations'] + 1)
+        self.assertEqual(newStats['hits'], stats['hits'] + 1)
+        self.assertEqual(newStats['size'], 1)
+
+    def test_setClient_4(self):
+        # A different project, key or location should use a different client
+        bqclient.clientPool.clear()
+        self.addCleanup(bqclient.clientPool.clear)
+
+        with patch('google.cloud.bigquery.Client') as client:
+            self.bc.setClient()
+            other = BqClient()
+            other.project = 'my-project'
+            other.setClient()
+
+            self.assertEqual(client.call_count, 2)
+            self.assertEqual(bqclient.getClientPoolStats()['size'], 2)
+
+    def test_setClient_5(self):
+        # Clients sharing access tokens should not be used by tables that do not share them
+        bqclient.clientPool.clear()
+        self.addCleanup(bqclient.clientPool.clear)
+
+        with patch('google.cloud.bigquery.Client') as client, \
+                patch.object(bqclient.TokenCache, 'attach') as attach:
+            self.bc.setClient()
+            attach.assert_not_called()
+
+            other = BqClient()
+            other.tokenCacheDir = '/tmp'
+            other.setClient()
+
+            self.assertEqual(client.call_count, 2)
+            attach.assert_called_once()
+
+    def test_setClient_6(self):
+        # Should return a RuntimeError if the Json key does not exist
+        self.bc.credentialsFile = '/non/existent/key.json'
+        self.assertRaises(RuntimeError, self.bc.setClient)
+
     def test_getClient(self):
         self.bc.setClient()
         self.assertIsInstance(self.bc.getClient(), bigquery.client.Client)
 
+    def test_getTableMetadata(self):
+        bqclient.tableCache.clear()
+        self.bc.client = MagicMock()
+
+        # Metadata should be fetched once and cached
+        table = self.bc.getTableMetadata('dataset.table')
+        self.assertEqual(table, self.bc.client.get_table.return_value)
+        self.assertEqual(self.bc.getTableMetadata('dataset.table'), table)
+        self.bc.client.get_table.assert_called_once_with('dataset.table')
+
+        # The cache should be shared with other instances
+        other = BqClient()
+        other.client = self.bc.client
+        self.assertEqual(other.getTableMetadata('dataset.table'), table)
+        self.bc.client.get_table.assert_called_once_with('dataset.table')
+
+    def test_getTableMetadata_2(self):
+        # Expired metadata should be fetched again
+        bqclient.tableCache.clear()
+        self.bc.client = MagicMock()
+
+        self.bc.getTableMetadata('dataset.table', 0)
+        self.bc.getTableMetadata('dataset.table', 0)
+        self.assertEqual(self.bc.client.get_table.call_count, 2)
+
+    def test_getTableMetadata_3(self):
+        # Should return a RuntimeError if the BigQuery client is not set
+        self.assertRaises(RuntimeError, self.bc.getTableMetadata, 'dataset.table')
+
+    def test_listTables(self):
+        self.bc.client = MagicMock()
+        self.bc.client.list_tables.return_value = [
+            bigquery.TableReference.from_string('project.dataset.table_1'),
+            bigquery.TableReference.from_string('project.dataset.table_2')]
+
+        self.assertEqual(self.bc.listTables('dataset'), ['table_1', 'table_2'])
+        self.bc.client.list_tables.assert_called_once_with('dataset')
+
+    def test_getTablesMetadata(self):
+        # Metadata of several tables should be fetched in parallel, in order, and cached
+        bqclient.tableCache.clear()
+        self.bc.client = MagicMock()
+        self.bc.client.get_table.side_effect = lambda tableId: tableId.upper()
+
+        tableIds = ['dataset.table_' + str(i) for i in range(20)]
+        self.assertEqual(self.bc.getTablesMetadata(tableIds, threads=4), [tableId.upper() for tableId in tableIds])
+        self.bc.getTablesMetadata(tableIds)
+        self.assertEqual(self.bc.client.get_table.call_count, 20)
+
     def test_runQuery(self):
         self.bc.setClient()
         self.assertIsNone(self.bc.runQuery(self.query))
@@ -60,6 +188,25 @@ class Test(unittest.TestCase):
     def test_runQuery_3(self):
         self.assertRaises(RuntimeError, self.bc.runQuery, self.query)
 
+    def test_runQuery_4(self):
+        # The bytes cap is set on the job configuration
+        self.bc.client = MagicMock()
+        self.bc.runQuery(self.query, maximumBytesBilled=1000)
+
+        jobConfig = self.bc.client.query.call_args[1]['job_config']
+        self.assertEqual(jobConfig.maximum_bytes_billed, 1000)
+
+    def test_dryRun(self):
+        self.bc.client = MagicMock()
+        self.bc.client.query.return_value.total_bytes_processed = 5000
+
+        self.assertEqual(self.bc.dryRun(self.query), 5000)
+        jobConfig = self.bc.client.query.call_args[1]['job_config']
+        self.assertTrue(jobConfig.dry_run)
+
+    def test_dryRun_2(self):
+        self.assertRaises(RuntimeError, self.bc.dryRun, self.query)
+
     def test_readResult(self):
         self.bc.setClient()
         self.bc.runQuery(self.query)
@@ -71,10 +218,324 @@ class Test(unittest.TestCase):
         # Test RuntimeError when no result is pending
         self.assertRaises(RuntimeError, self.bc.readResult)
 
+    def test_readResult_3(self):
+        # Rows should be streamed one page at a time
+        self.bc.queryJob = MagicMock()
+        self.bc.queryJob.result.return_value.pages = iter([[1, 2], [3]])
+
+        result = self.bc.readResult(2)
+        self.assertNotIsInstance(result, list)
+        self.assertEqual(list(result), [1, 2, 3])
+        self.bc.queryJob.result.assert_called_once_with(page_size=2, timeout=None, retry=ANY)
+
+    def test_readResult_4(self):
+        # The job timeout is raised to the caller, which decides whether the job is cancelled
+        self.bc.jobTimeout = 10
+        self.bc.queryJob = MagicMock()
+        self.bc.queryJob.done.return_value = False
+        self.bc.queryJob.result.side_effect = TimeoutError()
+
+        self.assertRaises(TimeoutError, self.bc.readResult)
+        self.bc.queryJob.result.assert_called_once_with(page_size=None, timeout=10, retry=ANY)
+        self.bc.queryJob.cancel.assert_not_called()
+
+    def test_runQuery_5(self):
+        # The job timeout is set on the job configuration
+        self.bc.client = MagicMock()
+        self.bc.jobTimeout = 10
+        self.bc.runQuery(self.query)
+
+        jobConfig = self.bc.client.query.call_args[1]['job_config']
+        self.assertEqual(int(jobConfig.job_timeout_ms), 10000)
+
+    def test_cancelQuery(self):
+        self.bc.queryJob = MagicMock()
+        self.bc.queryJob.done.return_value = False
+        self.assertTrue(self.bc.cancelQuery())
+        self.bc.queryJob.cancel.assert_called_once()
+
+    def test_cancelQuery_2(self):
+        # Jobs that are done are not cancelled
+        job = MagicMock()
+        job.done.return_value = True
+        self.assertFalse(self.bc.cancelQuery(job))
+        job.cancel.assert_not_called()
+
+        # Without a job, nothing is cancelled
+        self.assertFalse(self.bc.cancelQuery())
+
+    def test_attachQuery(self):
+        self.bc.client = MagicMock()
+        self.assertTrue(self.bc.attachQuery('job_1', 'US'))
+        self.bc.client.get_job.assert_called_once_with('job_1', location='US', retry=ANY)
+        self.assertIs(self.bc.getQueryJob(), self.bc.client.get_job.return_value)
+
+    def test_attachQuery_2(self):
+        # Jobs that cannot be read are not attached
+        self.bc.client = MagicMock()
+        self.bc.client.get_job.side_effect = Exception('Not found')
+        self.assertFalse(self.bc.attachQuery('job_1'))
+
+        self.bc.client = None
+        self.assertRaises(RuntimeError, self.bc.attachQuery, 'job_1')
+
+    def test_readResult_5(self):
+        # Test with pages prefetched in a background thread
+        self.bc.queryJob = MagicMock()
+        self.bc.queryJob.result.return_value.pages = iter([[1, 2], [3]])
+
+        self.assertEqual(list(self.bc.readResult(2, 1)), [1, 2, 3])
+
+    @unittest.skipUnless(pyarrow, 'pyarrow is not installed')
+    def test_readArrowResult(self):
+        # Fake read session returning two record batches
+        batches = [
+            pyarrow.RecordBatch.from_pydict({'name': ['a', 'b'], 'number': [1, 2]}),
+            pyarrow.RecordBatch.from_pydict({'name': ['c'], 'number': [3]}),
+        ]
+        self.bc.storageClient = MagicMock()
+        self.bc.queryJob = MagicMock()
+        self.bc.queryJob.result.return_value.to_arrow_iterable.return_value = iter(
+            batches)
+
+        rows = list(self.bc.readArrowResult())
+        self.assertEqual(rows, [('a', 1), ('b', 2), ('c', 3)])
+        self.bc.queryJob.result.return_value.to_arrow_iterable.assert_called_once_with(
+            bqstorage_client=self.bc.storageClient)
+
+    def test_readArrowResult_2(self):
+        # Test RuntimeError when no result is pending
+        self.bc.storageClient = MagicMock()
+        self.assertRaises(RuntimeError, self.bc.readArrowResult)
+
+    def test_setStorageClient(self):
+        # Should return a RuntimeError if the BigQuery client is not set
+        self.assertRaises(RuntimeError, self.bc.setStorageClient)
+
+    def setParallelResult(self, totalRows=100):
+        self.bc.client = MagicMock()
+        self.bc.client.list_rows.side_effect = fakeListRows
+        self.bc.queryJob = MagicMock()
+        self.bc.queryJob.result.return_value.total_rows = totalRows
+        self.bc.queryJob.result.return_value.pages = iter([[0, 1, 2]])
+
+    def test_readParallelResult(self):
+        # Rows should be returned in order
+        self.setParallelResult()
+
+        self.assertEqual(list(self.bc.readParallelResult(4, 7)),
+                         list(range(100)))
+        self.assertEqual(self.bc.client.list_rows.call_count, 4)
+
+    def test_readParallelResult_2(self):
+        # Rows may be returned in any order
+        self.setParallelResult()
+
+        rows = list(self.bc.readParallelResult(3, 10, ordered=False))
+        self.assertEqual(sorted(rows), list(range(100)))
+        self.assertEqual(self.bc.client.list_rows.call_count, 3)
+
+    def test_readParallelResult_3(self):
+        # Small results should be read sequentially
+        self.setParallelResult(3)
+
+        self.assertEqual(list(self.bc.readParallelResult(4)), [0, 1, 2])
+        self.bc.client.list_rows.assert_not_called()
+
+    def test_readParallelResult_4(self):
+        # Errors in a reader should be raised in the consumer
+        self.setParallelResult()
+        self.bc.client.list_rows.side_effect = RuntimeError('page read failed')
+
+        self.assertRaises(RuntimeError, list, self.bc.readParallelResult(2))
+
+    def test_readParallelResult_5(self):
+        # Test RuntimeError when no result is pending
+        self.assertRaises(RuntimeError, self.bc.readParallelResult, 2)
+
+    def test_readParallelResult_6(self):
+        # Closing the iterator early should stop the readers
+        self.setParallelResult()
+
+        fetchPages = self.bc.fetchPages
+        stops = []
+        stopped = threading.Semaphore(0)
+
+        def trackedFetchPages(pages, queue_, stop):
+            stops.append(stop)
+            fetchPages(pages, queue_, stop)
+            stopped.release()
+
+        with patch.object(self.bc, 'fetchPages', side_effect=trackedFetchPages):
+            rows = self.bc.readParallelResult(4, 1)
+            self.assertEqual(next(rows), 0)
+            rows.close()
+
+            # Readers blocked on their full queues return once the iterator is closed
+            for _ in range(4):
+                self.assertTrue(stopped.acquire(timeout=5))
+
+        self.assertTrue(all(stop.is_set() for stop in stops))
+        self.assertEqual(len(stops), 4)
+
+    def test_prefetchPages(self):
+        secondPageRequested = threading.Event()
+
+        def pages():
+            yield ['a', 'b']
+            secondPageRequested.set()
+            yield ['c']
+
+        rows = self.bc.prefetchPages(pages(), 1)
+
+        # The next page should be fetched while the current page is consumed
+        self.assertEqual(next(rows), 'a')
+        self.assertTrue(secondPageRequested.wait(5))
+        self.assertEqual(list(rows), ['b', 'c'])
+
+    def test_prefetchPages_2(self):
+        # Errors while fetching a page should be raised in the consumer
+        def pages():
+            yield ['a']
+            raise RuntimeError('page read failed')
+
+        rows = self.bc.prefetchPages(pages(), 2)
+        self.assertEqual(next(rows), 'a')
+        self.assertRaises(RuntimeError, next, rows)
+
+    def test_prefetchPages_3(self):
+        # Closing the iterator early should stop the background thread
+        def pages():
+            while True:
+                yield ['a']
+
+        rows = self.bc.prefetchPages(pages(), 2)
+        self.assertEqual(next(rows), 'a')
+        rows.close()
+
+        for thread in threading.enumerate():
+            if thread.name.endswith('(fetchPages)'):
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+
+    def test_streamPages(self):
+        pages = iter([['a', 'b'], [], ['c']])
+        stream = self.bc.streamPages(pages)
+
+        # The second page should not be requested before the first one is consumed
+        self.assertEqual(next(stream), 'a')
+        self.assertEqual(next(pages), [])
+        self.assertEqual(list(stream), ['b', 'c'])
+
     def test_setParameter(self):
         self.assertIsInstance(self.bc.setParameter(
             'STRING', 'some string'), bigquery.query.ScalarQueryParameter)
 
+    def test_readHedgedResult(self):
+        # Slow pages should be requested twice, the first response is used
+        self.setParallelResult()
+        self.bc.hedgeMinSamples = 2
+        calls = []
+        blocked, released = threading.Event(), threading.Event()
+
+        def slowListRows(table, **kwargs):
+            calls.append(kwargs['start_index'])
+            if kwargs['start_index'] == 50:
+                if calls.count(50) == 1:
+                    # The first request of the page is blocked until the page is requested again
+                    blocked.set()
+                    released.wait()
+                else:
+                    blocked.clear()
+                    released.set()
+            return fakeListRows(table, **kwargs)
+
+        def fakeWait(futures, timeout=None, return_when=ALL_COMPLETED):
+            # Without a timeout, wait for the requests
+            if timeout is None:
+                return wait(futures, return_when=return_when)
+
+            # A page is slower than the threshold only while its request is blocked, whatever the real latencies
+            while True:
+                done, pending = wait(futures, timeout=0.01, return_when=return_when)
+                if done or blocked.is_set():
+                    return (done, pending)
+
+        self.bc.client.list_rows.side_effect = slowListRows
+
+        with patch.object(bqclient, 'wait', side_effect=fakeWait):
+            self.assertEqual(list(self.bc.readHedgedResult(10, 50)), list(range(100)))
+        self.assertEqual(calls.count(50), 2)
+        self.assertEqual(len(calls), 11)
+
+    def test_readHedgedResult_2(self):
+        # Test RuntimeError when no result is pending
+        self.assertRaises(RuntimeError, self.bc.readHedgedResult, 10, 95)
+
+    def test_getRetry(self):
+        # Transient errors should be retried
+        from google.api_core import exceptions
+        self.bc.retryInitial = 0.01
+        attempts = []
+
+        def request():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise exceptions.ServiceUnavailable('Backend error')
+            return 'ok'
+
+        self.assertEqual(self.bc.getRetry()(request)(), 'ok')
+        self.assertEqual(len(attempts), 3)
+
+    def test_runQuery_6(self):
+        # Query jobs should be submitted with a generated job ID and a retry policy
+        self.bc.client = MagicMock()
+        self.bc.runQuery(self.query)
+
+        kwargs = self.bc.client.query.call_args[1]
+        self.assertEqual(kwargs['job_id_prefix'], 'bigquery_fdw_')
+        self.assertIsNotNone(kwargs['retry'])
+
+    def test_warmUp(self):
+        # The pooled client should be created and used once
+        self.addCleanup(bqclient.clientPool.clear)
+        with patch('google.cloud.bigquery.Client') as client:
+            self.assertGreaterEqual(bqclient.warmUp('project'), 0)
+
+            client.assert_called_once_with(project='project', location=None)
+            client.return_value.get_service_account_email.assert_called_once()
+
+            # Foreign tables with the same options use the warmed up client
+            bc = BqClient()
+            bc.project = 'project'
+            bc.setClient()
+            self.assertEqual(bc.client, client.return_value)
+
+    def test_warmUp_2(self):
+        # Should return a RuntimeError if the credentials cannot be refreshed
+        self.addCleanup(bqclient.clientPool.clear)
+        with patch('google.cloud.bigquery.Client') as client:
+            client.return_value.get_service_account_email.side_effect = ValueError('invalid_grant')
+            self.assertRaises(RuntimeError, bqclient.warmUp, 'project')
+
+    def test_getPercentile(self):
+        self.assertEqual(bqclient.getPercentile(list(range(1, 101)), 95), 96)
+        self.assertEqual(bqclient.getPercentile([3, 1, 2], 99), 3)
+        self.assertIsNone(bqclient.getPercentile([1, 2], 50, 5))
+
+    def test_firstResult(self):
+        # The error should only be raised if every future fails
+        with ThreadPoolExecutor(2) as executor:
+            failed = executor.submit(lambda: 1 / 0)
+            succeeded = executor.submit(lambda: 'page')
+            self.assertEqual(bqclient.firstResult([failed, succeeded]), 'page')
+            self.assertRaises(ZeroDivisionError, bqclient.firstResult, [failed])
+
+    def test_setParameter_2(self):
+        parameter = self.bc.setParameter('DATE', [datetime.date(2018, 5, 27)])
+        self.assertIsInstance(parameter, bigquery.query.ArrayQueryParameter)
+        self.assertEqual(parameter.values, ['2018-05-27'])
+
     def test_varToString(self):
         self.assertEqual(self.bc.varToString(1234), '1234')
 
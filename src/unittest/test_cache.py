@@ -0,0 +1,136 @@
+import unittest
+import tempfile
+import os
+
+from google.cloud import bigquery
+
+from ..cache import ResultCache, getResultCache
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.query = 'SELECT name FROM `dataset.table` WHERE year = ?'
+        self.parameters = [bigquery.ScalarQueryParameter(None, 'INT64', '2017')]
+
+        # Set ResultCache instance
+        self.cache = ResultCache()
+
+    def test_getKey(self):
+        key = self.cache.getKey(self.query, self.parameters)
+
+        self.assertIsInstance(key, str)
+        self.assertEqual(key, self.cache.getKey(self.query, self.parameters))
+
+    def test_getKey_2(self):
+        # Different parameters should use a different key
+        parameters = [bigquery.ScalarQueryParameter(None, 'INT64', '2018')]
+
+        self.assertNotEqual(self.cache.getKey(self.query, self.parameters),
+                            self.cache.getKey(self.query, parameters))
+
+    def test_get(self):
+        self.cache.set('key', [{'name': 'a'}, {'name': 'b'}], 60)
+        self.assertEqual(self.cache.get('key'), [{'name': 'a'}, {'name': 'b'}])
+
+    def test_get_2(self):
+        # Missing entry
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_get_3(self):
+        # Expired entry
+        self.cache.set('key', [1, 2, 3], 0)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_set(self):
+        # Least recently used entries should be evicted
+        self.cache.maxBytes = 200
+        self.cache.set('key1', list(range(30)), 60)
+        self.cache.set('key2', list(range(30)), 60)
+        self.cache.get('key1')
+        self.cache.set('key3', list(range(30)), 60)
+
+        self.assertIsNotNone(self.cache.get('key1'))
+        self.assertIsNone(self.cache.get('key2'))
+        self.assertIsNotNone(self.cache.get('key3'))
+        self.assertLessEqual(self.cache.size, 200)
+
+    def test_set_2(self):
+        # Replacing an entry should update the size
+        self.cache.set('key', list(range(30)), 60)
+        size = self.cache.size
+        self.cache.set('key', list(range(30)), 60)
+
+        self.assertEqual(self.cache.size, size)
+
+    def test_spill(self):
+        # Evicted entries should be read from the spill directory
+        with tempfile.TemporaryDirectory() as directory:
+            self.cache.maxBytes = 100
+            self.cache.spillDir = directory
+            self.cache.set('key1', list(range(30)), 60)
+            self.cache.set('key2', list(range(30)), 60)
+
+            self.assertNotIn('key1', self.cache.entries)
+            self.assertTrue(os.path.exists(self.cache.getSpillPath('key1')))
+            self.assertEqual(self.cache.get('key1'), list(range(30)))
+
+    def test_spill_2(self):
+        # Spilled files that can be written by other users are never unpickled
+        with tempfile.TemporaryDirectory() as directory:
+            self.cache.maxBytes = 100
+            self.cache.spillDir = os.path.join(directory, 'spill')
+            self.cache.set('key1', list(range(30)), 60)
+            self.cache.set('key2', list(range(30)), 60)
+
+            self.assertEqual(os.stat(self.cache.spillDir).st_mode & 0o777, 0o700)
+            self.assertEqual(os.stat(self.cache.getSpillPath('key1')).st_mode & 0o777, 0o600)
+
+            os.chmod(self.cache.getSpillPath('key1'), 0o666)
+            self.assertIsNone(self.cache.get('key1'))
+
+    def test_spill_3(self):
+        # Symbolic links are not followed
+        with tempfile.TemporaryDirectory() as directory:
+            self.cache.maxBytes = 100
+            self.cache.spillDir = directory
+            self.cache.set('key1', list(range(30)), 60)
+            self.cache.set('key3', list(range(30)), 60)
+            os.symlink(self.cache.getSpillPath('key1'), self.cache.getSpillPath('key2'))
+
+            self.assertIsNone(self.cache.get('key2'))
+
+    def test_getResultCache(self):
+        # Tables with the same settings share a cache
+        self.assertIs(getResultCache(1024, '/tmp/a'), getResultCache(1024, '/tmp/a'))
+        self.assertIsNot(getResultCache(1024, '/tmp/a'), getResultCache(2048, '/tmp/a'))
+        self.assertEqual(getResultCache().maxBytes, ResultCache.maxBytes)
+
+    def test_getSize(self):
+        self.assertGreater(self.cache.getSize((2017, 'a' * 1000)), 1000)
+
+    def test_spill_4(self):
+        # Entries larger than the memory budget should only be spilled
+        with tempfile.TemporaryDirectory() as directory:
+            self.cache.maxBytes = 10
+            self.cache.spillDir = directory
+            self.cache.set('key', list(range(30)), 60)
+
+            self.assertEqual(self.cache.size, 0)
+            self.assertEqual(self.cache.get('key'), list(range(30)))
+
+    def test_readSpill(self):
+        # Expired spilled entries should be removed
+        with tempfile.TemporaryDirectory() as directory:
+            self.cache.spillDir = directory
+            self.cache.spill('key', 1, b'')
+
+            self.assertIsNone(self.cache.readSpill('key', 2))
+
+    def test_clear(self):
+        self.cache.set('key', [1, 2, 3], 60)
+        self.cache.clear()
+
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.size, 0)
@@ -1,14 +1,19 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from collections import OrderedDict
 import datetime
 import os
+import tempfile
 
 import multicorn
+from multicorn.utils import ERROR, INFO
 from google.cloud import bigquery
 
 from ..bqclient import BqClient
+from .. import fdw
+from ..cache import resultCache
 from ..fdw import ConstantForeignDataWrapper
+from ..singleflight import SingleFlight
 
 
 class Test(unittest.TestCase):
@@ -121,6 +126,110 @@ class Test(unittest.TestCase):
         casting = ''
         self.assertIsNone(self.fdw.setOptionCasting(casting))
 
+    def test_setOptionAggregates(self):
+        self.fdw.setOptionAggregates('{"revenue": "SUM(price * quantity)"}')
+        self.assertEqual(self.fdw.aggregates, {'revenue': 'SUM(price * quantity)'})
+
+    def test_setOptionAggregates_2(self):
+        # Only a dict of expressions is accepted
+        self.fdw.setOptionAggregates('["SUM(price)"]')
+        self.assertIsNone(self.fdw.aggregates)
+
+    def test_setOptionPageSize(self):
+        self.fdw.setOptionPageSize('5000')
+        self.assertEqual(self.fdw.pageSize, 5000)
+
+    def test_setOptionPageSize_2(self):
+        # Should fallback to BigQuery's default page size
+        self.fdw.setOptionPageSize(None)
+        self.assertIsNone(self.fdw.pageSize)
+
+    def test_setOptionPageSize_3(self):
+        # Invalid values should be ignored and call log_to_postgres()
+        for pageSize in ['abc', '0', '-10']:
+            self.fdw.setOptionPageSize(pageSize)
+            self.assertIsNone(self.fdw.pageSize)
+
+    def test_setOptionStorageApi(self):
+        self.fdw.setOptionStorageApi('true')
+        self.assertTrue(self.fdw.storageApi)
+
+    def test_setOptionStorageApi_2(self):
+        self.fdw.setOptionStorageApi('false')
+        self.assertFalse(self.fdw.storageApi)
+
+    def test_setOptionStreams(self):
+        self.fdw.setOptionStreams('8')
+        self.assertEqual(self.fdw.streams, 8)
+
+    def test_setOptionStreams_2(self):
+        # Should fallback to a single reader
+        for streams in [None, 'abc', '-1']:
+            self.fdw.setOptionStreams(streams)
+            self.assertEqual(self.fdw.streams, 1)
+
+    def test_setOptionPreserveOrder(self):
+        self.fdw.setOptionPreserveOrder('true')
+        self.assertTrue(self.fdw.preserveOrder)
+
+    def test_setOptionPreserveOrder_2(self):
+        self.fdw.setOptionPreserveOrder('false')
+        self.assertFalse(self.fdw.preserveOrder)
+
+    def test_setOptionPrefetch(self):
+        self.fdw.setOptionPrefetch('2')
+        self.assertEqual(self.fdw.prefetch, 2)
+
+    def test_setOptionPrefetch_2(self):
+        # Should fallback to no prefetching
+        self.fdw.setOptionPrefetch(None)
+        self.assertEqual(self.fdw.prefetch, 0)
+
+    def test_setOptionMemoize(self):
+        self.fdw.setOptionMemoize('true')
+        self.assertTrue(self.fdw.memoize)
+
+    def test_setOptionMemoize_2(self):
+        self.fdw.setOptionMemoize('false')
+        self.assertFalse(self.fdw.memoize)
+
+    def test_setOptionDryRun(self):
+        self.fdw.setOptionDryRun('true')
+        self.assertTrue(self.fdw.dryRun)
+
+        self.fdw.setOptionDryRun(None)
+        self.assertFalse(self.fdw.dryRun)
+
+    def test_setOptionHedgePercentile(self):
+        self.fdw.setOptionHedgePercentile('95')
+        self.assertEqual(self.fdw.hedgePercentile, 95)
+
+        # Percentiles above 99 are ignored
+        self.fdw.setOptionHedgePercentile('100')
+        self.assertIsNone(self.fdw.hedgePercentile)
+
+    def test_setOptionCache(self):
+        self.fdw.setOptionCache('60', '1024', '/tmp/bigquery_fdw')
+        self.assertEqual(self.fdw.cacheTtl, 60)
+        self.assertEqual(self.fdw.resultCache.maxBytes, 1024)
+        self.assertEqual(self.fdw.resultCache.spillDir, '/tmp/bigquery_fdw')
+
+        # The settings of a table do not change the cache of the other tables
+        self.assertIsNot(self.fdw.resultCache, resultCache)
+        self.assertEqual(resultCache.spillDir, None)
+
+    def test_setOptionCache_2(self):
+        # The cache should be disabled by default
+        self.fdw.setOptionCache(None, None, None)
+        self.assertEqual(self.fdw.cacheTtl, 0)
+
+    def test_getIntegerOption(self):
+        self.assertEqual(self.fdw.getIntegerOption('10', 'fdw_option'), 10)
+
+    def test_getIntegerOption_2(self):
+        self.assertEqual(self.fdw.getIntegerOption(None, 'fdw_option', 5), 5)
+        self.assertEqual(self.fdw.getIntegerOption('0', 'fdw_option', 5), 5)
+
     def test_getClient(self):
         self.fdw.setClient()
         self.assertIsInstance(self.fdw.getClient(), BqClient)
@@ -142,16 +251,759 @@ class Test(unittest.TestCase):
         with patch.dict(os.environ, {'GOOGLE_APPLICATION_CREDENTIALS': ''}):
             self.assertIsNone(self.fdw.setClient())
 
+    def setTableMetadata(self, numRows=1000000, numBytes=50000000):
+        self.fdw.client = MagicMock()
+        table = self.fdw.client.getTableMetadata.return_value
+        table.num_rows = numRows
+        table.num_bytes = numBytes
+        table.schema = list(self.columns.keys())
+
+    def test_get_rel_size(self):
+        self.setTableMetadata()
+
+        # Without quals, all rows and all columns are returned
+        self.assertEqual(self.fdw.get_rel_size([], self.columns.keys()), (1000000, 50))
+        self.fdw.client.getTableMetadata.assert_called_with(
+            'bigquery-public-data.usa_names.usa_1910_current', 300)
+
+    def test_get_rel_size_2(self):
+        self.setTableMetadata()
+
+        # Quals and fewer columns should reduce the estimation
+        rows, width = self.fdw.get_rel_size(self.quals, ['year'])
+        self.assertEqual(rows, int(1000000 * 0.3333 * 0.005))
+        self.assertEqual(width, 10)
+
+    def test_get_rel_size_3(self):
+        # Ranges should use the selectivity of an equality
+        self.setTableMetadata()
+        quals = [multicorn.Qual(field_name='year', operator='>=', value=2010),
+                 multicorn.Qual(field_name='year', operator='<=', value=2017)]
+
+        self.assertEqual(self.fdw.get_rel_size(quals, ['year'])[0], 5000)
+
+    def test_get_rel_size_4(self):
+        # Should fallback to Multicorn's default estimation
+        self.fdw.client = MagicMock()
+        self.fdw.client.getTableMetadata.side_effect = RuntimeError('Not found')
+
+        self.assertEqual(self.fdw.get_rel_size([], ['year']), (100000000, 100))
+
+    def test_get_rel_size_5(self):
+        # Empty tables should return at least 1 row
+        self.setTableMetadata(0, 0)
+
+        self.assertEqual(self.fdw.get_rel_size(self.quals, ['year']), (1, 1))
+
+    def test_get_rel_size_6(self):
+        # Views and external tables have no statistics and should fallback to Multicorn's default estimation
+        self.setTableMetadata(None, None)
+
+        self.assertEqual(self.fdw.get_rel_size(self.quals, ['year']), (100000000, 100))
+
+    def test_get_rel_size_7(self):
+        # Dry run estimates are used as the cost of the scan
+        self.setTableMetadata()
+        self.fdw.dryRun = True
+        self.fdw.client.dryRun.return_value = 200000000
+
+        self.assertEqual(self.fdw.get_rel_size([], self.columns.keys()), (1000000, 200))
+
+        # Estimates are only requested once per query
+        self.fdw.get_rel_size([], self.columns.keys())
+        self.fdw.client.dryRun.assert_called_once()
+
+    def test_get_rel_size_8(self):
+        # The width derived from a dry run is capped
+        self.setTableMetadata(1, 100)
+        self.fdw.dryRun = True
+        self.fdw.client.dryRun.return_value = 10 ** 12
+
+        self.assertEqual(self.fdw.get_rel_size([], self.columns.keys()), (1, self.fdw.maxWidth))
+
+    def test_estimateBytes(self):
+        # Estimates expire after `fdw_stats_ttl` seconds and the least recently used are evicted
+        self.fdw.client = MagicMock()
+        self.fdw.client.dryRun.return_value = 5000
+        self.fdw.maxEstimates = 2
+
+        for query in ['SELECT 1', 'SELECT 2', 'SELECT 1', 'SELECT 3']:
+            self.assertEqual(self.fdw.estimateBytes(query, []), 5000)
+        self.assertEqual(self.fdw.client.dryRun.call_count, 3)
+        self.assertEqual(len(self.fdw.bytesEstimates), 2)
+
+        self.fdw.statsTtl = 0
+        self.fdw.bytesEstimates.clear()
+        self.fdw.estimateBytes('SELECT 1', [])
+        self.fdw.estimateBytes('SELECT 1', [])
+        self.assertEqual(self.fdw.client.dryRun.call_count, 5)
+
+    def test_get_rel_size_9(self):
+        # Wildcard tables have no metadata and are never looked up
+        self.fdw.client = MagicMock()
+        self.fdw.table = 'events_*'
+
+        self.assertEqual(self.fdw.get_rel_size([], ['year']), (100000000, 100))
+        self.assertEqual(self.fdw.get_path_keys(), [])
+        self.assertIsNone(self.fdw.getPartitioning())
+        self.fdw.client.getTableMetadata.assert_not_called()
+
+    def test_setOptionSuffixFormat(self):
+        self.fdw.setOptionSuffixFormat('%Y-%m')
+        self.assertEqual(self.fdw.suffixFormat, '%Y-%m')
+
+        # Formats that do not sort like dates are ignored
+        self.fdw.setOptionSuffixFormat('%d%m%Y')
+        self.assertEqual(self.fdw.suffixFormat, '%Y%m%d')
+
+        self.fdw.setOptionSuffixFormat(None)
+        self.assertEqual(self.fdw.suffixFormat, '%Y%m%d')
+
+    def test_getQualSelectivity(self):
+        self.assertEqual(self.fdw.getQualSelectivity(self.quals[1]), 0.005)
+
+    def test_getQualSelectivity_2(self):
+        # List quals
+        qual = multicorn.Qual(field_name='year',
+                              operator=('=', True), value=[2016, 2017])
+        self.assertEqual(self.fdw.getQualSelectivity(qual), 0.01)
+
+    def test_getQualSelectivity_3(self):
+        # Unknown operators should use a default selectivity
+        qual = multicorn.Qual(field_name='name', operator='~~*', value='a%')
+        self.assertEqual(self.fdw.getQualSelectivity(qual), 0.3333)
+
+    def test_can_sort(self):
+        sortkeys = [
+            multicorn.SortKey(attname='year', attnum=3,
+                              is_reversed=False, nulls_first=False, collate=None),
+            multicorn.SortKey(attname='name', attnum=4,
+                              is_reversed=True, nulls_first=True, collate='C'),
+        ]
+        self.assertEqual(self.fdw.can_sort(sortkeys), sortkeys)
+
+    def test_can_sort_2(self):
+        # Strings with a collation other than `C` cannot be sorted by BigQuery
+        sortkeys = [
+            multicorn.SortKey(attname='year', attnum=3,
+                              is_reversed=False, nulls_first=False, collate=None),
+            multicorn.SortKey(attname='name', attnum=4,
+                              is_reversed=False, nulls_first=False, collate=None),
+            multicorn.SortKey(attname='number', attnum=5,
+                              is_reversed=False, nulls_first=False, collate=None),
+        ]
+        self.assertEqual(self.fdw.can_sort(sortkeys), sortkeys[:1])
+
+    def test_can_sort_3(self):
+        # Casted columns cannot be sorted by BigQuery
+        self.fdw.setOptionCasting('{"number": "STRING"}')
+        sortkeys = [
+            multicorn.SortKey(attname='number', attnum=5,
+                              is_reversed=False, nulls_first=False, collate=None),
+        ]
+        self.assertEqual(self.fdw.can_sort(sortkeys), [])
+
+    def test_get_path_keys(self):
+        self.setTableMetadata()
+        table = self.fdw.client.getTableMetadata.return_value
+        table.clustering_fields = ['state', 'unknown_column']
+        table.time_partitioning.field = 'year'
+
+        self.assertEqual(self.fdw.get_path_keys(), [
+                         (('state',), 5000), (('year',), 5000)])
+
+    def test_get_path_keys_2(self):
+        # Should not advertise any path key without table statistics
+        self.fdw.client = MagicMock()
+        self.fdw.client.getTableMetadata.side_effect = RuntimeError('Not found')
+
+        self.assertEqual(self.fdw.get_path_keys(), [])
+
     def test_execute(self):
         self.fdw.setClient()
         execute = self.fdw.execute(self.quals, self.columns.keys())
 
         for row in execute:
-            # Ensure that the row is an OrderedDict
-            self.assertIsInstance(row, OrderedDict)
-            # Compare the keys of each row with the expected columns
-            self.assertEqual(set(row.keys()), set(
-                {'state', 'gender', 'year', 'name', 'number'}))
+            # Ensure that the row is a tuple with a value for each column
+            self.assertIsInstance(row, tuple)
+            self.assertEqual(len(row), len(self.columns))
+
+    def test_execute_2(self):
+        # Identical queries should be served from the result cache
+        resultCache.clear()
+        self.addCleanup(resultCache.clear)
+        self.fdw.client = MagicMock()
+        self.fdw.client.setParameter = BqClient().setParameter
+        self.fdw.client.readResult.return_value = iter([
+            (2017, 1001)])
+        self.fdw.cacheTtl = 60
+
+        rows = list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.assertEqual(list(self.fdw.execute(
+            self.quals, ['year', 'number'])), rows)
+        self.fdw.client.runQuery.assert_called_once()
+
+    def test_execute_3(self):
+        # Results larger than the memory budget of the cache are not buffered nor cached
+        resultCache.clear()
+        self.addCleanup(resultCache.clear)
+        self.setMockClient([(2017, 1001)] * 3)
+        self.fdw.cacheTtl = 60
+        self.fdw.resultCache = MagicMock(wraps=resultCache, maxBytes=100)
+        self.fdw.resultCache.getSize.return_value = 40
+
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.fdw.resultCache.set.assert_not_called()
+
+    def setMockClient(self, rows):
+        self.fdw.client = MagicMock()
+        self.fdw.client.setParameter = BqClient().setParameter
+        self.fdw.client.readResult.side_effect = lambda *args: iter(rows)
+
+    def test_execute_4(self):
+        # Rescans should be served from memory until the end of the scan
+        self.setMockClient([(2017, 1001)])
+        self.fdw.memoize = True
+
+        rows = list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.assertEqual(list(self.fdw.execute(
+            self.quals, ['year', 'number'])), rows)
+        self.assertEqual(self.fdw.client.runQuery.call_count, 1)
+
+        self.fdw.end_scan()
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.assertEqual(self.fdw.client.runQuery.call_count, 2)
+
+    def test_execute_5(self):
+        # Large results should not be memoized
+        self.setMockClient([(2017, 1001)] * 3)
+        self.fdw.memoize = True
+        self.fdw.memoMaxRows = 2
+
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.assertEqual(self.fdw.client.runQuery.call_count, 2)
+
+    def test_setMemoizedResult(self):
+        # The least recently used results are evicted when the memo is full
+        self.fdw.memoMaxTotalRows = 3
+        self.fdw.setMemoizedResult('a', [(1,), (2,)])
+        self.fdw.setMemoizedResult('b', [(3,)])
+        self.assertEqual(self.fdw.getMemoizedResult('a', [], [], None, None, None), [(1,), (2,)])
+
+        self.fdw.setMemoizedResult('c', [(4,)])
+        self.assertEqual(list(self.fdw.memo), ['a', 'c'])
+        self.assertEqual(self.fdw.memoRows, 3)
+
+        # Results larger than the memo are not kept
+        self.fdw.setMemoizedResult('d', [(5,)] * 4)
+        self.assertEqual(self.fdw.memo, {})
+        self.assertEqual(self.fdw.memoRows, 0)
+
+    def test_rollback(self):
+        # Memoized results of an aborted statement should not be read by the next statement
+        self.setMockClient([(2017, 1001)])
+        self.fdw.memoize = True
+
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.fdw.rollback()
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.assertEqual(self.fdw.client.runQuery.call_count, 2)
+
+        self.fdw.sub_rollback(1)
+        self.assertEqual(self.fdw.memo, {})
+
+    def test_execute_6(self):
+        # Repeated lookups of a column should be served from a single query
+        self.setMockClient([(year, 1001)
+                            for year in range(2010, 2020)])
+        table = self.fdw.client.getTableMetadata.return_value
+        table.num_rows = 100
+        self.fdw.memoize = True
+        self.fdw.batchMaxRows = 100
+
+        for year in [2015, 2016, 2017, 2018, 2019, 2030]:
+            quals = [multicorn.Qual(field_name='number', operator='>', value=1000),
+                     multicorn.Qual(field_name='year', operator='=', value=year)]
+            rows = list(self.fdw.execute(quals, ['year', 'number']))
+
+        # 2 lookups and 1 query to load the rows matching `number > 1000`
+        self.assertEqual(self.fdw.client.runQuery.call_count, 3)
+        self.assertNotIn('year = ?', self.fdw.client.runQuery.call_args[0][0])
+        self.assertEqual(rows, [])
+
+    def test_execute_7(self):
+        # Rows should not be loaded at once if they are too many
+        self.setMockClient([])
+        table = self.fdw.client.getTableMetadata.return_value
+        table.num_rows = 1000000
+        self.fdw.memoize = True
+        self.fdw.batchMaxRows = 100
+
+        for year in range(2010, 2016):
+            quals = [multicorn.Qual(field_name='year', operator='=', value=year)]
+            list(self.fdw.execute(quals, ['year', 'number']))
+
+        self.assertEqual(self.fdw.client.runQuery.call_count, 6)
+
+    def test_buildLookupIndex(self):
+        # Rows of views and external tables should not be loaded at once: their size is unknown
+        self.setMockClient([])
+        self.fdw.client.getTableMetadata.return_value.num_rows = None
+        self.fdw.batchMaxRows = 100
+
+        self.assertIsNone(self.fdw.buildLookupIndex('year', [], ['year', 'number']))
+        self.fdw.client.runQuery.assert_not_called()
+
+    def test_buildLookupIndex_2(self):
+        # The cost limits of the table apply to the query loading the rows
+        self.setMockClient([(2017, 1001)])
+        self.fdw.client.getTableMetadata.return_value.num_rows = 10
+        self.fdw.batchMaxRows = 100
+        self.fdw.maxBytesBilled = 1000
+        self.fdw.dryRun = True
+
+        with patch.object(self.fdw, 'checkQueryCost') as checkQueryCost:
+            index = self.fdw.buildLookupIndex('year', self.quals[:1], ['year', 'number'])
+
+        checkQueryCost.assert_called_once()
+        self.assertEqual(self.fdw.client.runQuery.call_args[0][3], 1000)
+        self.assertEqual(list(index), [2017])
+
+    def test_buildLookupIndex_3(self):
+        # The job is cancelled if the rows cannot be read
+        self.setMockClient([])
+        self.fdw.client.getTableMetadata.return_value.num_rows = 10
+        self.fdw.client.readResult.side_effect = TimeoutError()
+        self.fdw.batchMaxRows = 100
+
+        self.assertRaises(TimeoutError, self.fdw.buildLookupIndex, 'year', self.quals[:1], ['year', 'number'])
+        self.fdw.client.cancelQuery.assert_called_once_with(self.fdw.client.getQueryJob.return_value)
+        self.assertEqual(self.fdw.activeJobs, [])
+
+    def test_getLookupSignature(self):
+        self.fdw.batchMaxRows = 100
+        signature, column, value, otherQuals = self.fdw.getLookupSignature(
+            self.quals, ['year', 'number'], None, None, None)
+
+        self.assertEqual((column, value, otherQuals),
+                         ('year', 2017, self.quals[:1]))
+
+    def test_getLookupSignature_2(self):
+        # Batched lookups are disabled by default
+        self.assertIsNone(self.fdw.getLookupSignature(
+            self.quals, ['year', 'number'], None, None, None))
+
+    def test_getLookupSignature_3(self):
+        # Casted columns cannot be looked up
+        self.fdw.batchMaxRows = 100
+        self.fdw.setOptionCasting('{"year": "STRING"}')
+
+        self.assertIsNone(self.fdw.getLookupSignature(
+            self.quals, ['year', 'number'], None, None, None))
+
+    def test_getOrderedColumns(self):
+        self.assertEqual(self.fdw.getOrderedColumns(
+            {'number', 'state', 'year'}), ['state', 'year', 'number'])
+
+    def test_getOrderedColumns_2(self):
+        self.assertEqual(self.fdw.getOrderedColumns(None), [])
+
+    def test_getRowFormatter(self):
+        # All columns
+        formatRow = self.fdw.getRowFormatter(list(self.columns))
+        self.assertEqual(formatRow(('CA', 'F', 2017, 'Emma', 1001)),
+                         ('CA', 'F', 2017, 'Emma', 1001))
+
+    def test_getRowFormatter_2(self):
+        # Some columns, `None` for the other columns
+        formatRow = self.fdw.getRowFormatter(['gender', 'number'])
+        self.assertEqual(formatRow(('F', 1001)),
+                         (None, 'F', None, None, 1001))
+
+    def test_getRowFormatter_3(self):
+        # A single column
+        formatRow = self.fdw.getRowFormatter(['year'])
+        self.assertEqual(formatRow((2017,)), (None, None, 2017, None, None))
+
+    def test_getRowFormatter_4(self):
+        # No column
+        formatRow = self.fdw.getRowFormatter([])
+        self.assertEqual(formatRow(()), (None, None, None, None, None))
+
+    def test_getRowFormatter_5(self):
+        # Test with a BigQuery row
+        formatRow = self.fdw.getRowFormatter(['year', 'name'])
+        row = bigquery.table.Row((2017, 'Emma'), {'year': 0, 'name': 1})
+        self.assertEqual(formatRow(row), (None, None, 2017, 'Emma', None))
+
+    def test_readResult(self):
+        client = MagicMock()
+        self.fdw.pageSize = 100
+
+        self.assertEqual(self.fdw.readResult(client),
+                         client.readResult.return_value)
+        client.readResult.assert_called_once_with(100, 0)
+        client.readArrowResult.assert_not_called()
+
+    def test_readResult_2(self):
+        # Test with hedged page requests
+        client = MagicMock()
+        self.fdw.hedgePercentile = 95
+
+        self.assertEqual(self.fdw.readResult(client),
+                         client.readHedgedResult.return_value)
+        client.readHedgedResult.assert_called_once_with(10000, 95)
+
+    def test_readResult_3(self):
+        # Test with the BigQuery Storage Read API
+        client = MagicMock()
+        self.fdw.storageApi = True
+
+        self.assertEqual(self.fdw.readResult(client),
+                         client.readArrowResult.return_value)
+        client.readResult.assert_not_called()
+
+    def test_readResult_4(self):
+        # Should fallback to the REST API if the Storage Read API is not available
+        client = MagicMock()
+        client.readArrowResult.side_effect = RuntimeError('not installed')
+        self.fdw.storageApi = True
+
+        self.assertEqual(self.fdw.readResult(client),
+                         client.readResult.return_value)
+
+    def test_readResult_5(self):
+        # Test with parallel readers
+        client = MagicMock()
+        self.fdw.streams = 4
+        self.fdw.preserveOrder = True
+
+        self.assertEqual(self.fdw.readResult(client),
+                         client.readParallelResult.return_value)
+        client.readParallelResult.assert_called_once_with(4, None, True)
+
+    def test_readResult_6(self):
+        # Parallel readers should keep the order of sorted results
+        client = MagicMock()
+        self.fdw.streams = 4
+
+        self.fdw.readResult(client, True)
+        client.readParallelResult.assert_called_once_with(4, None, True)
+
+    def test_readResult_7(self):
+        # Limited results should be read sequentially without prefetching
+        client = MagicMock()
+        self.fdw.streams = 4
+        self.fdw.prefetch = 2
+        self.fdw.storageApi = True
+
+        self.assertEqual(self.fdw.readResult(client, False, True),
+                         client.readResult.return_value)
+        client.readResult.assert_called_once_with(None)
+
+    def test_can_limit(self):
+        self.fdw.setOptionLimitPushdown('true')
+        self.fdw.plannedQuals = self.quals
+        self.assertTrue(self.fdw.can_limit(10, 0))
+
+    def test_can_limit_2(self):
+        # Quals that are evaluated locally prevent LIMIT pushdown
+        self.fdw.setOptionLimitPushdown('true')
+        self.fdw.plannedQuals = [multicorn.Qual(
+            field_name='name', operator='~~*', value='a%')]
+        self.assertFalse(self.fdw.can_limit(10, 0))
+
+    def test_can_limit_3(self):
+        # LIMIT is not pushed down without `fdw_limit_pushdown`: restrictions Multicorn cannot convert are not visible
+        self.fdw.plannedQuals = self.quals
+        self.assertFalse(self.fdw.can_limit(10, 0))
+
+    def test_can_limit_4(self):
+        # LIMIT is not pushed down when PostgreSQL sorts the rows
+        self.fdw.setOptionLimitPushdown('true')
+        self.fdw.get_rel_size(self.quals, ['year', 'name'])
+        sortkeys = [MagicMock(attname='year', collate=None), MagicMock(attname='name', collate='en_US')]
+        self.assertEqual(self.fdw.can_sort(sortkeys), sortkeys[:1])
+        self.assertFalse(self.fdw.can_limit(10, 0))
+        self.assertEqual(self.fdw.plannedLimit, (None, None))
+
+        # Sort keys that are all pushed down
+        self.assertEqual(self.fdw.can_sort(sortkeys[:1]), sortkeys[:1])
+        self.assertTrue(self.fdw.can_limit(10, 0))
+
+    def test_canPushLimit(self):
+        # Quals on casted columns are evaluated on the casted value by PostgreSQL
+        self.fdw.setOptionCasting('{"number": "STRING"}')
+        self.assertFalse(self.fdw.canPushLimit(self.quals))
+
+    def test_canPushLimit_2(self):
+        # Quals on converted time zones are evaluated on the converted value by PostgreSQL
+        self.fdw.convertToTz = 'US/Eastern'
+        self.columns['datetime'] = multicorn.ColumnDefinition(
+            column_name='datetime', type_oid=0, base_type_name='date')
+        quals = [multicorn.Qual(field_name='datetime', operator='=',
+                                value=datetime.date(2018, 5, 27))]
+
+        self.assertTrue(self.fdw.canPushLimit(self.quals))
+        self.assertFalse(self.fdw.canPushLimit(quals))
+
+    def test_execute_8(self):
+        # The bytes cap is sent with the query
+        self.setMockClient([(2017, 1001)])
+        self.fdw.maxBytesBilled = 1000
+
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.assertEqual(self.fdw.client.runQuery.call_args[0][3], 1000)
+        self.fdw.client.dryRun.assert_not_called()
+
+    def test_execute_9(self):
+        # Queries over the bytes cap fail before running
+        self.setMockClient([(2017, 1001)])
+        self.fdw.dryRun = True
+        self.fdw.maxBytesBilled = 1000
+        self.fdw.client.dryRun.return_value = 5000
+
+        def logToPostgres(message, level=INFO, hint=None):
+            # Errors interrupt the query like in PostgreSQL
+            if level == ERROR:
+                raise RuntimeError(message)
+
+        with patch.object(fdw, 'log_to_postgres', side_effect=logToPostgres):
+            with self.assertRaisesRegex(RuntimeError, '5000 bytes'):
+                list(self.fdw.execute(self.quals, ['year', 'number']))
+
+        self.fdw.client.runQuery.assert_not_called()
+
+    def test_import_schema(self):
+        table = bigquery.Table('project.dataset.table_1', schema=[
+            bigquery.SchemaField('name', 'STRING'),
+            bigquery.SchemaField('number', 'INTEGER'),
+            bigquery.SchemaField('created', 'DATETIME'),
+            bigquery.SchemaField('tags', 'STRING', mode='REPEATED'),
+            bigquery.SchemaField('price', 'NUMERIC')])
+        table.time_partitioning = bigquery.TimePartitioning(type_='DAY')
+
+        with patch.object(fdw, 'BqClient') as client:
+            client.return_value.listTables.return_value = ['table_1', 'table_2']
+            client.return_value.getTablesMetadata.return_value = [table]
+
+            definitions = ConstantForeignDataWrapper.import_schema(
+                'dataset', {'fdw_project': 'project'}, {'fdw_group': 'true'}, 'except', ['table_2'])
+
+        self.assertEqual(client.return_value.project, 'project')
+        client.return_value.getTablesMetadata.assert_called_once_with(
+            ['dataset.table_1'], 300, 16)
+
+        self.assertEqual(len(definitions), 1)
+        self.assertEqual(definitions[0].table_name, 'table_1')
+        self.assertEqual(definitions[0].options, {
+                         'fdw_group': 'true', 'fdw_dataset': 'dataset', 'fdw_table': 'table_1'})
+        self.assertEqual([(column.column_name, column.type_name) for column in definitions[0].columns], [
+            ('name', 'text'), ('number', 'bigint'), ('created', 'timestamp without time zone'),
+            ('tags', 'text'), ('price', 'text'), ('partition_date', 'date')])
+
+    def test_execute_10(self):
+        # The job is cancelled when the scan is abandoned
+        self.setMockClient([(2017, 1001), (2018, 1002)])
+
+        execute = self.fdw.execute(self.quals, ['year', 'number'])
+        next(execute)
+        self.assertEqual(self.fdw.activeJobs, [self.fdw.client.getQueryJob.return_value])
+        execute.close()
+
+        self.fdw.client.cancelQuery.assert_called_once_with(
+            self.fdw.client.getQueryJob.return_value)
+        self.assertEqual(self.fdw.activeJobs, [])
+
+    def test_execute_11(self):
+        # Completed scans are not cancelled
+        self.setMockClient([(2017, 1001)])
+
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+        self.fdw.end_scan()
+        self.fdw.client.cancelQuery.assert_not_called()
+
+    def test_execute_12(self):
+        # Jobs read by other backends through single-flight are not cancelled
+        self.setMockClient([(2017, 1001), (2018, 1002)])
+
+        with patch.object(self.fdw.singleFlight, 'runQuery', return_value=True) as runQuery, \
+                patch.object(self.fdw.singleFlight, 'release', return_value=False):
+            execute = self.fdw.execute(self.quals, ['year', 'number'])
+            next(execute)
+            self.assertEqual(self.fdw.activeJobs, [self.fdw.client.getQueryJob.return_value])
+            execute.close()
+
+        self.assertIs(runQuery.call_args[0][0], self.fdw.client)
+        self.assertTrue(runQuery.call_args[0][2].startswith('SELECT year'))
+        self.fdw.client.cancelQuery.assert_not_called()
+        self.assertEqual(self.fdw.activeJobs, [])
+
+    def test_execute_13(self):
+        # Jobs submitted with single-flight are cancelled when no other backend reads them
+        self.setMockClient([(2017, 1001), (2018, 1002)])
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.fdw.singleFlight = SingleFlight(directory)
+            job = self.fdw.client.getQueryJob.return_value
+            job.job_id, job.location = 'job_1', 'US'
+
+            execute = self.fdw.execute(self.quals, ['year', 'number'])
+            next(execute)
+            self.fdw.end_scan()
+
+        self.fdw.client.cancelQuery.assert_called_once_with(
+            self.fdw.client.getQueryJob.return_value)
+
+    def test_execute_14(self):
+        # Tables on different projects should not share cached results
+        resultCache.clear()
+        self.addCleanup(resultCache.clear)
+        self.setMockClient([(2017, 1001)])
+        self.fdw.cacheTtl = 60
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+
+        other = ConstantForeignDataWrapper(dict(self.options, fdw_project='other-project'), self.columns)
+        other.client = self.fdw.client
+        other.cacheTtl = 60
+        list(other.execute(self.quals, ['year', 'number']))
+
+        self.assertEqual(self.fdw.client.runQuery.call_count, 2)
+
+    def test_execute_15(self):
+        # Tables with other columns should not read cached lines of another layout
+        resultCache.clear()
+        self.addCleanup(resultCache.clear)
+        self.setMockClient([(2017, 1001)])
+        self.fdw.cacheTtl = 60
+        list(self.fdw.execute(self.quals, ['year', 'number']))
+
+        columns = OrderedDict((column, self.columns[column]) for column in ['year', 'number'])
+        other = ConstantForeignDataWrapper(self.options, columns)
+        other.client = self.fdw.client
+        other.cacheTtl = 60
+
+        self.assertEqual(list(other.execute(self.quals, ['year', 'number'])), [(2017, 1001)])
+        self.assertEqual(self.fdw.client.runQuery.call_count, 2)
+
+    def test_execute_16(self):
+        # Jobs of other backends are not cancelled when their result is not ready before the job timeout
+        self.setMockClient([])
+        self.fdw.client.readResult.side_effect = TimeoutError()
+        job = self.fdw.client.getQueryJob.return_value
+        job.job_id = 'job_1'
+
+        def follow(*args):
+            self.fdw.singleFlight.following[job.job_id] = 'key'
+            return True
+
+        self.fdw.singleFlight = SingleFlight()
+        with patch.object(self.fdw.singleFlight, 'runQuery', side_effect=follow):
+            self.assertRaises(TimeoutError, list, self.fdw.execute(self.quals, ['year', 'number']))
+
+        self.fdw.client.cancelQuery.assert_not_called()
+        self.assertEqual(self.fdw.activeJobs, [])
+        self.assertEqual(self.fdw.singleFlight.following, {})
+
+        # Jobs submitted by this backend are cancelled
+        with patch.object(self.fdw.singleFlight, 'runQuery', return_value=False):
+            self.assertRaises(TimeoutError, list, self.fdw.execute(self.quals, ['year', 'number']))
+
+        self.fdw.client.cancelQuery.assert_called_once_with(job)
+
+    def test_setOptions_3(self):
+        # Tables with a different single-flight directory do not share the coordination
+        other = ConstantForeignDataWrapper(dict(self.options, fdw_single_flight_dir='/tmp/bigquery_fdw'), self.columns)
+
+        self.assertIsNone(self.fdw.singleFlight.directory)
+        self.assertEqual(other.singleFlight.directory, '/tmp/bigquery_fdw')
+
+    def test_end_scan(self):
+        # Jobs of scans still being read are cancelled at the end of the scan
+        self.setMockClient([(2017, 1001), (2018, 1002)])
+
+        execute = self.fdw.execute(self.quals, ['year', 'number'])
+        next(execute)
+        self.fdw.end_scan()
+
+        self.fdw.client.cancelQuery.assert_called_once_with(
+            self.fdw.client.getQueryJob.return_value)
+        self.assertEqual(self.fdw.activeJobs, [])
+
+        # Closing the abandoned scan does not cancel the job twice
+        execute.close()
+        self.fdw.client.cancelQuery.assert_called_once()
+
+    def test_explain(self):
+        self.setMockClient([])
+        quals = self.quals + [
+            multicorn.Qual(field_name='name', operator='~~*', value='J%'),
+            multicorn.Qual(field_name='state', operator=('=', True), value=['TX', 'CA']),
+        ]
+
+        lines = self.fdw.explain(quals, ['year', 'number'])
+        self.assertEqual(lines[0], 'BigQuery query: SELECT year  as year, number  as number FROM `bigquery-public-data.usa_names.usa_1910_current` WHERE number > ? AND year = ? AND state IN UNNEST(?)')
+        self.assertEqual(lines[1], "BigQuery parameters: INT64 '1000', INT64 '2017', ARRAY<STRING> ['TX', 'CA']")
+        self.assertEqual(lines[2], "Pushed quals: number > 1000, year = 2017, state = ANY(['TX', 'CA'])")
+        self.assertEqual(lines[3], "Local quals: name ~~* 'J%'")
+
+        # The query is not run
+        self.fdw.client.runQuery.assert_not_called()
+        self.fdw.client.dryRun.assert_not_called()
+
+    def test_explain_2(self):
+        # The pushed down LIMIT and OFFSET are displayed
+        self.setMockClient([])
+        self.fdw.setOptionLimitPushdown('true')
+        self.fdw.plannedQuals = self.quals
+        self.assertTrue(self.fdw.can_limit(10, 5))
+
+        lines = self.fdw.explain(self.quals, ['year'])
+        self.assertTrue(lines[0].endswith(' LIMIT 10 OFFSET 5'))
+
+        # LIMIT is not displayed when it is not pushed down
+        self.fdw.setOptionLimitPushdown('false')
+        self.fdw.can_limit(10, 5)
+        self.assertNotIn('LIMIT', self.fdw.explain(self.quals, ['year'])[0])
+
+    def test_explain_3(self):
+        # `EXPLAIN (VERBOSE)` adds the estimated bytes processed
+        self.setMockClient([])
+        self.fdw.client.dryRun.return_value = 5000
+
+        lines = self.fdw.explain(self.quals, ['year'], verbose=True)
+        self.assertEqual(lines[-1], 'BigQuery bytes processed (estimate): 5000')
+
+        # Estimates are cached
+        self.fdw.explain(self.quals, ['year'], verbose=True)
+        self.fdw.client.dryRun.assert_called_once()
+
+    def test_execute_17(self):
+        # Test LIMIT and OFFSET pushdown
+        self.fdw.client = MagicMock()
+        self.fdw.setOptionLimitPushdown('true')
+        self.fdw.client.readResult.return_value = iter([
+            (2017, 1001)])
+
+        rows = list(self.fdw.execute(
+            self.quals, ['year', 'number'], limit=10, offset=5))
+        self.assertEqual(rows, [(None, None, 2017, None, 1001)])
+
+        query = self.fdw.client.runQuery.call_args[0][0]
+        self.assertTrue(query.endswith(' LIMIT 10 OFFSET 5'))
+
+    def test_execute_18(self):
+        # LIMIT should not be pushed down with quals evaluated locally
+        self.fdw.client = MagicMock()
+        self.fdw.setOptionLimitPushdown('true')
+        self.fdw.client.readResult.return_value = iter([])
+        self.fdw.setOptionCasting('{"number": "STRING"}')
+
+        list(self.fdw.execute(self.quals, ['year', 'number'], limit=10))
+
+        query = self.fdw.client.runQuery.call_args[0][0]
+        self.assertNotIn('LIMIT', query)
 
     def test_buildQuery(self):
         self.fdw.bq = self.fdw.getClient()
@@ -254,13 +1106,128 @@ class Test(unittest.TestCase):
             c, 'GROUP_BY'), 'state , gender , year , name , number , datetime')
 
     def test_buildColumnList_8(self):
+        # Test with table suffix pseudo column
+        c = self.columns
+        c['table_suffix'] = multicorn.ColumnDefinition(
+            column_name='table_suffix', type_oid=0, base_type_name='date')
+
+        self.assertEqual(self.fdw.buildColumnList(
+            ['state', 'table_suffix']), "state  as state, SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX)  as table_suffix")
+
+        c['table_suffix'] = multicorn.ColumnDefinition(
+            column_name='table_suffix', type_oid=25, base_type_name='text')
+        self.fdw.compileTable()
+
+        self.assertEqual(self.fdw.buildColumnList(
+            ['table_suffix'], 'GROUP_BY'), '_TABLE_SUFFIX')
+
+    def test_buildColumnList_9(self):
         # Test `SELECT *`
         self.assertEqual(self.fdw.buildColumnList(None), '*')
 
-    def test_buildColumnList_9(self):
+    def test_buildColumnList_10(self):
         # Test no columns when grouping by
         self.assertEqual(self.fdw.buildColumnList(None, 'GROUP_BY'), '')
 
+    def test_getColumnFragments(self):
+        # Fragments are compiled at table setup
+        self.assertIn('state', self.fdw.columnFragments)
+        self.assertEqual(self.fdw.getColumnFragments(
+            'state'), ('state  as state', 'state '))
+
+    def test_getColumnFragments_2(self):
+        # Fragments are compiled once and reused
+        with patch.object(self.fdw, 'compileColumn', wraps=self.fdw.compileColumn) as compileColumn:
+            self.fdw.buildColumnList(self.columns)
+            self.fdw.buildColumnList(self.columns, 'GROUP_BY')
+
+            compileColumn.assert_not_called()
+
+    def test_getColumnFragments_3(self):
+        # Changing casting rules invalidates compiled fragments
+        self.fdw.setOptionCasting('{"number": "STRING"}')
+
+        self.assertEqual(self.fdw.getColumnFragments('number'), (
+            'CAST(number as STRING)  as number', 'CAST(number as STRING) '))
+
+    def test_getAggregateExpression(self):
+        self.assertEqual(self.fdw.getAggregateExpression('_fdw_sum_number'), 'SUM(number)')
+        self.assertEqual(self.fdw.getAggregateExpression('_fdw_count_distinct_name'), 'COUNT(DISTINCT name)')
+        self.assertEqual(self.fdw.getAggregateExpression('_fdw_approx_distinct_name'), 'APPROX_COUNT_DISTINCT(name)')
+
+    def test_getAggregateExpression_2(self):
+        # Regular columns, the counting pseudo column and unknown functions are not aggregates
+        self.assertIsNone(self.fdw.getAggregateExpression('number'))
+        self.assertIsNone(self.fdw.getAggregateExpression('_fdw_count'))
+        self.assertIsNone(self.fdw.getAggregateExpression('_fdw_median_number'))
+        self.assertIsNone(self.fdw.getAggregateExpression('_fdw_sum_'))
+
+    def test_getAggregateExpression_3(self):
+        # Pseudo columns declared with `fdw_aggregates`
+        self.fdw.setOptionAggregates('{"total": "SUM(number * 2)"}')
+        self.assertEqual(self.fdw.getAggregateExpression('total'), 'SUM(number * 2)')
+
+    def test_getAggregateExpression_4(self):
+        # Aggregate pseudo columns of the table are resolved once at table setup
+        c = self.columns
+        c['_fdw_sum_number'] = multicorn.ColumnDefinition(
+            column_name='_fdw_sum_number', type_oid=20, base_type_name='bigint')
+        fdw = ConstantForeignDataWrapper(self.options, c)
+
+        with patch.object(fdw, 'resolveAggregateExpression') as resolveAggregateExpression:
+            self.assertEqual(fdw.getAggregateExpression('_fdw_sum_number'), 'SUM(number)')
+            self.assertTrue(fdw.isAggregateColumn('_fdw_sum_number'))
+            self.assertFalse(fdw.isAggregateColumn('number'))
+
+        resolveAggregateExpression.assert_not_called()
+
+    def test_buildColumnList_11(self):
+        # Aggregate pseudo columns are not grouped
+        c = self.columns
+        c['_fdw_sum_number'] = multicorn.ColumnDefinition(
+            column_name='_fdw_sum_number', type_oid=20, base_type_name='bigint')
+
+        self.assertEqual(self.fdw.buildColumnList(
+            ['state', '_fdw_sum_number']), 'state  as state, SUM(number)  as _fdw_sum_number')
+        self.assertEqual(self.fdw.buildColumnList(
+            ['state', '_fdw_sum_number'], 'GROUP_BY'), 'state')
+
+    def test_compileColumn(self):
+        # Counting pseudo column is not grouped
+        self.assertEqual(self.fdw.compileColumn(
+            '_fdw_count'), ('count(*)  as _fdw_count', None))
+
+    def test_buildOrderByClause(self):
+        sortkeys = [
+            multicorn.SortKey(attname='year', attnum=3,
+                              is_reversed=True, nulls_first=True, collate=None),
+            multicorn.SortKey(attname='number', attnum=5,
+                              is_reversed=False, nulls_first=False, collate=None),
+        ]
+        self.assertEqual(self.fdw.buildOrderByClause(
+            sortkeys, self.columns), 'year DESC NULLS FIRST, number ASC NULLS LAST')
+
+    def test_buildOrderByClause_2(self):
+        # Test with partition pseudo column not selected
+        sortkeys = [
+            multicorn.SortKey(attname='partition_date', attnum=6,
+                              is_reversed=False, nulls_first=False, collate=None),
+        ]
+        self.assertEqual(self.fdw.buildOrderByClause(
+            sortkeys, ['year']), '_PARTITIONTIME ASC NULLS LAST')
+
+    def test_buildLimitClause(self):
+        self.assertEqual(self.fdw.buildLimitClause(10, None), ' LIMIT 10')
+        self.assertEqual(self.fdw.buildLimitClause(10, 0), ' LIMIT 10')
+        self.assertEqual(self.fdw.buildLimitClause(
+            10, 20), ' LIMIT 10 OFFSET 20')
+
+    def test_buildLimitClause_2(self):
+        # No limit
+        self.assertEqual(self.fdw.buildLimitClause(None, None), '')
+        self.assertEqual(self.fdw.buildLimitClause(
+            None, 20), ' LIMIT 9223372036854775807 OFFSET 20')
+
     def test_setTimeZone(self):
         self.fdw.convertToTz = 'US/Eastern'
         self.assertEqual(self.fdw.setTimeZone(
@@ -360,6 +1327,268 @@ class Test(unittest.TestCase):
         self.assertIsInstance(parameters, list)
         self.assertEqual(parameters, [])
 
+    def test_buildWhereClause_4(self):
+        # Test with `IN` and `= ANY()` list quals
+        self.fdw.client = BqClient()
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='year', operator=('=', True), value=[2016, 2017])])
+
+        self.assertEqual(clause, 'WHERE year IN UNNEST(?)')
+        self.assertIsInstance(parameters[0], bigquery.query.ArrayQueryParameter)
+        self.assertEqual(parameters[0].array_type, 'INT64')
+        self.assertEqual(parameters[0].values, ['2016', '2017'])
+
+    def test_buildWhereClause_5(self):
+        # Test with `NOT IN` and `<> ALL()` list quals
+        self.fdw.client = BqClient()
+        qual = multicorn.Qual(field_name='state', operator=('<>', False), value=['CA', 'NY'])
+        self.assertIs(qual.list_any_or_all, multicorn.ALL)
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='number', operator='>', value=1000), qual])
+
+        self.assertEqual(clause, 'WHERE number > ? AND state NOT IN UNNEST(?)')
+        self.assertEqual(parameters[1].values, ['CA', 'NY'])
+
+    def test_buildWhereClause_6(self):
+        # Quals that cannot be pushed down should be ignored
+        self.fdw.client = BqClient()
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='number', operator=('>', True), value=[1, 2]),
+            multicorn.Qual(field_name='name', operator='~~*', value='a%')])
+
+        self.assertEqual(clause, '')
+        self.assertEqual(parameters, [])
+
+    def test_buildWhereClause_7(self):
+        # NULL elements are removed from `IN` lists
+        self.fdw.client = BqClient()
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='year', operator=('=', True), value=[2017, None])])
+
+        self.assertEqual(parameters[0].values, ['2017'])
+
+    def test_buildWhereClause_8(self):
+        # Test `IS NULL` and `IS NOT NULL`
+        self.fdw.client = BqClient()
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='name', operator='=', value=None),
+            multicorn.Qual(field_name='state', operator='<>', value=None)])
+
+        self.assertEqual(clause, 'WHERE name IS NULL AND state IS NOT NULL')
+        self.assertEqual(parameters, [])
+
+    def test_buildWhereClause_9(self):
+        # `IS NULL` on the partition pseudo column of a table without partitioning metadata
+        self.fdw.client = MagicMock()
+        self.fdw.client.getTableMetadata.side_effect = RuntimeError('Not found')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='partition_date', operator='=', value=None)])
+
+        self.assertEqual(clause, 'WHERE _PARTITIONTIME IS NULL')
+        self.assertEqual(parameters, [])
+
+    def test_buildWhereClause_10(self):
+        # `>=` and `<=` quals on the same column should be merged in a `BETWEEN`
+        self.fdw.client = BqClient()
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='year', operator='<=', value=2017),
+            multicorn.Qual(field_name='number', operator='>=', value=1000),
+            multicorn.Qual(field_name='year', operator='>=', value=2010)])
+
+        self.assertEqual(clause, 'WHERE number >= ? AND year BETWEEN ? AND ?')
+        self.assertEqual([p.value for p in parameters], ['1000', '2010', '2017'])
+
+    def test_buildWhereClause_11(self):
+        # Test `BETWEEN` with partition pseudo column
+        self.fdw.client = BqClient()
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='partition_date', operator='>=',
+                           value=datetime.date(2018, 5, 1)),
+            multicorn.Qual(field_name='partition_date', operator='<=',
+                           value=datetime.date(2018, 5, 31))])
+
+        self.assertEqual(clause, 'WHERE _PARTITIONTIME BETWEEN ? AND ?')
+        self.assertEqual([p.value for p in parameters], [
+                         '2018-05-01 00:00:00', '2018-05-31 00:00:00'])
+
+    def setPartitioning(self, type_=None, field=None, dataType='TIMESTAMP'):
+        self.setMockClient([])
+        table = bigquery.Table('project.dataset.table', schema=[
+            bigquery.SchemaField('created', dataType), bigquery.SchemaField('year', 'INT64')])
+        if type_ == 'RANGE':
+            table.range_partitioning = bigquery.RangePartitioning(
+                field=field, range_=bigquery.PartitionRange(start=1900, end=2100, interval=1))
+        elif type_:
+            table.time_partitioning = bigquery.TimePartitioning(type_=type_, field=field)
+        self.fdw.client.getTableMetadata.return_value = table
+
+    def test_getPartitioning(self):
+        self.setPartitioning('HOUR')
+        self.assertEqual(self.fdw.getPartitioning(), ('_PARTITIONTIME', 'TIMESTAMP', 'HOUR'))
+
+        self.setPartitioning('DAY', 'created', 'DATETIME')
+        self.assertEqual(self.fdw.getPartitioning(), ('created', 'DATETIME', 'DAY'))
+
+        self.setPartitioning('RANGE', 'year')
+        self.assertEqual(self.fdw.getPartitioning(), ('year', 'INT64', 'RANGE'))
+
+        self.setPartitioning()
+        self.assertIsNone(self.fdw.getPartitioning())
+
+    def test_buildWhereClause_12(self):
+        # Daily ingestion-time partitions are filtered with `_PARTITIONDATE`
+        self.setPartitioning('DAY')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='partition_date', operator='=', value=datetime.date(2018, 5, 1))])
+
+        self.assertEqual(clause, 'WHERE _PARTITIONDATE = ?')
+        self.assertEqual([(p.type_, p.value) for p in parameters], [('DATE', '2018-05-01')])
+
+    def test_buildWhereClause_13(self):
+        # Hourly partitions are filtered with ranges of timestamps
+        self.setPartitioning('HOUR')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='partition_date', operator='=', value=datetime.date(2018, 5, 1)),
+            multicorn.Qual(field_name='partition_date', operator='<=', value=datetime.date(2018, 5, 31))])
+
+        self.assertEqual(
+            clause, 'WHERE (_PARTITIONTIME >= ? AND _PARTITIONTIME < ?) AND _PARTITIONTIME < ?')
+        self.assertEqual([p.value for p in parameters], [
+                         '2018-05-01 00:00:00', '2018-05-02 00:00:00', '2018-06-01 00:00:00'])
+
+    def test_buildWhereClause_14(self):
+        # Dates compared to a timestamp partitioning column
+        self.setPartitioning('DAY', 'created')
+        self.fdw.columns['created'] = multicorn.ColumnDefinition(
+            column_name='created', type_oid=0, base_type_name='date')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='created', operator='>', value=datetime.date(2018, 5, 1)),
+            multicorn.Qual(field_name='created', operator=('=', True), value=[datetime.date(2018, 5, 1)])])
+
+        self.assertEqual(clause, 'WHERE created >= ? AND DATE(created) IN UNNEST(?)')
+        self.assertEqual([p.type_ if hasattr(p, 'type_') else p.array_type for p in parameters], [
+                         'TIMESTAMP', 'DATE'])
+        self.assertEqual(parameters[0].value, '2018-05-02 00:00:00')
+
+    def test_buildWhereClause_15(self):
+        # Quals on the partitioning column use its BigQuery data type
+        self.setPartitioning('DAY', 'created', 'DATETIME')
+        self.fdw.columns['created'] = multicorn.ColumnDefinition(
+            column_name='created', type_oid=0, base_type_name='timestamp without time zone')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='created', operator='>=', value=datetime.datetime(2018, 5, 1, 12))])
+
+        self.assertEqual(clause, 'WHERE created >= ?')
+        self.assertEqual((parameters[0].type_, parameters[0].value), ('DATETIME', '2018-05-01 12:00:00'))
+
+    def test_buildWhereClause_16(self):
+        # Dates on the table suffix pseudo column select the shards of wildcard tables
+        self.fdw.client = BqClient()
+        self.fdw.columns['table_suffix'] = multicorn.ColumnDefinition(
+            column_name='table_suffix', type_oid=0, base_type_name='date')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='table_suffix', operator='>=', value=datetime.date(2018, 5, 1)),
+            multicorn.Qual(field_name='table_suffix', operator='<=', value=datetime.date(2018, 5, 31))])
+
+        self.assertEqual(clause, 'WHERE _TABLE_SUFFIX BETWEEN ? AND ?')
+        self.assertEqual([(p.type_, p.value) for p in parameters], [
+                         ('STRING', '20180501'), ('STRING', '20180531')])
+
+    def test_buildWhereClause_17(self):
+        # Text suffixes are sent unchanged
+        self.fdw.client = BqClient()
+        self.fdw.columns['table_suffix'] = multicorn.ColumnDefinition(
+            column_name='table_suffix', type_oid=25, base_type_name='text')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='table_suffix', operator='~~', value='2018%')])
+
+        self.assertEqual(clause, 'WHERE _TABLE_SUFFIX LIKE ?')
+        self.assertEqual(parameters[0].value, '2018%')
+
+    def test_buildWhereClause_18(self):
+        # Strict comparisons with a date inside the period of a shard also read the shard
+        self.fdw.client = BqClient()
+        self.fdw.setOptionSuffixFormat('%Y%m')
+        self.fdw.columns['table_suffix'] = multicorn.ColumnDefinition(
+            column_name='table_suffix', type_oid=0, base_type_name='date')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='table_suffix', operator='>', value=datetime.date(2018, 5, 15)),
+            multicorn.Qual(field_name='table_suffix', operator='<', value=datetime.date(2018, 7, 1))])
+
+        self.assertEqual(clause, 'WHERE _TABLE_SUFFIX >= ? AND _TABLE_SUFFIX < ?')
+        self.assertEqual([p.value for p in parameters], ['201805', '201807'])
+
+        # Timestamps are inside the period of their day
+        self.fdw.setOptionSuffixFormat('%Y%m%d')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='table_suffix', operator='<', value=datetime.datetime(2018, 5, 15, 12))])
+        self.assertEqual(clause, 'WHERE _TABLE_SUFFIX <= ?')
+
+    def test_buildWhereClause_19(self):
+        # `<>` is not pushed down when it could exclude shards with matching rows
+        self.fdw.client = BqClient()
+        self.fdw.columns['table_suffix'] = multicorn.ColumnDefinition(
+            column_name='table_suffix', type_oid=0, base_type_name='date')
+        quals = [multicorn.Qual(field_name='table_suffix', operator='<>', value=datetime.date(2018, 5, 1)),
+                 multicorn.Qual(field_name='table_suffix', operator=('<>', False), value=[datetime.date(2018, 5, 1)])]
+
+        clause, parameters = self.fdw.buildWhereClause(quals)
+        self.assertEqual(clause, 'WHERE _TABLE_SUFFIX <> ? AND _TABLE_SUFFIX NOT IN UNNEST(?)')
+
+        self.fdw.setOptionSuffixFormat('%Y-%m')
+        self.assertEqual(self.fdw.buildWhereClause(quals), ('', []))
+
+        self.fdw.setOptionSuffixFormat('%Y%m%d')
+        self.assertEqual(self.fdw.buildWhereClause([multicorn.Qual(
+            field_name='table_suffix', operator='<>', value=datetime.datetime(2018, 5, 1, 12))]), ('', []))
+
+    def test_buildWhereClause_20(self):
+        # Timestamps are not truncated to the date of daily ingestion-time partitions
+        self.setPartitioning('DAY')
+        clause, parameters = self.fdw.buildWhereClause([
+            multicorn.Qual(field_name='partition_date', operator='<', value=datetime.datetime(2018, 5, 1, 12))])
+
+        self.assertEqual(clause, 'WHERE _PARTITIONTIME < ?')
+        self.assertEqual([(p.type_, p.value) for p in parameters], [('TIMESTAMP', '2018-05-01 12:00:00')])
+
+    def test_getBetweenQuals(self):
+        lower = multicorn.Qual(field_name='year', operator='>=', value=2010)
+        upper = multicorn.Qual(field_name='year', operator='<=', value=2017)
+        quals = [lower, upper, multicorn.Qual(
+            field_name='number', operator='<=', value=10)]
+
+        self.assertEqual(self.fdw.getBetweenQuals(quals), {'year': (lower, upper)})
+
+    def test_isQualPushable(self):
+        self.assertTrue(self.fdw.isQualPushable(self.quals[0]))
+        self.assertTrue(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='year', operator=('=', True), value=[2016, 2017])))
+        self.assertTrue(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='year', operator=('<>', False), value=[2016, 2017])))
+
+    def test_isQualPushable_2(self):
+        # Only `IS NULL` and `IS NOT NULL` are supported with NULL values
+        self.assertTrue(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='name', operator='=', value=None)))
+        self.assertFalse(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='name', operator='>', value=None)))
+
+    def test_isQualPushable_3(self):
+        self.assertFalse(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='name', operator='~~*', value='a%')))
+        self.assertFalse(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='year', operator=('=', False), value=[2016, 2017])))
+        # `<> ALL()` with a NULL element never matches in PostgreSQL
+        self.assertFalse(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='year', operator=('<>', False), value=[2016, None])))
+
+    def test_isQualPushable_4(self):
+        # Aggregate pseudo columns are filtered by PostgreSQL
+        self.assertFalse(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='_fdw_count', operator='>', value=10)))
+        self.assertFalse(self.fdw.isQualPushable(multicorn.Qual(
+            field_name='_fdw_sum_number', operator='>', value=10)))
+
     def test_getOperator(self):
         self.assertEqual(self.fdw.getOperator('='), '=')
 
@@ -0,0 +1,209 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import datetime
+import os
+import tempfile
+
+from .. import singleflight
+from ..singleflight import SingleFlight, getSingleFlight
+
+
+class FakeClient:
+    """
+        Client submitting a new job on each query, jobs are shared between clients through `jobs`
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.queryJob = None
+        self.queries = 0
+
+    def runQuery(self, query, parameters=[]):
+        self.queries += 1
+        self.queryJob = MagicMock(job_id='job_' + str(len(self.jobs)), location='US',
+                                  state='RUNNING', error_result=None, ended=None)
+        self.jobs[self.queryJob.job_id] = self.queryJob
+
+    def attachQuery(self, jobId, location=None):
+        if jobId not in self.jobs:
+            return False
+
+        self.queryJob = self.jobs[jobId]
+        return True
+
+    def getQueryJob(self):
+        return self.queryJob
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        # Set SingleFlight instance
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.flight = SingleFlight(self.directory.name)
+        self.jobs = {}
+        self.key = self.flight.getKey('query', 'project')
+
+    def test_getKey(self):
+        self.assertEqual(self.key, self.flight.getKey('query', 'project'))
+        self.assertNotEqual(self.key, self.flight.getKey('query', 'project', '/key.json'))
+        self.assertNotEqual(self.key, self.flight.getKey('query', 'project', location='EU'))
+
+    def test_runQuery(self):
+        # The second client reads the job of the first one
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+
+        self.assertFalse(self.flight.runQuery(leader, self.key, 'SELECT 1'))
+        self.assertTrue(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+        self.assertEqual(follower.queries, 0)
+        self.assertIs(follower.getQueryJob(), leader.getQueryJob())
+
+        # The lock file is only readable by its owner
+        self.assertEqual(os.stat(self.flight.getPath(self.key)).st_mode & 0o777, 0o600)
+
+    def test_runQuery_2(self):
+        # Failed jobs and jobs that ended before the window are not shared
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+        self.flight.runQuery(leader, self.key, 'SELECT 1')
+
+        leader.getQueryJob().error_result = {'reason': 'backendError'}
+        self.assertFalse(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+        self.assertEqual(follower.queries, 1)
+
+        job = follower.getQueryJob()
+        job.state = 'DONE'
+        job.ended = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=120)
+        self.assertFalse(self.flight.runQuery(leader, self.key, 'SELECT 1'))
+        self.assertEqual(leader.queries, 2)
+
+        # Jobs that ended within the window are shared
+        leader.getQueryJob().state = 'DONE'
+        leader.getQueryJob().ended = datetime.datetime.now(datetime.timezone.utc)
+        self.assertTrue(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+
+    def test_runQuery_3(self):
+        # Jobs that cannot be read are not shared
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+        self.flight.runQuery(leader, self.key, 'SELECT 1')
+        self.jobs.clear()
+
+        self.assertFalse(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+        self.assertEqual(follower.queries, 1)
+
+    def test_runQuery_4(self):
+        # Without a directory, each client runs its own query
+        self.flight.directory = None
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+
+        self.assertFalse(self.flight.runQuery(leader, self.key, 'SELECT 1'))
+        self.assertFalse(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_runQuery_5(self):
+        # The lock file is not locked while the job is submitted
+        leader = FakeClient(self.jobs)
+        runQuery = leader.runQuery
+
+        def lockedRunQuery(*args):
+            with open(self.flight.getPath(self.key)) as file_:
+                singleflight.fcntl.flock(file_, singleflight.fcntl.LOCK_EX | singleflight.fcntl.LOCK_NB)
+            runQuery(*args)
+
+        leader.runQuery = lockedRunQuery
+        self.assertFalse(self.flight.runQuery(leader, self.key, 'SELECT 1'))
+
+    def test_runQuery_6(self):
+        # Other backends wait for the job of a backend submitting the same query
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+        self.flight.transaction(self.key, lambda flights: self.flight.claim(flights, self.key))
+
+        def publish(seconds):
+            # The job is submitted while the follower waits
+            leader.runQuery('SELECT 1')
+            self.flight.transaction(self.key, lambda flights: self.flight.publish(
+                flights, self.key, leader.getQueryJob()))
+
+        with patch.object(singleflight.time, 'sleep', side_effect=publish) as sleep:
+            self.assertTrue(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+
+        sleep.assert_called_once()
+        self.assertIs(follower.getQueryJob(), leader.getQueryJob())
+
+    def test_runQuery_7(self):
+        # Claims of backends that did not submit their job expire
+        follower = FakeClient(self.jobs)
+        self.flight.claimTimeout = 0
+        self.flight.transaction(self.key, lambda flights: self.flight.claim(flights, self.key))
+
+        self.assertFalse(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+        self.assertEqual(follower.queries, 1)
+
+    def test_runQuery_8(self):
+        # Lock files accessible by other users are not used
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+        self.flight.runQuery(leader, self.key, 'SELECT 1')
+        os.chmod(self.flight.getPath(self.key), 0o666)
+
+        self.assertFalse(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+        self.assertEqual(follower.queries, 1)
+
+    def test_release(self):
+        # Jobs without readers can be cancelled and are not shared anymore
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+        self.flight.runQuery(leader, self.key, 'SELECT 1')
+
+        self.assertTrue(self.flight.release(leader.getQueryJob()))
+        self.assertFalse(self.flight.runQuery(follower, self.key, 'SELECT 1'))
+
+    def test_release_2(self):
+        # Jobs read by other backends are not cancelled
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+        flight = SingleFlight(self.directory.name)
+        self.flight.runQuery(leader, self.key, 'SELECT 1')
+        flight.runQuery(follower, self.key, 'SELECT 1')
+
+        self.assertFalse(self.flight.release(leader.getQueryJob()))
+
+        # Followers never cancel the job
+        self.assertFalse(flight.release(follower.getQueryJob()))
+
+    def test_release_3(self):
+        # Jobs run without single-flight can be cancelled
+        self.assertTrue(self.flight.release(MagicMock(job_id='job_0')))
+
+    def test_release_4(self):
+        # Followers are not readers anymore once they released or read the job
+        leader, follower = FakeClient(self.jobs), FakeClient(self.jobs)
+        followers = [SingleFlight(self.directory.name), SingleFlight(self.directory.name)]
+        self.flight.runQuery(leader, self.key, 'SELECT 1')
+
+        for flight in followers:
+            self.assertTrue(flight.runQuery(follower, self.key, 'SELECT 1'))
+        readers = self.flight.transaction(self.key, lambda flights: flights[self.key]['readers'])
+        self.assertEqual(readers, 2)
+
+        self.assertFalse(followers[0].release(follower.getQueryJob()))
+        followers[1].forget(follower.getQueryJob())
+        self.assertEqual(followers[1].following, {})
+
+        # The job can be cancelled by the backend that submitted it
+        self.assertTrue(self.flight.release(leader.getQueryJob()))
+
+    def test_getSingleFlight(self):
+        # Tables with the same directory share the coordination
+        self.assertIs(getSingleFlight('/tmp/a'), getSingleFlight('/tmp/a'))
+        self.assertIsNot(getSingleFlight('/tmp/a'), getSingleFlight('/tmp/b'))
+        self.assertIsNone(getSingleFlight().directory)
+
+    def test_write(self):
+        # Old jobs are removed from the lock files
+        with open(os.path.join(self.directory.name, 'flights.json'), 'w+') as file_:
+            self.flight.write(file_, {'a': {'jobId': 'job_a', 'location': 'US', 'submitted': 0},
+                                      'b': {'jobId': 'job_b', 'location': 'US', 'submitted': 4102444800}})
+            self.assertEqual(list(self.flight.read(file_)), ['b'])
+
+    def test_read(self):
+        # Empty files contain no job
+        with open(os.path.join(self.directory.name, 'flights.json'), 'w+') as file_:
+            self.assertEqual(self.flight.read(file_), {})
@@ -0,0 +1,109 @@
+import unittest
+from unittest.mock import MagicMock
+import datetime
+import os
+import tempfile
+
+from ..tokencache import TokenCache
+
+
+class FakeCredentials:
+    """
+        Credentials fetching a new token valid for `lifetime` seconds on each refresh
+    """
+
+    def __init__(self, lifetime=3600):
+        self.token = None
+        self.expiry = None
+        self.lifetime = lifetime
+        self.refreshes = 0
+        self.service_account_email = 'fdw@project.iam.gserviceaccount.com'
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = 'token ' + str(self.refreshes)
+        self.expiry = datetime.datetime.now(datetime.timezone.utc).replace(
+            tzinfo=None) + datetime.timedelta(seconds=self.lifetime)
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        # Set TokenCache instance
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = TokenCache()
+        self.cache.directory = self.directory.name
+
+    def test_getKey(self):
+        credentials = FakeCredentials()
+        credentials.scopes = ['b', 'a']
+
+        self.assertEqual(self.cache.getKey(credentials),
+                         'fdw@project.iam.gserviceaccount.com a b')
+
+    def test_attach(self):
+        # Tokens should be shared between credentials of different processes
+        credentials = FakeCredentials()
+        self.assertTrue(self.cache.attach(credentials, 'key'))
+        credentials.refresh(MagicMock())
+
+        other = FakeCredentials()
+        self.cache.attach(other, 'key')
+        other.refresh(MagicMock())
+
+        self.assertEqual(other.token, 'token 1')
+        self.assertEqual(other.expiry.replace(microsecond=0),
+                         credentials.expiry.replace(microsecond=0))
+        self.assertEqual(other.refreshes, 0)
+
+    def test_attach_2(self):
+        # Tokens expiring soon should be renewed
+        credentials = FakeCredentials(60)
+        self.cache.attach(credentials, 'key')
+        credentials.refresh(MagicMock())
+        credentials.refresh(MagicMock())
+
+        self.assertEqual(credentials.refreshes, 2)
+        self.assertEqual(credentials.token, 'token 2')
+
+    def test_attach_3(self):
+        # The cache is disabled without a directory
+        self.cache.directory = None
+        credentials = FakeCredentials()
+
+        self.assertFalse(self.cache.attach(credentials, 'key'))
+        credentials.refresh(MagicMock())
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_refresh(self):
+        # Token files should only be readable by their owner
+        credentials = FakeCredentials()
+        self.cache.refresh(credentials, credentials.refresh, MagicMock(), 'key')
+
+        self.assertEqual(os.stat(self.cache.getPath('key')).st_mode & 0o777, 0o600)
+
+    def test_refresh_2(self):
+        # Symbolic links planted in the directory should not be followed
+        target = os.path.join(self.directory.name, 'target')
+        os.symlink(target, self.cache.getPath('key'))
+        credentials = FakeCredentials()
+
+        self.assertRaises(OSError, self.cache.refresh, credentials, credentials.refresh, MagicMock(), 'key')
+        self.assertFalse(os.path.exists(target))
+
+    def test_refresh_3(self):
+        # Token files accessible by other users should not be used
+        with open(self.cache.getPath('key'), 'w') as file_:
+            file_.write('{"token": "planted", "expiry": 4102444800}')
+        os.chmod(self.cache.getPath('key'), 0o666)
+        credentials = FakeCredentials()
+        self.cache.refresh(credentials, credentials.refresh, MagicMock(), 'key')
+
+        self.assertEqual(credentials.token, 'token 1')
+
+    def test_read(self):
+        # Corrupted files should be ignored
+        with open(self.cache.getPath('key'), 'w+') as file_:
+            file_.write('{"tok')
+            self.assertIsNone(self.cache.read(file_))